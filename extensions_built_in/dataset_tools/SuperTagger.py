@@ -1,9 +1,11 @@
 import copy
 import json
 import os
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import gc
 import traceback
+from typing import List, Union
 import torch
 from PIL import Image, ImageOps
 from tqdm import tqdm
@@ -27,6 +29,19 @@ def flush():
 VERSION = 2
 
 
+class TaggerItem:
+    # an image on its way through the pipeline. Prepared on a worker thread, captioned in a batch on the main one
+    def __init__(self, img_path: str, train_img_path: str, json_path: str, img_info: ImgInfo):
+        self.img_path = img_path
+        self.train_img_path = train_img_path
+        self.json_path = json_path
+        self.img_info = img_info
+        self.image: Image = None
+        self.caption_image: Image = None
+        self.did_update_image = False
+        self.caption_steps: List[Step] = []
+
+
 class SuperTagger(BaseExtensionProcess):
 
     def __init__(self, process_id: int, job, config: OrderedDict):
@@ -41,8 +56,13 @@ class SuperTagger(BaseExtensionProcess):
         self.force_reprocess_img = config.get('force_reprocess_img', False)
         self.caption_replacements = config.get('caption_replacements', default_replacements)
         self.caption_short_replacements = config.get('caption_short_replacements', default_replacements)
-        self.master_dataset_dict = OrderedDict()
+        # number of images captioned together. caption and caption_short for the whole batch go in one generate call
+        self.batch_size = config.get('batch_size', 1)
+        # threads that load and resize images ahead of the model. 0 loads them on the main thread
+        self.num_workers = config.get('num_workers', 4)
         self.dataset_master_config_file = config.get('dataset_master_config_file', None)
+        self.master_config_file = None
+        self.num_master_entries = 0
         if parent_dir is not None and len(self.dataset_paths) == 0:
             # find all folders in the patent_dataset_path
             self.dataset_paths = [
@@ -68,7 +88,8 @@ class SuperTagger(BaseExtensionProcess):
         else:
             raise ValueError(f"Unknown caption method: {self.caption_method}")
 
-    def process_image(self, img_path: str):
+    def prepare_image(self, img_path: str) -> TaggerItem:
+        # loads the image info and does everything except captioning. Thread safe, runs on the workers
         root_img_dir = os.path.dirname(os.path.dirname(img_path))
         filename = os.path.basename(img_path)
         filename_no_ext = os.path.splitext(filename)[0]
@@ -88,10 +109,7 @@ class SuperTagger(BaseExtensionProcess):
         img_info.set_version(VERSION)
         img_info.set_caption_method(self.caption_method)
 
-        image: Image = None
-        caption_image: Image = None
-
-        did_update_image = False
+        item = TaggerItem(img_path, train_img_path, json_path, img_info)
 
         # trigger reprocess of steps
         if self.force_reprocess_img:
@@ -99,69 +117,151 @@ class SuperTagger(BaseExtensionProcess):
 
         # set the image as updated if it does not exist on disk
         if not os.path.exists(train_img_path):
-            did_update_image = True
-            image = load_image(img_path)
+            item.did_update_image = True
+            item.image = load_image(img_path)
         if img_info.force_image_process:
-            did_update_image = True
-            image = load_image(img_path)
+            item.did_update_image = True
+            item.image = load_image(img_path)
 
-        # go through the needed steps
+        # go through the needed steps. Steps already in the image info state are skipped, so runs can be resumed
         for step in copy.deepcopy(img_info.state.steps_to_complete):
-            if step == 'caption':
+            if step == 'caption' or step == 'caption_short':
                 # load image
-                if image is None:
-                    image = load_image(img_path)
-                if caption_image is None:
-                    caption_image = resize_to_max(image, 1024, 1024)
-
-                if not self.image_processor.is_loaded:
-                    print('Loading Model. Takes a while, especially the first time')
-                    self.image_processor.load_model()
-
-                img_info.caption = self.image_processor.generate_caption(
-                    image=caption_image,
-                    prompt=self.caption_prompt,
-                    replacements=self.caption_replacements
-                )
-                img_info.mark_step_complete(step)
-            elif step == 'caption_short':
-                # load image
-                if image is None:
-                    image = load_image(img_path)
-
-                if caption_image is None:
-                    caption_image = resize_to_max(image, 1024, 1024)
-
-                if not self.image_processor.is_loaded:
-                    print('Loading Model. Takes a while, especially the first time')
-                    self.image_processor.load_model()
-                img_info.caption_short = self.image_processor.generate_caption(
-                    image=caption_image,
-                    prompt=self.caption_short_prompt,
-                    replacements=self.caption_short_replacements
-                )
-                img_info.mark_step_complete(step)
+                if item.image is None:
+                    item.image = load_image(item.img_path)
+                # captions see the image as it is at the first caption step
+                if item.caption_image is None:
+                    item.caption_image = resize_to_max(item.image, 1024, 1024)
+                item.caption_steps.append(step)
             elif step == 'contrast_stretch':
                 # load image
-                if image is None:
-                    image = load_image(img_path)
-                image = ImageOps.autocontrast(image, cutoff=(0.1, 0), preserve_tone=True)
-                did_update_image = True
+                if item.image is None:
+                    item.image = load_image(img_path)
+                item.image = ImageOps.autocontrast(item.image, cutoff=(0.1, 0), preserve_tone=True)
+                item.did_update_image = True
                 img_info.mark_step_complete(step)
             else:
                 raise ValueError(f"Unknown step: {step}")
 
-        os.makedirs(os.path.dirname(train_img_path), exist_ok=True)
-        if did_update_image:
-            image.save(train_img_path)
+        return item
+
+    def caption_images(self, items: List[TaggerItem]):
+        # captions all the pending caption steps of the items in a single generate call
+        requests = []
+        for item in items:
+            for step in item.caption_steps:
+                requests.append((item, step))
+        if len(requests) == 0:
+            return
+
+        if not self.image_processor.is_loaded:
+            print('Loading Model. Takes a while, especially the first time')
+            self.image_processor.load_model()
+
+        images = []
+        prompts = []
+        replacements = []
+        for item, step in requests:
+            images.append(item.caption_image)
+            if step == 'caption':
+                prompts.append(self.caption_prompt)
+                replacements.append(self.caption_replacements)
+            else:
+                prompts.append(self.caption_short_prompt)
+                replacements.append(self.caption_short_replacements)
+
+        captions = self.image_processor.generate_captions(
+            images=images,
+            prompts=prompts,
+            replacements=replacements
+        )
+        for (item, step), caption in zip(requests, captions):
+            if step == 'caption':
+                item.img_info.caption = caption
+            else:
+                item.img_info.caption_short = caption
+            item.img_info.mark_step_complete(step)
+        for item in items:
+            item.caption_steps = []
+            # done with the caption image
+            item.caption_image = None
+
+    def finish_image(self, item: TaggerItem):
+        os.makedirs(os.path.dirname(item.train_img_path), exist_ok=True)
+        if item.did_update_image:
+            item.image.save(item.train_img_path)
 
-        if img_info.is_dirty:
-            with open(json_path, 'w') as f:
-                json.dump(img_info.to_dict(), f, indent=4)
+        if item.img_info.is_dirty:
+            with open(item.json_path, 'w') as f:
+                json.dump(item.img_info.to_dict(), f, indent=4)
 
-        if self.dataset_master_config_file:
-            # add to master dict
-            self.master_dataset_dict[train_img_path] = img_info.to_dict()
+        if self.master_config_file is not None:
+            self.write_master_entry(item.train_img_path, item.img_info.to_dict())
+
+    def process_image(self, img_path: str):
+        item = self.prepare_image(img_path)
+        self.caption_images([item])
+        self.finish_image(item)
+
+    def open_master_config(self):
+        self.master_config_file = open(self.dataset_master_config_file, 'w')
+        self.master_config_file.write('{')
+        self.num_master_entries = 0
+
+    def write_master_entry(self, key: str, value: dict):
+        # written as it goes so a large dataset never has to be held in memory. Same layout as json.dump indent=4
+        entry = json.dumps({key: value}, indent=4)[1:-2]
+        if self.num_master_entries > 0:
+            self.master_config_file.write(',')
+        self.master_config_file.write(entry)
+        self.master_config_file.flush()
+        self.num_master_entries += 1
+
+    def close_master_config(self):
+        if self.master_config_file is None:
+            return
+        self.master_config_file.write('\n}' if self.num_master_entries > 0 else '}')
+        self.master_config_file.close()
+        self.master_config_file = None
+
+    def _get_prepared(self, img_path: str, future) -> Union[TaggerItem, None]:
+        try:
+            return future.result() if future is not None else self.prepare_image(img_path)
+        except Exception:
+            # print full stack trace
+            print(f"Error preparing {img_path}")
+            print(traceback.format_exc())
+            return None
+
+    def iter_prepared_images(self, img_paths: List[str]):
+        # yields prepared items in order while the workers load the next ones
+        if self.num_workers <= 0:
+            for img_path in img_paths:
+                yield self._get_prepared(img_path, None)
+            return
+        # only keep a few batches worth of decoded images in memory
+        max_queued = max(self.batch_size * 2, self.num_workers * 2)
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            queued = deque()
+            for img_path in img_paths:
+                queued.append((img_path, executor.submit(self.prepare_image, img_path)))
+                if len(queued) >= max_queued:
+                    yield self._get_prepared(*queued.popleft())
+            while len(queued) > 0:
+                yield self._get_prepared(*queued.popleft())
+
+    def process_batch(self, items: List[TaggerItem]):
+        try:
+            self.caption_images(items)
+        except Exception:
+            # print full stack trace. Nothing is marked complete, the next run picks these up again
+            print(traceback.format_exc())
+            return
+        for item in items:
+            try:
+                self.finish_image(item)
+            except Exception:
+                print(traceback.format_exc())
 
     def run(self):
         super().run()
@@ -173,24 +273,27 @@ class SuperTagger(BaseExtensionProcess):
             for raw_image_path in raw_image_paths:
                 imgs_to_process.append(raw_image_path)
 
+        if self.dataset_master_config_file is not None:
+            self.open_master_config()
+
         if len(imgs_to_process) == 0:
             print(f"No images to process")
         else:
             print(f"Found {len(imgs_to_process)} to process")
 
-            for img_path in tqdm(imgs_to_process, desc="Processing images"):
-                try:
-                    self.process_image(img_path)
-                except Exception:
-                    # print full stack trace
-                    print(traceback.format_exc())
+            batch = []
+            for item in tqdm(self.iter_prepared_images(imgs_to_process), total=len(imgs_to_process),
+                             desc="Processing images"):
+                if item is None:
                     continue
-                # self.process_image(img_path)
-
-        if self.dataset_master_config_file is not None:
-            # save it as json
-            with open(self.dataset_master_config_file, 'w') as f:
-                json.dump(self.master_dataset_dict, f, indent=4)
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    self.process_batch(batch)
+                    batch = []
+            if len(batch) > 0:
+                self.process_batch(batch)
+
+        self.close_master_config()
 
         del self.image_processor
         flush()
@@ -1,5 +1,7 @@
 from transformers import  CLIPImageProcessor, BitsAndBytesConfig, AutoTokenizer
 
+from typing import List
+
 from .caption import default_long_prompt, default_short_prompt, default_replacements, clean_caption
 import torch
 from PIL import Image
@@ -34,25 +36,39 @@ class FuyuImageProcessor:
         self.model = FuyuForCausalLM.from_pretrained(model_path, torch_dtype=self.dtype, **kwargs)
         self.processor = FuyuProcessor(image_processor=FuyuImageProcessor(), tokenizer=self.tokenizer)
 
+    def _to_device(self, value):
+        # batched image patches come back as a list of tensors
+        if isinstance(value, list):
+            return [self._to_device(v) for v in value]
+        return value.to(dtype=self.dtype if torch.is_floating_point(value) else value.dtype, device=self.device)
+
     def generate_caption(
             self, image: Image,
             prompt: str = default_long_prompt,
             replacements=default_replacements,
             max_new_tokens=512
     ):
-        # prepare inputs for the model
-        # text_prompt = f"{prompt}\n"
+        return self.generate_captions(
+            [image], [prompt], replacements=[replacements], max_new_tokens=max_new_tokens
+        )[0]
 
-        # image = image.convert('RGB')
-        model_inputs = self.processor(text=prompt, images=[image])
-        model_inputs = {k: v.to(dtype=self.dtype if torch.is_floating_point(v) else v.dtype, device=self.device) for k, v in
-                        model_inputs.items()}
+    def generate_captions(
+            self,
+            images: List[Image.Image],
+            prompts: List[str],
+            replacements: List[list] = None,
+            max_new_tokens=512
+    ) -> List[str]:
+        # captions a batch in one generate call, the processor left pads the prompts
+        if replacements is None:
+            replacements = [default_replacements] * len(images)
+        model_inputs = self.processor(text=prompts, images=images)
+        model_inputs = {k: self._to_device(v) for k, v in model_inputs.items()}
 
         generation_output = self.model.generate(**model_inputs, max_new_tokens=max_new_tokens)
         prompt_len = model_inputs["input_ids"].shape[-1]
-        output = self.tokenizer.decode(generation_output[0][prompt_len:], skip_special_tokens=True)
-        output = clean_caption(output, replacements=replacements)
-        return output
+        outputs = self.tokenizer.batch_decode(generation_output[:, prompt_len:], skip_special_tokens=True)
+        return [clean_caption(output, replacements=replacements[idx]) for idx, output in enumerate(outputs)]
 
         # inputs = self.processor(text=text_prompt, images=image, return_tensors="pt")
         # for k, v in inputs.items():
@@ -1,4 +1,6 @@
 
+from typing import List
+
 from .caption import default_long_prompt, default_short_prompt, default_replacements, clean_caption
 
 import torch
@@ -52,34 +54,67 @@ class LLaVAImageProcessor:
             replacements=default_replacements,
             max_new_tokens=512
     ):
+        return self.generate_captions(
+            [image], [prompt], replacements=[replacements], max_new_tokens=max_new_tokens
+        )[0]
+
+    def generate_captions(
+            self,
+            images: List[Image.Image],
+            prompts: List[str],
+            replacements: List[list] = None,
+            max_new_tokens=512
+    ) -> List[str]:
+        # captions a batch in one generate call. Each image gets its own prompt, prompts are left padded
         from llava.conversation import conv_templates, SeparatorStyle
         from llava.utils import disable_torch_init
         from llava.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
         from llava.mm_utils import tokenizer_image_token, KeywordsStoppingCriteria
-        # question = "how many dogs are in the picture?"
+        if replacements is None:
+            replacements = [default_replacements] * len(images)
         disable_torch_init()
         conv_mode = "llava_v0"
-        conv = conv_templates[conv_mode].copy()
-        roles = conv.roles
-        image_tensor = self.image_processor.preprocess([image], return_tensors='pt')['pixel_values'].half().cuda()
+        image_tensor = self.image_processor.preprocess(images, return_tensors='pt')['pixel_values'].half().cuda()
+
+        prompt_ids = []
+        stop_str = None
+        for prompt in prompts:
+            conv = conv_templates[conv_mode].copy()
+            roles = conv.roles
+            inp = f"{roles[0]}: {prompt}"
+            inp = DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN + '\n' + inp
+            conv.append_message(conv.roles[0], inp)
+            conv.append_message(conv.roles[1], None)
+            raw_prompt = conv.get_prompt()
+            prompt_ids.append(tokenizer_image_token(raw_prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt'))
+            stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
+
+        pad_token_id = self.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = self.tokenizer.unk_token_id
+        max_len = max([len(ids) for ids in prompt_ids])
+        input_ids = torch.full((len(prompt_ids), max_len), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(prompt_ids), max_len), dtype=torch.long)
+        for idx, ids in enumerate(prompt_ids):
+            input_ids[idx, max_len - len(ids):] = ids
+            attention_mask[idx, max_len - len(ids):] = 1
+        input_ids = input_ids.cuda()
+        attention_mask = attention_mask.cuda()
+        # llava re pads after inserting the image features, keep the padding on the left for generation
+        self.model.config.tokenizer_padding_side = 'left'
 
-        inp = f"{roles[0]}: {prompt}"
-        inp = DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN + '\n' + inp
-        conv.append_message(conv.roles[0], inp)
-        conv.append_message(conv.roles[1], None)
-        raw_prompt = conv.get_prompt()
-        input_ids = tokenizer_image_token(raw_prompt, self.tokenizer, IMAGE_TOKEN_INDEX,
-                                          return_tensors='pt').unsqueeze(0).cuda()
-        stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
         keywords = [stop_str]
         stopping_criteria = KeywordsStoppingCriteria(keywords, self.tokenizer, input_ids)
         with torch.inference_mode():
             output_ids = self.model.generate(
-                input_ids, images=image_tensor, do_sample=True, temperature=0.1,
+                input_ids, attention_mask=attention_mask, images=image_tensor, do_sample=True, temperature=0.1,
                 max_new_tokens=max_new_tokens, use_cache=True, stopping_criteria=[stopping_criteria],
-                top_p=0.8
+                top_p=0.8, pad_token_id=pad_token_id
             )
-        outputs = self.tokenizer.decode(output_ids[0, input_ids.shape[1]:]).strip()
-        conv.messages[-1][-1] = outputs
-        output = outputs.rsplit('</s>', 1)[0]
-        return clean_caption(output, replacements=replacements)
+        captions = []
+        for idx in range(len(prompt_ids)):
+            outputs = self.tokenizer.decode(output_ids[idx, input_ids.shape[1]:]).strip()
+            # finished rows are padded after the first end token
+            output = outputs.split('</s>', 1)[0]
+            captions.append(clean_caption(output, replacements=replacements[idx]))
+        return captions
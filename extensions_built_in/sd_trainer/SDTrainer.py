@@ -1,7 +1,7 @@
 import os
 import random
 from collections import OrderedDict
-from typing import Union, Literal, List, Optional
+from typing import Union, Literal, List, Optional, Dict
 
 import numpy as np
 from diffusers import T2IAdapter, AutoencoderTiny, ControlNetModel
@@ -20,7 +20,7 @@ from toolkit.guidance import get_targeted_guidance_loss, get_guidance_loss, Guid
 from toolkit.image_utils import show_tensors, show_latents
 from toolkit.ip_adapter import IPAdapter
 from toolkit.custom_adapter import CustomAdapter
-from toolkit.prompt_utils import PromptEmbeds, concat_prompt_embeds
+from toolkit.prompt_utils import PromptEmbeds, concat_prompt_embeds, split_prompt_embeds
 from toolkit.reference_adapter import ReferenceAdapter
 from toolkit.stable_diffusion_model import StableDiffusion, BlankNetwork
 from toolkit.train_tools import get_torch_dtype, apply_snr_weight, add_all_snr_to_noise_scheduler, \
@@ -78,6 +78,8 @@ class SDTrainer(BaseSDTrainProcess):
 
         self.cached_blank_embeds: Optional[PromptEmbeds] = None
         self.cached_trigger_embeds: Optional[PromptEmbeds] = None
+        # negative prompt -> embeds when caching text embeddings
+        self.cached_negative_embeds: Optional[Dict[str, PromptEmbeds]] = None
 
 
     def before_model_load(self):
@@ -179,6 +181,36 @@ class SDTrainer(BaseSDTrainProcess):
                 self.sd.text_encoder_to('cpu')
                 flush()
 
+        if self.train_config.cache_text_embeddings:
+            if self.train_config.unload_text_encoder:
+                raise ValueError("cache_text_embeddings and unload_text_encoder cannot be used together")
+            if self.embedding is not None:
+                raise ValueError("Cannot cache text embeddings while training an embedding")
+            if self.adapter is not None and isinstance(self.adapter, (ClipVisionAdapter, CustomAdapter)):
+                raise ValueError("Cannot cache text embeddings with an adapter that modifies the text encoder")
+            if self.train_config.do_cfg or self.train_config.do_random_cfg:
+                if self.negative_prompt_pool is not None and self.train_config.max_negative_prompts > 1:
+                    raise ValueError("max_negative_prompts must be 1 when caching text embeddings")
+            with torch.no_grad():
+                self.sd.text_encoder_to(self.device_torch)
+                datasets = get_dataloader_datasets(self.data_loader) if self.data_loader is not None else []
+                if self.data_loader_reg is not None:
+                    datasets = datasets + get_dataloader_datasets(self.data_loader_reg)
+                for dataset in datasets:
+                    dataset.cache_text_embeddings(self.get_conditioned_prompt)
+
+                # used for prompt dropout
+                self.cached_blank_embeds = self.sd.encode_prompt("").to('cpu')
+                if self.train_config.do_cfg or self.train_config.do_random_cfg:
+                    negative_prompts = self.negative_prompt_pool if self.negative_prompt_pool is not None else ['']
+                    self.cached_negative_embeds = {}
+                    for negative_prompt in negative_prompts:
+                        self.cached_negative_embeds[negative_prompt] = self.sd.encode_prompt(negative_prompt).to('cpu')
+
+                # text encoders are not needed for training anymore
+                self.sd.text_encoder_to('cpu')
+                flush()
+
 
     def process_output_for_turbo(self, pred, noisy_latents, timesteps, noise, batch):
         # to process turbo learning, we make one big step from our current timestep to the end
@@ -1123,6 +1155,10 @@ class SDTrainer(BaseSDTrainProcess):
             noise_list = torch.chunk(noise, batch_size, dim=0)
             timesteps_list = torch.chunk(timesteps, batch_size, dim=0)
             conditioned_prompts_list = [[prompt] for prompt in prompts_1]
+            if batch.prompt_embeds is not None:
+                prompt_embeds_list = split_prompt_embeds(batch.prompt_embeds, batch_size)
+            else:
+                prompt_embeds_list = [None for _ in range(batch_size)]
             if imgs is not None:
                 imgs_list = torch.chunk(imgs, batch_size, dim=0)
             else:
@@ -1146,6 +1182,7 @@ class SDTrainer(BaseSDTrainProcess):
             noise_list = [noise]
             timesteps_list = [timesteps]
             conditioned_prompts_list = [prompts_1]
+            prompt_embeds_list = [batch.prompt_embeds]
             imgs_list = [imgs]
             adapter_images_list = [adapter_images]
             clip_images_list = [clip_images]
@@ -1155,11 +1192,12 @@ class SDTrainer(BaseSDTrainProcess):
             else:
                 prompt_2_list = [prompts_2]
 
-        for noisy_latents, noise, timesteps, conditioned_prompts, imgs, adapter_images, clip_images, mask_multiplier, prompt_2 in zip(
+        for noisy_latents, noise, timesteps, conditioned_prompts, prompt_embeds, imgs, adapter_images, clip_images, mask_multiplier, prompt_2 in zip(
                 noisy_latents_list,
                 noise_list,
                 timesteps_list,
                 conditioned_prompts_list,
+                prompt_embeds_list,
                 imgs_list,
                 adapter_images_list,
                 clip_images_list,
@@ -1235,6 +1273,26 @@ class SDTrainer(BaseSDTrainProcess):
                             if isinstance(self.adapter, CustomAdapter):
                                 self.adapter.is_unconditional_run = False
 
+                    elif self.train_config.cache_text_embeddings:
+                        with torch.set_grad_enabled(False):
+                            if prompt_embeds is None:
+                                raise ValueError("Text embeddings are not cached for this batch")
+                            conditional_embeds = prompt_embeds.clone().detach().to(self.device_torch, dtype=dtype)
+                            if self.train_config.prompt_dropout_prob > 0.0:
+                                # drop out to the blank prompt the same way the text encoder would
+                                blank_embeds = self.cached_blank_embeds.clone().detach().to(
+                                    self.device_torch, dtype=dtype
+                                )
+                                conditional_embeds = concat_prompt_embeds([
+                                    blank_embeds if random.random() < self.train_config.prompt_dropout_prob else embeds
+                                    for embeds in split_prompt_embeds(conditional_embeds)
+                                ])
+                            if self.train_config.do_cfg:
+                                unconditional_embeds = concat_prompt_embeds([
+                                    self.cached_negative_embeds[negative_prompt]
+                                    for negative_prompt in self.batch_negative_prompt
+                                ]).to(self.device_torch, dtype=dtype).detach()
+
                     elif grad_on_text_encoder:
                         with torch.set_grad_enabled(True):
                             if isinstance(self.adapter, CustomAdapter):
@@ -1638,6 +1696,9 @@ class SDTrainer(BaseSDTrainProcess):
                         torch.nn.utils.clip_grad_norm_(self.params[i]['params'], self.train_config.max_grad_norm)
                 else:
                     torch.nn.utils.clip_grad_norm_(self.params, self.train_config.max_grad_norm)
+            if self.ema is not None:
+                # an offloaded ema may still be copying the params from the last step
+                self.ema.wait_for_transfer()
             # only step if we are not accumulating
             with self.timer('optimizer_step'):
                 # self.optimizer.step()
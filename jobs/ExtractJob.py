@@ -1,4 +1,5 @@
 from toolkit.kohya_model_util import load_models_from_stable_diffusion_checkpoint
+from toolkit.safetensors_stream import LazySafetensors
 from collections import OrderedDict
 from jobs import BaseJob
 from toolkit.train_tools import get_torch_dtype
@@ -30,6 +31,10 @@ class ExtractJob(BaseJob):
         self.output_folder = self.get_conf('output_folder', required=True)
         self.is_v2 = self.get_conf('is_v2', False)
         self.device = self.get_conf('device', 'cpu')
+        # read the safetensors checkpoints a few layers at a time instead of loading both models.
+        # lora names come from the checkpoint keys with lora_prefix in front
+        self.stream = self.get_conf('stream', False)
+        self.lora_prefix = self.get_conf('lora_prefix', 'lora_unet')
 
         # loads the processes from the config
         self.load_processes(process_dict)
@@ -37,6 +42,13 @@ class ExtractJob(BaseJob):
     def run(self):
         super().run()
         # load models
+        if self.stream:
+            print(f"Streaming models for extraction")
+            self.model_base = LazySafetensors(self.base_model_path)
+            self.model_extract = LazySafetensors(self.extract_model_path)
+            self.run_processes()
+            return
+
         print(f"Loading models for extraction")
         print(f" - Loading base model: {self.base_model_path}")
         # (text_model, vae, unet)
@@ -51,6 +63,9 @@ class ExtractJob(BaseJob):
         self.model_extract_vae = self.model_extract[1]
         self.model_extract_unet = self.model_extract[2]
 
+        self.run_processes()
+
+    def run_processes(self):
         print("")
         print(f"Running  {len(self.process)} process{'' if len(self.process) == 1 else 'es'}")
 
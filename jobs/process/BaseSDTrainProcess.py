@@ -22,6 +22,8 @@ from huggingface_hub import HfApi, Repository, interpreter_login
 from huggingface_hub.utils import HfFolder
 
 from toolkit.basic import value_map
+from toolkit.batch_prefetcher import BatchPrefetcher
+from toolkit.checkpoint_writer import AsyncCheckpointWriter
 from toolkit.clip_vision_adapter import ClipVisionAdapter
 from toolkit.custom_adapter import CustomAdapter
 from toolkit.data_loader import get_dataloader_from_datasets, trigger_dataloader_setup_epoch
@@ -37,9 +39,12 @@ from toolkit.lycoris_special import LycorisSpecialNetwork
 from toolkit.models.decorator import Decorator
 from toolkit.network_mixins import Network
 from toolkit.optimizer import get_optimizer
+from toolkit.optimizers.optimizer_utils import stochastic_rounder
 from toolkit.paths import CONFIG_ROOT
 from toolkit.progress_bar import ToolkitProgressBar
+from toolkit.prompt_utils import concat_prompt_embeds
 from toolkit.reference_adapter import ReferenceAdapter
+from toolkit.sample_worker import SampleWorker
 from toolkit.sampler import get_sampler
 from toolkit.saving import save_t2i_from_diffusers, load_t2i_model, save_ip_adapter_from_diffusers, \
     load_ip_adapter_model, load_custom_adapter_model
@@ -97,7 +102,12 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.model_config = ModelConfig(**model_config)
 
         self.save_config = SaveConfig(**self.get_conf('save', {}))
+        self.checkpoint_writer: Union[AsyncCheckpointWriter, None] = None
+        if self.save_config.async_save:
+            self.checkpoint_writer = AsyncCheckpointWriter()
         self.sample_config = SampleConfig(**self.get_conf('sample', {}))
+        # set up in run once the network exists
+        self.sample_worker: Union[SampleWorker, None] = None
         first_sample_config = self.get_conf('first_sample', None)
         if first_sample_config is not None:
             self.has_first_sample_requested = True
@@ -167,6 +177,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.adapter: Union[T2IAdapter, IPAdapter, ClipVisionAdapter, ReferenceAdapter, CustomAdapter, ControlNetModel, None] = None
         self.embedding: Union[Embedding, None] = None
         self.decorator: Union[Decorator, None] = None
+        # the train timesteps we last set on the noise scheduler, if they are the same every step
+        self.train_timesteps: Union[torch.Tensor, None] = None
 
         is_training_adapter = self.adapter_config is not None and self.adapter_config.train
 
@@ -186,7 +198,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
             train_embedding=self.embed_config is not None,
             train_decorator=self.decorator_config is not None,
             train_refiner=self.train_config.train_refiner,
-            unload_text_encoder=self.train_config.unload_text_encoder,
+            unload_text_encoder=self.train_config.unload_text_encoder or self.train_config.cache_text_embeddings,
             require_grads=False  # we ensure them later
         )
         
@@ -200,7 +212,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
             train_embedding=self.embed_config is not None,
             train_decorator=self.decorator_config is not None,
             train_refiner=self.train_config.train_refiner,
-            unload_text_encoder=self.train_config.unload_text_encoder,
+            unload_text_encoder=self.train_config.unload_text_encoder or self.train_config.cache_text_embeddings,
             require_grads=True  # We check for grads when getting params
         )
 
@@ -300,12 +312,121 @@ class BaseSDTrainProcess(BaseTrainProcess):
         if self.ema is not None:
             self.ema.eval()
 
-        # send to be generated
-        self.sd.generate_images(gen_img_config_list, sampler=sample_config.sampler)
+        if self.sample_worker is not None:
+            # the worker renders them with a snapshot of the network while we keep training
+            self.sample_worker.submit(
+                step,
+                SampleWorker.snapshot_state_dict(self.network.state_dict()),
+                gen_img_config_list,
+                sampler=sample_config.sampler,
+                batch_size=sample_config.batch_size
+            )
+        else:
+            # sampling needs the memory more than the rounding scratch buffers
+            stochastic_rounder.release_scratch()
+            # send to be generated
+            self.sd.generate_images(
+                gen_img_config_list,
+                sampler=sample_config.sampler,
+                batch_size=sample_config.batch_size
+            )
 
         if self.ema is not None:
             self.ema.train()
 
+    def get_network_class_and_kwargs(self):
+        # TODO should we completely switch to LycorisSpecialNetwork?
+        network_kwargs = self.network_config.network_kwargs
+        is_lycoris = False
+        is_lorm = self.network_config.type.lower() == 'lorm'
+        # default to LoCON if there are any conv layers or if it is named
+        NetworkClass = LoRASpecialNetwork
+        if self.network_config.type.lower() == 'locon' or self.network_config.type.lower() == 'lycoris':
+            NetworkClass = LycorisSpecialNetwork
+            is_lycoris = True
+
+        if is_lorm:
+            network_kwargs['ignore_if_contains'] = lorm_ignore_if_contains
+            network_kwargs['parameter_threshold'] = lorm_parameter_threshold
+            network_kwargs['target_lin_modules'] = LORM_TARGET_REPLACE_MODULE
+
+        # if is_lycoris:
+        #     preset = PRESET['full']
+        # NetworkClass.apply_preset(preset)
+
+        return NetworkClass, dict(
+            lora_dim=self.network_config.linear,
+            multiplier=1.0,
+            alpha=self.network_config.linear_alpha,
+            train_unet=self.train_config.train_unet,
+            train_text_encoder=self.train_config.train_text_encoder,
+            conv_lora_dim=self.network_config.conv,
+            conv_alpha=self.network_config.conv_alpha,
+            is_sdxl=self.model_config.is_xl or self.model_config.is_ssd,
+            is_v2=self.model_config.is_v2,
+            is_v3=self.model_config.is_v3,
+            is_pixart=self.model_config.is_pixart,
+            is_auraflow=self.model_config.is_auraflow,
+            is_flux=self.model_config.is_flux,
+            is_ssd=self.model_config.is_ssd,
+            is_vega=self.model_config.is_vega,
+            dropout=self.network_config.dropout,
+            use_text_encoder_1=self.model_config.use_text_encoder_1,
+            use_text_encoder_2=self.model_config.use_text_encoder_2,
+            use_bias=is_lorm,
+            is_lorm=is_lorm,
+            network_config=self.network_config,
+            network_type=self.network_config.type,
+            transformer_only=self.network_config.transformer_only,
+            **network_kwargs
+        )
+
+    def setup_sample_worker(self):
+        if not self.sample_config.async_sampling or self.train_config.disable_sampling:
+            return
+        # the worker only rebuilds the base model and a LoRA / LoCON network from the configs
+        can_sample_async = self.network is not None and not self.network.is_lorm and self.adapter is None and \
+                           self.embedding is None and self.decorator is None and \
+                           self.model_config.assistant_lora_path is None and \
+                           self.model_config.inference_lora_path is None and not self.train_config.train_refiner
+        if not can_sample_async:
+            self.print("Async sampling only supports LoRA and LoCON networks, sampling in the training process")
+            return
+        NetworkClass, network_init_kwargs = self.get_network_class_and_kwargs()
+        if self.sample_config.sample_device is not None:
+            device = self.sample_config.sample_device
+        else:
+            device = self.device
+            self.print(
+                f"Warning: async sampling without a sample_device loads a second copy of the model on {device}. "
+                f"Set sample_device to sample on another device"
+            )
+        self.sample_worker = SampleWorker(
+            device=device,
+            model_config=self.model_config,
+            dtype=self.train_config.dtype,
+            noise_scheduler=self.train_config.noise_scheduler,
+            network_class=NetworkClass,
+            network_kwargs=network_init_kwargs,
+            train_text_encoder=self.train_config.train_text_encoder,
+            train_unet=self.train_config.train_unet,
+            custom_pipeline=self.custom_pipeline,
+        )
+
+    def log_sample_results(self, block=False):
+        # log the samples the worker finished, with the step they were rendered at
+        if self.sample_worker is None:
+            return
+        for step, images, error in self.sample_worker.get_results(block=block):
+            if error is not None:
+                self.print(f"Sampling at step {step} failed: {error}")
+                continue
+            for image, idx, caption in images:
+                self.logger.log_image(image, idx, caption)
+            self.logger.log({
+                'sample_step': step,
+            })
+
     def update_training_metadata(self):
         o_dict = OrderedDict({
             "training_info": self.get_training_info()
@@ -417,7 +538,30 @@ class BaseSDTrainProcess(BaseTrainProcess):
         # override in subclass
         pass
 
+    def run_save_job(self, fn, *args, **kwargs):
+        # runs on the checkpoint writer thread when saving async, in order with the writes
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.submit(fn, *args, **kwargs)
+        else:
+            fn(*args, **kwargs)
+
+    def save_optimizer_file(self, state_dict, file_path):
+        try:
+            torch.save(state_dict, file_path)
+        except Exception as e:
+            print(e)
+            print("Could not save optimizer")
+
+    def finish_save(self, file_path):
+        self.print(f"Saved to {file_path}")
+        self.clean_up_saves()
+        self.post_save_hook(file_path)
+
     def save(self, step=None):
+        writer = self.checkpoint_writer
+        if writer is not None:
+            # only one checkpoint in flight, wait for the last one before taking another snapshot
+            writer.flush()
         flush()
         if self.ema is not None:
             # always save params as ema
@@ -463,7 +607,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     file_path,
                     dtype=get_torch_dtype(self.save_config.dtype),
                     metadata=save_meta,
-                    extra_state_dict=embedding_dict
+                    extra_state_dict=embedding_dict,
+                    writer=writer
                 )
                 self.network.multiplier = prev_multiplier
                 # if we have an embedding as well, pair it with the network
@@ -571,7 +716,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 self.sd.save(
                     file_path,
                     save_meta,
-                    get_torch_dtype(self.save_config.dtype)
+                    get_torch_dtype(self.save_config.dtype),
+                    writer=writer
                 )
 
         # save learnable params as json if we have thim
@@ -588,18 +734,18 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
         # save optimizer
         if self.optimizer is not None:
+            filename = f'optimizer.pt'
+            file_path = os.path.join(self.save_root, filename)
             try:
-                filename = f'optimizer.pt'
-                file_path = os.path.join(self.save_root, filename)
                 state_dict = self.optimizer.state_dict()
-                torch.save(state_dict, file_path)
+                if writer is not None:
+                    state_dict = writer.snapshot(state_dict)
+                self.run_save_job(self.save_optimizer_file, state_dict, file_path)
             except Exception as e:
                 print(e)
                 print("Could not save optimizer")
 
-        self.print(f"Saved to {file_path}")
-        self.clean_up_saves()
-        self.post_save_hook(file_path)
+        self.run_save_job(self.finish_save, file_path)
 
         if self.ema is not None:
             self.ema.train()
@@ -642,6 +788,11 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 decay=self.train_config.ema_config.ema_decay,
                 use_feedback=self.train_config.ema_config.use_feedback,
                 param_multiplier=self.train_config.ema_config.param_multiplier,
+                use_foreach=self.train_config.ema_config.use_foreach,
+                update_every=self.train_config.ema_config.update_every,
+                offload_to_cpu=self.train_config.ema_config.offload_to_cpu,
+                shadow_dtype=get_torch_dtype(self.train_config.ema_config.shadow_dtype),
+                num_offload_workers=self.train_config.ema_config.offload_workers,
             )
 
     def before_dataset_load(self):
@@ -772,13 +923,60 @@ class BaseSDTrainProcess(BaseTrainProcess):
         schedule_timesteps = self.sd.noise_scheduler.timesteps.to(self.device)
         timesteps = timesteps.to(self.device)
 
-        step_indices = [(schedule_timesteps == t).nonzero().item() for t in timesteps]
+        # first match of each timestep in the schedule without syncing with the device
+        matches = schedule_timesteps.unsqueeze(0) == timesteps.unsqueeze(1)
+        # argmax would silently give index 0 for a timestep not in the schedule, fail on the device instead
+        torch._assert_async(matches.any(dim=1).all(), "timestep not found in the noise scheduler timesteps")
+        step_indices = matches.int().argmax(dim=1)
 
         sigma = sigmas[step_indices].flatten()
         while len(sigma.shape) < n_dim:
             sigma = sigma.unsqueeze(-1)
         return sigma
 
+    def setup_train_timesteps(self):
+        noise_scheduler = self.sd.noise_scheduler
+        # skip rebuilding a fixed schedule unless something else, like sampling, replaced it on the scheduler
+        if self.train_timesteps is not None and noise_scheduler.timesteps is self.train_timesteps:
+            return
+
+        num_train_timesteps = self.train_config.num_train_timesteps
+        is_fixed_schedule = True
+
+        if self.train_config.noise_scheduler in ['custom_lcm']:
+            # we store this value on our custom one
+            noise_scheduler.set_timesteps(
+                noise_scheduler.train_timesteps, device=self.device_torch
+            )
+        elif self.train_config.noise_scheduler in ['lcm']:
+            noise_scheduler.set_timesteps(
+                num_train_timesteps, device=self.device_torch, original_inference_steps=num_train_timesteps
+            )
+        elif self.train_config.noise_scheduler == 'flowmatch':
+            linear_timesteps = any([
+                self.train_config.linear_timesteps,
+                self.train_config.linear_timesteps2,
+                self.train_config.timestep_type == 'linear',
+            ])
+
+            timestep_type = 'linear' if linear_timesteps else None
+            if timestep_type is None:
+                timestep_type = self.train_config.timestep_type
+
+            noise_scheduler.set_train_timesteps(
+                num_train_timesteps,
+                device=self.device_torch,
+                timestep_type=timestep_type
+            )
+            # the other types draw a new random schedule every step
+            is_fixed_schedule = timestep_type == 'linear'
+        else:
+            noise_scheduler.set_timesteps(
+                num_train_timesteps, device=self.device_torch
+            )
+
+        self.train_timesteps = noise_scheduler.timesteps if is_fixed_schedule else None
+
     def get_noise(self, latents, batch_size, dtype=torch.float32):
         # get noise
         noise = self.sd.get_latent_noise(
@@ -806,6 +1004,31 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
         return noise
 
+    def get_conditioned_prompt(self, prompt: str, is_reg: bool = False) -> str:
+        # make sure the embedding is in the prompts
+        if self.embedding is not None:
+            prompt = self.embedding.inject_embedding_to_prompt(
+                prompt,
+                expand_token=True,
+                add_if_not_present=not is_reg,
+            )
+
+        if self.adapter and isinstance(self.adapter, ClipVisionAdapter):
+            prompt = self.adapter.inject_trigger_into_prompt(
+                prompt,
+                expand_token=True,
+                add_if_not_present=not is_reg,
+            )
+
+        # make sure trigger is in the prompts if not a regularization run
+        if self.trigger_word is not None:
+            prompt = self.sd.inject_trigger_into_prompt(
+                prompt,
+                trigger=self.trigger_word,
+                add_if_not_present=not is_reg,
+            )
+        return prompt
+
     def process_general_training_batch(self, batch: 'DataLoaderBatchDTO'):
         with torch.no_grad():
             with self.timer('prepare_prompt'):
@@ -826,32 +1049,21 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     prompts = prompts + prompts
                     is_reg_list = is_reg_list + is_reg_list
 
+                if batch.prompt_embeds is not None:
+                    # text embeddings are cached, line them up with the prompts
+                    prompt_embeds = batch.prompt_embeds
+                    if self.train_config.short_and_long_captions and do_double:
+                        if batch.prompt_embeds_short is None:
+                            raise ValueError("Short caption embeddings were not cached for this batch")
+                        prompt_embeds = concat_prompt_embeds([prompt_embeds, batch.prompt_embeds_short])
+                    if self.model_config.refiner_name_or_path is not None and self.train_config.train_unet:
+                        prompt_embeds = concat_prompt_embeds([prompt_embeds, prompt_embeds])
+                    batch.prompt_embeds = prompt_embeds
+
                 conditioned_prompts = []
 
                 for prompt, is_reg in zip(prompts, is_reg_list):
-
-                    # make sure the embedding is in the prompts
-                    if self.embedding is not None:
-                        prompt = self.embedding.inject_embedding_to_prompt(
-                            prompt,
-                            expand_token=True,
-                            add_if_not_present=not is_reg,
-                        )
-
-                    if self.adapter and isinstance(self.adapter, ClipVisionAdapter):
-                        prompt = self.adapter.inject_trigger_into_prompt(
-                            prompt,
-                            expand_token=True,
-                            add_if_not_present=not is_reg,
-                        )
-
-                    # make sure trigger is in the prompts if not a regularization run
-                    if self.trigger_word is not None:
-                        prompt = self.sd.inject_trigger_into_prompt(
-                            prompt,
-                            trigger=self.trigger_word,
-                            add_if_not_present=not is_reg,
-                        )
+                    prompt = self.get_conditioned_prompt(prompt, is_reg)
 
                     if not is_reg and self.train_config.prompt_saturation_chance > 0.0:
                         # do random prompt saturation by expanding the prompt to hit at least 77 tokens
@@ -953,37 +1165,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     do_double = False
 
             with self.timer('prepare_noise'):
-                num_train_timesteps = self.train_config.num_train_timesteps
-
-                if self.train_config.noise_scheduler in ['custom_lcm']:
-                    # we store this value on our custom one
-                    self.sd.noise_scheduler.set_timesteps(
-                        self.sd.noise_scheduler.train_timesteps, device=self.device_torch
-                    )
-                elif self.train_config.noise_scheduler in ['lcm']:
-                    self.sd.noise_scheduler.set_timesteps(
-                        num_train_timesteps, device=self.device_torch, original_inference_steps=num_train_timesteps
-                    )
-                elif self.train_config.noise_scheduler == 'flowmatch':
-                    linear_timesteps = any([
-                        self.train_config.linear_timesteps,
-                        self.train_config.linear_timesteps2,
-                        self.train_config.timestep_type == 'linear',
-                    ])
-                    
-                    timestep_type = 'linear' if linear_timesteps else None
-                    if timestep_type is None:
-                        timestep_type = self.train_config.timestep_type
-                    
-                    self.sd.noise_scheduler.set_train_timesteps(
-                        num_train_timesteps,
-                        device=self.device_torch,
-                        timestep_type=timestep_type
-                    )
-                else:
-                    self.sd.noise_scheduler.set_timesteps(
-                        num_train_timesteps, device=self.device_torch
-                    )
+                self.setup_train_timesteps()
 
                 content_or_style = self.train_config.content_or_style
                 if is_reg:
@@ -1044,8 +1226,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 #     )
                 #     timestep_indices = (u * self.sd.noise_scheduler.config.num_train_timesteps).long()
                 # convert the timestep_indices to a timestep
-                timesteps = [self.sd.noise_scheduler.timesteps[x.item()] for x in timestep_indices]
-                timesteps = torch.stack(timesteps, dim=0)
+                timesteps = self.sd.noise_scheduler.timesteps[timestep_indices.to(self.sd.noise_scheduler.timesteps.device)]
 
                 # get noise
                 noise = self.get_noise(latents, batch_size, dtype=dtype)
@@ -1252,6 +1433,12 @@ class BaseSDTrainProcess(BaseTrainProcess):
         # set trainable params
         self.sd.adapter = self.adapter
 
+    def get_dataloader_iterator(self, dataloader: DataLoader):
+        if self.train_config.prefetch_batches > 0:
+            # loads the next batches in the background and copies them to the device on a side stream
+            return BatchPrefetcher(iter(dataloader), self.device_torch, self.train_config.prefetch_batches)
+        return iter(dataloader)
+
     def run(self):
         # torch.autograd.set_detect_anomaly(True)
         # run base process run
@@ -1398,52 +1585,12 @@ class BaseSDTrainProcess(BaseTrainProcess):
         flush()
         if not self.is_fine_tuning:
             if self.network_config is not None:
-                # TODO should we completely switch to LycorisSpecialNetwork?
-                network_kwargs = self.network_config.network_kwargs
-                is_lycoris = False
                 is_lorm = self.network_config.type.lower() == 'lorm'
-                # default to LoCON if there are any conv layers or if it is named
-                NetworkClass = LoRASpecialNetwork
-                if self.network_config.type.lower() == 'locon' or self.network_config.type.lower() == 'lycoris':
-                    NetworkClass = LycorisSpecialNetwork
-                    is_lycoris = True
-
-                if is_lorm:
-                    network_kwargs['ignore_if_contains'] = lorm_ignore_if_contains
-                    network_kwargs['parameter_threshold'] = lorm_parameter_threshold
-                    network_kwargs['target_lin_modules'] = LORM_TARGET_REPLACE_MODULE
-
-                # if is_lycoris:
-                #     preset = PRESET['full']
-                # NetworkClass.apply_preset(preset)
-
+                NetworkClass, network_init_kwargs = self.get_network_class_and_kwargs()
                 self.network = NetworkClass(
                     text_encoder=text_encoder,
                     unet=unet,
-                    lora_dim=self.network_config.linear,
-                    multiplier=1.0,
-                    alpha=self.network_config.linear_alpha,
-                    train_unet=self.train_config.train_unet,
-                    train_text_encoder=self.train_config.train_text_encoder,
-                    conv_lora_dim=self.network_config.conv,
-                    conv_alpha=self.network_config.conv_alpha,
-                    is_sdxl=self.model_config.is_xl or self.model_config.is_ssd,
-                    is_v2=self.model_config.is_v2,
-                    is_v3=self.model_config.is_v3,
-                    is_pixart=self.model_config.is_pixart,
-                    is_auraflow=self.model_config.is_auraflow,
-                    is_flux=self.model_config.is_flux,
-                    is_ssd=self.model_config.is_ssd,
-                    is_vega=self.model_config.is_vega,
-                    dropout=self.network_config.dropout,
-                    use_text_encoder_1=self.model_config.use_text_encoder_1,
-                    use_text_encoder_2=self.model_config.use_text_encoder_2,
-                    use_bias=is_lorm,
-                    is_lorm=is_lorm,
-                    network_config=self.network_config,
-                    network_type=self.network_config.type,
-                    transformer_only=self.network_config.transformer_only,
-                    **network_kwargs
+                    **network_init_kwargs
                 )
 
 
@@ -1606,6 +1753,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
         ### HOOK ###
         params = self.hook_add_extra_train_params(params)
         self.params = params
+        # sampling cannot reuse encoded prompts while the text encoder or an embedding is trained. The sample prompts
+        # are encoded after the generate device state turns off requires_grad, so the model cannot tell on its own
+        self.sd.is_training_text_encoder = self.train_config.train_text_encoder or self.embedding is not None
         # self.params = []
 
         # for param in params:
@@ -1629,7 +1779,11 @@ class BaseSDTrainProcess(BaseTrainProcess):
         # set it to do paramiter swapping
         if self.train_config.do_paramiter_swapping:
             # only works for adafactor, but it should have thrown an error prior to this otherwise
-            self.optimizer.enable_paramiter_swapping(self.train_config.paramiter_swapping_factor)
+            self.optimizer.enable_paramiter_swapping(
+                self.train_config.paramiter_swapping_factor,
+                swap_every=self.train_config.paramiter_swapping_every,
+                offload_state=self.train_config.paramiter_swapping_offload_state,
+            )
 
         # check if it exists
         optimizer_state_filename = f'optimizer.pt'
@@ -1679,15 +1833,20 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.before_dataset_load()
         # load datasets if passed in the root process
         if self.datasets is not None:
-            self.data_loader = get_dataloader_from_datasets(self.datasets, self.train_config.batch_size, self.sd)
+            self.data_loader = get_dataloader_from_datasets(
+                self.datasets, self.train_config.batch_size, self.sd, seed=self.training_seed
+            )
         if self.datasets_reg is not None:
-            self.data_loader_reg = get_dataloader_from_datasets(self.datasets_reg, self.train_config.batch_size,
-                                                                self.sd)
+            self.data_loader_reg = get_dataloader_from_datasets(
+                self.datasets_reg, self.train_config.batch_size, self.sd, seed=self.training_seed
+            )
 
         flush()
         ### HOOK ###
         self.hook_before_train_loop()
 
+        self.setup_sample_worker()
+
         if self.has_first_sample_requested and self.step_num <= 1 and not self.train_config.disable_sampling:
             self.print("Generating first sample from first sample config")
             self.sample(0, is_first=True)
@@ -1710,14 +1869,14 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
         if self.data_loader is not None:
             dataloader = self.data_loader
-            dataloader_iterator = iter(dataloader)
+            dataloader_iterator = self.get_dataloader_iterator(dataloader)
         else:
             dataloader = None
             dataloader_iterator = None
 
         if self.data_loader_reg is not None:
             dataloader_reg = self.data_loader_reg
-            dataloader_iterator_reg = iter(dataloader_reg)
+            dataloader_iterator_reg = self.get_dataloader_iterator(dataloader_reg)
         else:
             dataloader_reg = None
             dataloader_iterator_reg = None
@@ -1734,8 +1893,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
         # print(f"Compiling Model")
         # torch.compile(self.sd.unet, dynamic=True)
 
-        # make sure all params require grad
-        self.ensure_params_requires_grad(force=True)
+        # make sure all params require grad. With paramiter swapping the optimizer sets them
+        self.ensure_params_requires_grad()
 
 
         ###################################################################
@@ -1781,7 +1940,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                             with self.timer('reset_batch:reg'):
                                 # hit the end of an epoch, reset
                                 self.progress_bar.pause()
-                                dataloader_iterator_reg = iter(dataloader_reg)
+                                dataloader_iterator_reg = self.get_dataloader_iterator(dataloader_reg)
                                 trigger_dataloader_setup_epoch(dataloader_reg)
 
                             with self.timer('get_batch:reg'):
@@ -1796,7 +1955,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                             with self.timer('reset_batch'):
                                 # hit the end of an epoch, reset
                                 self.progress_bar.pause()
-                                dataloader_iterator = iter(dataloader)
+                                dataloader_iterator = self.get_dataloader_iterator(dataloader)
                                 trigger_dataloader_setup_epoch(dataloader)
                                 self.epoch_num += 1
                                 if self.train_config.gradient_accumulation_steps == -1:
@@ -1874,7 +2033,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         if self.train_config.free_u:
                             self.sd.pipeline.disable_freeu()
                         self.sample(self.step_num)
-                        if self.train_config.unload_text_encoder:
+                        if self.train_config.unload_text_encoder or self.train_config.cache_text_embeddings:
                             # make sure the text encoder is unloaded
                             self.sd.text_encoder_to('cpu')
                         flush()
@@ -1926,6 +2085,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         self.timer.reset()
                         self.progress_bar.unpause()
                 
+                # samples rendered by the worker since the last step
+                self.log_sample_results()
+
                 # commit log
                 self.logger.commit(step=self.step_num)
 
@@ -1946,13 +2108,24 @@ class BaseSDTrainProcess(BaseTrainProcess):
         ###################################################################
 
         self.progress_bar.close()
+        # stop loading batches we will not use
+        for iterator in [dataloader_iterator, dataloader_iterator_reg]:
+            if isinstance(iterator, BatchPrefetcher):
+                iterator.close()
         if self.train_config.free_u:
             self.sd.pipeline.disable_freeu()
         if not self.train_config.disable_sampling:
             self.sample(self.step_num)
+            # wait for the worker to finish everything
+            self.log_sample_results(block=True)
             self.logger.commit(step=self.step_num)
+        if self.sample_worker is not None:
+            self.sample_worker.close()
         print("")
         self.save()
+        if self.checkpoint_writer is not None:
+            # wait for the checkpoints to be written
+            self.checkpoint_writer.close()
         self.logger.finish()
 
         if self.save_config.push_to_hub:
@@ -1,5 +1,5 @@
 from collections import OrderedDict
-from toolkit.lycoris_utils import extract_diff
+from toolkit.lycoris_utils import extract_diff, extract_diff_streaming
 from .BaseExtractProcess import BaseExtractProcess
 
 mode_dict = {
@@ -33,6 +33,10 @@ class ExtractLoconProcess(BaseExtractProcess):
         self.use_sparse_bias = self.get_conf('use_sparse_bias', False)
         self.sparsity = self.get_conf('sparsity', 0.98)
         self.disable_cp = self.get_conf('disable_cp', False)
+        # randomized svd for the top ranks in fixed mode, full svd otherwise
+        self.use_lowrank_svd = self.get_conf('use_lowrank_svd', True)
+        # threads extracting groups of same shape layers
+        self.num_workers = self.get_conf('num_workers', 4)
 
         # set modes
         if self.mode not in list(mode_dict.keys()):
@@ -44,19 +48,38 @@ class ExtractLoconProcess(BaseExtractProcess):
         super().run()
         print(f"Running process: {self.mode}, lin: {self.linear_param}, conv: {self.conv_param}")
 
-        state_dict, extract_diff_meta = extract_diff(
-            self.job.model_base,
-            self.job.model_extract,
-            self.mode,
-            self.linear_param,
-            self.conv_param,
-            self.job.device,
-            self.use_sparse_bias,
-            self.sparsity,
-            not self.disable_cp,
-            extract_unet=self.extract_unet,
-            extract_text_encoder=self.extract_text_encoder
-        )
+        if self.job.stream:
+            state_dict, extract_diff_meta = extract_diff_streaming(
+                self.job.model_base,
+                self.job.model_extract,
+                self.mode,
+                self.linear_param,
+                self.conv_param,
+                self.job.device,
+                self.use_sparse_bias,
+                self.sparsity,
+                small_conv=not self.disable_cp,
+                linear_only=False,
+                prefix=self.job.lora_prefix,
+                use_lowrank_svd=self.use_lowrank_svd,
+                num_workers=self.num_workers
+            )
+        else:
+            state_dict, extract_diff_meta = extract_diff(
+                self.job.model_base,
+                self.job.model_extract,
+                self.mode,
+                self.linear_param,
+                self.conv_param,
+                self.job.device,
+                self.use_sparse_bias,
+                self.sparsity,
+                not self.disable_cp,
+                extract_unet=self.extract_unet,
+                extract_text_encoder=self.extract_text_encoder,
+                use_lowrank_svd=self.use_lowrank_svd,
+                num_workers=self.num_workers
+            )
 
         self.add_meta(extract_diff_meta)
         self.save(state_dict)
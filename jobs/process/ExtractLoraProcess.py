@@ -1,5 +1,5 @@
 from collections import OrderedDict
-from toolkit.lycoris_utils import extract_diff
+from toolkit.lycoris_utils import extract_diff, extract_diff_streaming
 from .BaseExtractProcess import BaseExtractProcess
 
 
@@ -44,25 +44,48 @@ class ExtractLoraProcess(BaseExtractProcess):
         self.conv_param = self.get_conf('conv', mode_dict[self.mode]['conv'], as_type=mode_dict[self.mode]['type'])
         self.use_sparse_bias = self.get_conf('use_sparse_bias', False)
         self.sparsity = self.get_conf('sparsity', 0.98)
+        # randomized svd for the top ranks in fixed mode, full svd otherwise
+        self.use_lowrank_svd = self.get_conf('use_lowrank_svd', True)
+        # threads extracting groups of same shape layers
+        self.num_workers = self.get_conf('num_workers', 4)
 
     def run(self):
         super().run()
         print(f"Running process: {self.mode}, dim: {self.dim}")
 
-        state_dict, extract_diff_meta = extract_diff(
-            self.job.model_base,
-            self.job.model_extract,
-            self.mode,
-            self.linear_param,
-            self.conv_param,
-            self.job.device,
-            self.use_sparse_bias,
-            self.sparsity,
-            small_conv=False,
-            linear_only=self.conv_param > 0.0000000001,
-            extract_unet=self.extract_unet,
-            extract_text_encoder=self.extract_text_encoder
-        )
+        if self.job.stream:
+            state_dict, extract_diff_meta = extract_diff_streaming(
+                self.job.model_base,
+                self.job.model_extract,
+                self.mode,
+                self.linear_param,
+                self.conv_param,
+                self.job.device,
+                self.use_sparse_bias,
+                self.sparsity,
+                small_conv=False,
+                linear_only=self.conv_param > 0.0000000001,
+                prefix=self.job.lora_prefix,
+                use_lowrank_svd=self.use_lowrank_svd,
+                num_workers=self.num_workers
+            )
+        else:
+            state_dict, extract_diff_meta = extract_diff(
+                self.job.model_base,
+                self.job.model_extract,
+                self.mode,
+                self.linear_param,
+                self.conv_param,
+                self.job.device,
+                self.use_sparse_bias,
+                self.sparsity,
+                small_conv=False,
+                linear_only=self.conv_param > 0.0000000001,
+                extract_unet=self.extract_unet,
+                extract_text_encoder=self.extract_text_encoder,
+                use_lowrank_svd=self.use_lowrank_svd,
+                num_workers=self.num_workers
+            )
 
         self.add_meta(extract_diff_meta)
         self.save(state_dict)
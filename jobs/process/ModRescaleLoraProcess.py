@@ -4,11 +4,10 @@ from collections import OrderedDict
 from typing import ForwardRef
 
 import torch
-from safetensors.torch import save_file, load_file
 
 from jobs.process.BaseProcess import BaseProcess
-from toolkit.metadata import get_meta_for_safetensors, load_metadata_from_safetensors, add_model_hash_to_meta, \
-    add_base_model_info_to_meta
+from toolkit.metadata import get_meta_for_safetensors, load_metadata_from_safetensors, add_base_model_info_to_meta
+from toolkit.safetensors_stream import LazySafetensors, SafetensorsStreamWriter
 from toolkit.train_tools import get_torch_dtype
 
 
@@ -41,7 +40,8 @@ class ModRescaleLoraProcess(BaseProcess):
 
     def run(self):
         super().run()
-        source_state_dict = load_file(self.input_path)
+        # read and write one tensor at a time
+        source_state_dict = LazySafetensors(self.input_path)
         source_meta = load_metadata_from_safetensors(self.input_path)
 
         if self.replace_meta:
@@ -59,11 +59,21 @@ class ModRescaleLoraProcess(BaseProcess):
         # save
         os.makedirs(os.path.dirname(self.output_path), exist_ok=True)
 
-        new_state_dict = OrderedDict()
+        writer = SafetensorsStreamWriter(
+            self.output_path,
+            OrderedDict([(key, (self.save_dtype, source_state_dict.get_shape(key))) for key in source_state_dict.keys()]),
+            save_meta
+        )
 
-        for key in list(source_state_dict.keys()):
-            v = source_state_dict[key]
-            v = v.detach().clone().to("cpu").to(get_torch_dtype('fp32'))
+        total_module_scale = torch.tensor(self.current_weight / self.target_weight) \
+            .to("cpu", dtype=get_torch_dtype('fp32'))
+        num_modules_layers = 2  # up and down
+        up_down_scale = torch.pow(total_module_scale, 1.0 / num_modules_layers) \
+            .to("cpu", dtype=get_torch_dtype('fp32'))
+
+        for key in writer.keys():
+            # freshly loaded from the file, no need to clone it
+            v = source_state_dict[key].to(get_torch_dtype('fp32'))
 
             # all loras have an alpha, up weight and down weight
             #  - "lora_te_text_model_encoder_layers_0_mlp_fc1.alpha",
@@ -76,25 +86,18 @@ class ModRescaleLoraProcess(BaseProcess):
             # when adjusting alpha, it is used to calculate the multiplier in a lora module
             #  - scale = alpha / lora_dim
             #  - output = layer_out + lora_up_out * multiplier * scale
-            total_module_scale = torch.tensor(self.current_weight / self.target_weight) \
-                .to("cpu", dtype=get_torch_dtype('fp32'))
-            num_modules_layers = 2  # up and down
-            up_down_scale = torch.pow(total_module_scale, 1.0 / num_modules_layers) \
-                .to("cpu", dtype=get_torch_dtype('fp32'))
             # only update alpha
             if self.scale_target == 'alpha' and key.endswith('.alpha'):
                 v = v * total_module_scale
             if self.scale_target == 'up_down' and key.endswith('.lora_up.weight') or key.endswith('.lora_down.weight'):
                 # would it be better to adjust the up weights for fp16 precision? Doing both should reduce chance of NaN
                 v = v * up_down_scale
-            v = v.detach().clone().to("cpu").to(self.save_dtype)
-            new_state_dict[key] = v
+            writer.write(key, v.to(self.save_dtype))
 
-        save_meta = add_model_hash_to_meta(new_state_dict, save_meta)
-        save_file(new_state_dict, self.output_path, save_meta)
+        writer.close()
 
         # cleanup incase there are other jobs
-        del new_state_dict
+        source_state_dict.close()
         del source_state_dict
         del source_meta
 
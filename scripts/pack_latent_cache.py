@@ -0,0 +1,60 @@
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from safetensors.torch import load_file
+from tqdm import tqdm
+
+from toolkit.latent_store import ShardedLatentStore
+
+# packs existing _latent_cache folders with one safetensors file per image into a sharded latent store
+# use sharded_latent_cache: true in the dataset config to train from the packed store
+
+parser = argparse.ArgumentParser(description='Pack _latent_cache folders into sharded latent stores.')
+parser.add_argument("dataset_folder", type=str, help="Path to the dataset folder. Searched recursively")
+parser.add_argument("--shard_size_mb", type=int, default=1024, help="Max size of each shard in MB")
+parser.add_argument("--delete", action='store_true', help="Delete the safetensors files once they are packed")
+
+args = parser.parse_args()
+
+latent_dirs = []
+for root, dirs, _ in os.walk(args.dataset_folder):
+    for dir_name in dirs:
+        if dir_name == '_latent_cache':
+            latent_dirs.append(os.path.join(root, dir_name))
+print(f"Found {len(latent_dirs)} latent cache folders")
+
+num_packed = 0
+num_skipped = 0
+
+for latent_dir in latent_dirs:
+    latent_files = [f for f in os.listdir(latent_dir) if f.endswith('.safetensors')]
+    store = ShardedLatentStore(latent_dir, max_shard_size_mb=args.shard_size_mb)
+    packed_files = []
+    for latent_file in tqdm(latent_files, desc=f"Packing {latent_dir}", unit="latent"):
+        key = os.path.splitext(latent_file)[0]
+        latent_path = os.path.join(latent_dir, latent_file)
+        if key in store:
+            num_skipped += 1
+            packed_files.append(latent_path)
+            continue
+        try:
+            state_dict = load_file(latent_path, device='cpu')
+        except Exception as e:
+            print(f"Error loading {latent_path}: {e}")
+            continue
+        if 'latent' not in state_dict:
+            print(f"No latent found in {latent_path}, skipping")
+            continue
+        store.put(key, state_dict['latent'])
+        packed_files.append(latent_path)
+        num_packed += 1
+    # save the index before deleting anything
+    store.save_index()
+    if args.delete:
+        for latent_path in packed_files:
+            os.remove(latent_path)
+
+print(f"Packed {num_packed} latents, {num_skipped} were already packed")
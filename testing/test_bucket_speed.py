@@ -0,0 +1,56 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from tqdm import tqdm
+
+from toolkit.buckets import get_bucket_for_image_size, get_buckets_for_image_sizes
+
+# compares bucketing synthetic image sizes one at a time with the vectorized path and checks they match
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_sizes', type=int, default=1_000_000)
+parser.add_argument('--resolution', type=int, default=1024)
+parser.add_argument('--divisibility', type=int, default=64)
+parser.add_argument('--seed', type=int, default=42)
+args = parser.parse_args()
+
+rng = np.random.default_rng(args.seed)
+widths = rng.integers(256, 4096, size=args.num_sizes)
+heights = rng.integers(256, 4096, size=args.num_sizes)
+# some exact bucket sizes and common camera sizes
+widths[:1000] = 1024
+heights[:1000] = 1024
+widths[1000:2000] = 6000
+heights[1000:2000] = 4000
+
+start = time.time()
+loop_widths = np.zeros(args.num_sizes, dtype=np.int64)
+loop_heights = np.zeros(args.num_sizes, dtype=np.int64)
+for idx in tqdm(range(args.num_sizes), desc="Loop"):
+    bucket = get_bucket_for_image_size(
+        int(widths[idx]), int(heights[idx]),
+        resolution=args.resolution,
+        divisibility=args.divisibility
+    )
+    loop_widths[idx] = bucket["width"]
+    loop_heights[idx] = bucket["height"]
+loop_time = time.time() - start
+
+start = time.time()
+vec_widths, vec_heights = get_buckets_for_image_sizes(
+    widths, heights,
+    resolution=args.resolution,
+    divisibility=args.divisibility
+)
+vec_time = time.time() - start
+
+num_mismatch = int(np.sum((loop_widths != vec_widths) | (loop_heights != vec_heights)))
+print(f"Loop: {loop_time:.2f}s")
+print(f"Vectorized: {vec_time:.2f}s ({loop_time / max(vec_time, 1e-6):.1f}x)")
+print(f"Mismatches: {num_mismatch}")
+assert num_mismatch == 0
@@ -0,0 +1,66 @@
+import argparse
+import copy
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.config_modules import DatasetConfig
+from toolkit.data_loader import AiToolkitDataset
+
+# measures dataset __getitem__ throughput with latents cached in memory. Latents are faked with random
+# tensors so no model is needed. Compares the old deepcopy per sample with the shallow sample copy
+
+parser = argparse.ArgumentParser()
+parser.add_argument('dataset_folder', type=str)
+parser.add_argument('--resolution', type=int, default=1024)
+parser.add_argument('--num_samples', type=int, default=5000)
+args = parser.parse_args()
+
+dataset_config = DatasetConfig(
+    dataset_path=args.dataset_folder,
+    resolution=args.resolution,
+    buckets=True,
+)
+dataset = AiToolkitDataset(dataset_config, batch_size=1)
+
+# pretend the latents were cached to memory
+for file_item in dataset.file_list:
+    file_item.is_latent_cached = True
+    file_item.is_caching_to_memory = True
+for idx in range(len(dataset.file_index)):
+    file_item = dataset.get_file_item(idx)
+    latent_path = file_item.get_latent_path(recalculate=True)
+    dataset.file_index.latent_paths[idx] = latent_path
+    dataset.latent_cache[latent_path] = torch.randn(
+        4, file_item.crop_height // 8, file_item.crop_width // 8, dtype=torch.float16
+    )
+
+
+def get_item_deepcopy(index):
+    # what __getitem__ used to do
+    file_item = copy.deepcopy(dataset.get_file_item(index))
+    file_item.load_and_process_image(dataset.transform)
+    file_item.load_caption(dataset.caption_dict)
+    return file_item
+
+
+def get_item_shallow(index):
+    return dataset._get_single_item(index)
+
+
+def run(name, get_item):
+    num_items = len(dataset.file_index)
+    start = time.time()
+    for i in range(args.num_samples):
+        file_item = get_item(i % num_items)
+        file_item.cleanup()
+    elapsed = time.time() - start
+    print(f"{name}: {args.num_samples / elapsed:.1f} samples/s")
+
+
+run("deepcopy", get_item_deepcopy)
+run("shallow copy", get_item_shallow)
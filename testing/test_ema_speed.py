@@ -0,0 +1,115 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.ema import ExponentialMovingAverage
+
+# benchmarks the grouped ema update against the per tensor one and checks they give the same averages
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_params', type=int, default=400)
+parser.add_argument('--dim', type=int, default=256)
+parser.add_argument('--steps', type=int, default=20)
+parser.add_argument('--device', type=str, default='cpu')
+parser.add_argument('--seed', type=int, default=42)
+args = parser.parse_args()
+
+torch.manual_seed(args.seed)
+device = torch.device(args.device)
+
+
+def make_params(dtype):
+    params = []
+    for idx in range(args.num_params):
+        # mix of weights and biases like a real model
+        shape = (args.dim, args.dim) if idx % 2 == 0 else (args.dim,)
+        params.append(torch.nn.Parameter(torch.randn(shape, device=device, dtype=dtype)))
+    return params
+
+
+def run_ema(params, use_foreach, update_every=1, **kwargs):
+    params = [torch.nn.Parameter(p.detach().clone()) for p in params]
+    ema = ExponentialMovingAverage(params, decay=0.9, use_foreach=use_foreach, update_every=update_every, **kwargs)
+    generator = torch.Generator(device=device).manual_seed(args.seed)
+    elapsed = 0.0
+    for _ in range(args.steps):
+        with torch.no_grad():
+            for p in params:
+                p.add_(torch.randn(p.shape, device=device, generator=generator).to(p.dtype) * 0.01)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        ema.update()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed += time.time() - start
+    return ema, params, elapsed / args.steps
+
+
+def max_diff(a_list, b_list):
+    return max([(a.float() - b.float()).abs().max().item() for a, b in zip(a_list, b_list)])
+
+
+for dtype, atol in [(torch.float32, 1e-5), (torch.bfloat16, 1e-1)]:
+    params = make_params(dtype)
+    loop_ema, _, loop_time = run_ema(params, use_foreach=False)
+    foreach_ema, _, foreach_time = run_ema(params, use_foreach=True)
+    diff = max_diff(loop_ema.shadow_params, foreach_ema.shadow_params)
+    print(f"{dtype} loop {loop_time * 1000:.2f}ms, foreach {foreach_time * 1000:.2f}ms "
+          f"({loop_time / max(foreach_time, 1e-9):.2f}x), max diff {diff:.2e}")
+    assert diff <= atol
+
+    # small chunks and feedback go through the flat path
+    loop_ema, loop_params, _ = run_ema(params, use_foreach=False, use_feedback=True, param_multiplier=0.999)
+    foreach_ema, foreach_params, _ = run_ema(
+        params, use_foreach=True, use_feedback=True, param_multiplier=0.999, max_chunk_numel=args.dim * args.dim * 3
+    )
+    diff = max(max_diff(loop_ema.shadow_params, foreach_ema.shadow_params), max_diff(loop_params, foreach_params))
+    print(f"{dtype} feedback and multiplier match, max diff {diff:.2e}")
+    assert diff <= atol
+
+    # a state dict from the grouped ema loads into the per tensor one
+    state_dict = foreach_ema.state_dict()
+    loop_ema.load_state_dict(state_dict)
+    print(f"{dtype} state dict round trip")
+    assert max_diff(loop_ema.shadow_params, foreach_ema.shadow_params) == 0
+
+# updating every k steps with the corrected decay should track updating every step
+params = make_params(torch.float32)
+every_ema, _, _ = run_ema(params, use_foreach=True)
+sparse_ema, _, _ = run_ema(params, use_foreach=True, update_every=4)
+diff = max_diff(every_ema.shadow_params, sparse_ema.shadow_params)
+print(f"update_every 4 tracks every step, max diff {diff:.2e}")
+assert diff <= 0.05
+
+# offloaded shadows are averaged on cpu threads and should match the on device ema
+for shadow_dtype, atol in [(None, 1e-5), (torch.bfloat16, 1e-1)]:
+    params = make_params(torch.float32)
+    device_ema, _, device_time = run_ema(params, use_foreach=True)
+    offload_ema, offload_params, offload_time = run_ema(
+        params, use_foreach=True, offload_to_cpu=True, shadow_dtype=shadow_dtype
+    )
+    # wait() is part of the cost when the next update comes around
+    start = time.time()
+    offload_ema.wait()
+    offload_time += (time.time() - start) / args.steps
+    diff = max_diff(device_ema.shadow_params, offload_ema.shadow_params)
+    print(f"offload {shadow_dtype} device {device_time * 1000:.2f}ms, offload {offload_time * 1000:.2f}ms, "
+          f"max diff {diff:.2e}")
+    assert diff <= atol and offload_ema.shadow_params[0].device.type == 'cpu'
+
+    # sampling swaps the averaged weights in and puts the live ones back
+    live_weights = [p.detach().clone() for p in offload_params]
+    offload_ema.eval()
+    swapped = max_diff(offload_params, offload_ema.shadow_params)
+    offload_ema.train()
+    restored = max_diff(offload_params, live_weights)
+    print(f"offload {shadow_dtype} store, copy_to and restore")
+    assert swapped == 0 and restored == 0
+
+print("All checks passed")
@@ -0,0 +1,81 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.lycoris_utils import ExtractLayer, extract_layers, extract_linear, extract_conv
+
+# compares the grouped extraction (full and randomized svd) with extracting one layer at a time with full svd
+# on synthetic fine tune diffs. Checks the reconstruction error of the randomized svd is close to the full one
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_layers', type=int, default=24)
+parser.add_argument('--dim', type=int, default=640)
+parser.add_argument('--rank', type=int, default=32)
+parser.add_argument('--num_workers', type=int, default=4)
+parser.add_argument('--seed', type=int, default=42)
+args = parser.parse_args()
+
+torch.manual_seed(args.seed)
+
+
+def make_weights(shape):
+    base = torch.randn(shape) * 0.02
+    # a fine tune is mostly low rank with some noise
+    out_ch, in_ch = shape[0], int(torch.tensor(shape[1:]).prod())
+    low_rank = (torch.randn(out_ch, args.rank * 2) @ torch.randn(args.rank * 2, in_ch)) * 1e-3
+    delta = low_rank * torch.linspace(1.0, 0.1, in_ch) + torch.randn(out_ch, in_ch) * 1e-5
+    return base + delta.reshape(shape), base
+
+
+layers = []
+shapes = [(args.dim, args.dim), (args.dim * 4, args.dim), (args.dim, args.dim // 2, 3, 3)]
+for idx in range(args.num_layers):
+    shape = shapes[idx % len(shapes)]
+    weight, base_weight = make_weights(shape)
+    layers.append(ExtractLayer(f"lora_{idx}", weight, base_weight, args.rank))
+
+
+def reconstruction_error(loras):
+    errors = []
+    for layer in layers:
+        diff = (layer.weight - layer.base_weight).reshape(layer.weight.shape[0], -1)
+        down = loras[f'{layer.lora_name}.lora_down.weight'].float()
+        up = loras[f'{layer.lora_name}.lora_up.weight'].float()
+        rebuilt = up.reshape(up.shape[0], -1) @ down.reshape(down.shape[0], -1)
+        errors.append(((diff - rebuilt).norm() / diff.norm()).item())
+    return sum(errors) / len(errors)
+
+
+start = time.time()
+serial_loras = {}
+for layer in layers:
+    if layer.is_conv:
+        (extract_a, extract_b, _), _ = extract_conv(layer.weight - layer.base_weight, 'fixed', args.rank)
+    else:
+        (extract_a, extract_b, _), _ = extract_linear(layer.weight - layer.base_weight, 'fixed', args.rank)
+    serial_loras[f'{layer.lora_name}.lora_down.weight'] = extract_a.half()
+    serial_loras[f'{layer.lora_name}.lora_up.weight'] = extract_b.half()
+serial_time = time.time() - start
+
+start = time.time()
+full_loras = extract_layers(layers, 'fixed', small_conv=False, use_lowrank_svd=False, num_workers=args.num_workers)
+full_time = time.time() - start
+
+start = time.time()
+lowrank_loras = extract_layers(layers, 'fixed', small_conv=False, use_lowrank_svd=True, num_workers=args.num_workers)
+lowrank_time = time.time() - start
+
+serial_error = reconstruction_error(serial_loras)
+full_error = reconstruction_error(full_loras)
+lowrank_error = reconstruction_error(lowrank_loras)
+print(f"Serial full svd: {serial_time:.2f}s, error {serial_error:.5f}")
+print(f"Grouped full svd: {full_time:.2f}s ({serial_time / max(full_time, 1e-6):.1f}x), error {full_error:.5f}")
+print(f"Grouped lowrank svd: {lowrank_time:.2f}s ({serial_time / max(lowrank_time, 1e-6):.1f}x), "
+      f"error {lowrank_error:.5f}")
+
+assert abs(full_error - serial_error) <= 1e-3 and lowrank_error <= full_error * 1.05 + 1e-4
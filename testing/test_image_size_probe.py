@@ -0,0 +1,52 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+from PIL.ImageOps import exif_transpose
+from tqdm import tqdm
+
+from toolkit.image_utils import get_exif_transposed_image_size, UnknownImageFormat
+
+# checks the header only size probe against opening every image with PIL and compares the speed
+
+parser = argparse.ArgumentParser()
+parser.add_argument('dataset_folder', type=str)
+args = parser.parse_args()
+
+file_list = [
+    os.path.join(root, file) for root, _, files in os.walk(args.dataset_folder) for file in files
+    if file.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))
+]
+print(f"Found {len(file_list)} images")
+
+start = time.time()
+probed_sizes = {}
+num_unknown = 0
+for file in tqdm(file_list, desc="Header probe"):
+    try:
+        probed_sizes[file] = get_exif_transposed_image_size(file)
+    except UnknownImageFormat:
+        num_unknown += 1
+probe_time = time.time() - start
+
+start = time.time()
+pil_sizes = {}
+for file in tqdm(file_list, desc="PIL exif_transpose"):
+    pil_sizes[file] = exif_transpose(Image.open(file)).size
+pil_time = time.time() - start
+
+num_mismatch = 0
+for file, size in probed_sizes.items():
+    if tuple(size) != tuple(pil_sizes[file]):
+        num_mismatch += 1
+        print(f"Mismatch: {file} probe: {size} PIL: {pil_sizes[file]}")
+
+print(f"Header probe: {probe_time:.2f}s ({len(file_list) / max(probe_time, 1e-6):.1f} img/s)")
+print(f"PIL: {pil_time:.2f}s ({len(file_list) / max(pil_time, 1e-6):.1f} img/s)")
+print(f"Unknown format (PIL fallback): {num_unknown}")
+print(f"Mismatches: {num_mismatch}")
+assert num_mismatch == 0
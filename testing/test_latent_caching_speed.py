@@ -0,0 +1,71 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.basic import flush
+from toolkit.config_modules import ModelConfig, DatasetConfig
+from toolkit.data_loader import AiToolkitDataset
+from toolkit.stable_diffusion_model import StableDiffusion
+
+# compares latent caching speed for the old one image at a time path and the batched path
+# latents are only cached to memory so both runs have to encode every image
+
+parser = argparse.ArgumentParser()
+parser.add_argument('dataset_folder', type=str)
+parser.add_argument('--model', type=str, default='stabilityai/stable-diffusion-xl-base-1.0')
+parser.add_argument('--is_xl', action='store_true')
+parser.add_argument('--is_flux', action='store_true')
+parser.add_argument('--resolution', type=int, default=1024)
+parser.add_argument('--batch_size', type=int, default=8)
+parser.add_argument('--num_workers', type=int, default=4)
+args = parser.parse_args()
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+sd = StableDiffusion(
+    model_config=ModelConfig(
+        name_or_path=args.model,
+        is_xl=args.is_xl,
+        is_flux=args.is_flux,
+    ),
+    device=device,
+    dtype='bf16' if device == 'cuda' else 'fp32',
+)
+sd.load_model()
+
+
+def run(cache_batch_size, cache_num_workers):
+    dataset_config = DatasetConfig(
+        dataset_path=args.dataset_folder,
+        resolution=args.resolution,
+        default_caption='default',
+        buckets=True,
+        cache_latents=True,
+        cache_batch_size=cache_batch_size,
+        cache_num_workers=cache_num_workers,
+    )
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    dataset = AiToolkitDataset(dataset_config, batch_size=1, sd=sd)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = time.time() - start
+    num_images = len(dataset.file_list)
+    del dataset
+    flush()
+    return num_images / elapsed
+
+
+with torch.no_grad():
+    before = run(cache_batch_size=1, cache_num_workers=0)
+    after = run(cache_batch_size=args.batch_size, cache_num_workers=args.num_workers)
+
+print(f"batch size 1, no workers: {before:.2f} images/sec")
+print(f"batch size {args.batch_size}, {args.num_workers} workers: {after:.2f} images/sec")
+print(f"speedup: {after / before:.2f}x")
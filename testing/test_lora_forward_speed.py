@@ -0,0 +1,79 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.lora_special import LoRAModule
+
+# benchmarks the lora fast forward against the full forward path on cpu and checks the outputs match
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_modules', type=int, default=32)
+parser.add_argument('--dim', type=int, default=1024)
+parser.add_argument('--tokens', type=int, default=512)
+parser.add_argument('--rank', type=int, default=16)
+parser.add_argument('--iterations', type=int, default=10)
+parser.add_argument('--seed', type=int, default=42)
+args = parser.parse_args()
+
+torch.manual_seed(args.seed)
+
+
+class FakeNetwork:
+    # what the modules read from the network in forward
+    def __init__(self, multiplier: float):
+        self.is_lorm = False
+        self.is_active = True
+        self.is_merged_in = False
+        self._multiplier = multiplier
+        self.torch_multiplier = torch.tensor((multiplier,))
+        self.single_multiplier = multiplier
+
+
+def build_modules(network, base_dtype):
+    modules = []
+    for idx in range(args.num_modules):
+        linear = torch.nn.Linear(args.dim, args.dim).to(base_dtype)
+        lora = LoRAModule(f"lora_{idx}", linear, lora_dim=args.rank, alpha=args.rank // 2, network=network)
+        # lora_up starts at zero, give it weights so the outputs mean something
+        torch.nn.init.normal_(lora.lora_up.weight, std=0.02)
+        lora.apply_to()
+        lora.eval()
+        modules.append(lora)
+    return modules
+
+
+@torch.no_grad()
+def run(modules, x):
+    outputs = []
+    for module in modules:
+        outputs.append(module.org_module[0].forward(x))
+    return outputs
+
+
+def time_run(modules, x):
+    run(modules, x)
+    start = time.time()
+    for _ in range(args.iterations):
+        outputs = run(modules, x)
+    return (time.time() - start) / args.iterations, outputs
+
+
+for base_dtype, atol in [(torch.float32, 1e-4), (torch.bfloat16, 2e-2)]:
+    network = FakeNetwork(0.75)
+    modules = build_modules(network, base_dtype)
+    x = torch.randn(1, args.tokens, args.dim, dtype=base_dtype)
+
+    network.single_multiplier = None
+    full_time, full_outputs = time_run(modules, x)
+    network.single_multiplier = network._multiplier
+    fast_time, fast_outputs = time_run(modules, x)
+
+    max_diff = max([(a.float() - b.float()).abs().max().item() for a, b in zip(full_outputs, fast_outputs)])
+    print(f"{base_dtype}: full {full_time * 1000:.1f}ms, fast {fast_time * 1000:.1f}ms "
+          f"({full_time / max(fast_time, 1e-9):.2f}x), max diff {max_diff:.2e}")
+    assert max_diff <= atol
@@ -0,0 +1,87 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.lora_special import LoRAModule
+from toolkit.network_mixins import ToolkitNetworkMixin
+
+# checks merge_in / merge_out cycles leave the base weights bit identical and that the merged weights match
+# the lora forward
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--cycles', type=int, default=100)
+parser.add_argument('--num_modules', type=int, default=8)
+parser.add_argument('--dim', type=int, default=256)
+parser.add_argument('--rank', type=int, default=8)
+parser.add_argument('--device', type=str, default='cpu')
+parser.add_argument('--seed', type=int, default=42)
+args = parser.parse_args()
+
+torch.manual_seed(args.seed)
+device = torch.device(args.device)
+
+
+class TestNetwork(ToolkitNetworkMixin, torch.nn.Module):
+    def __init__(self):
+        ToolkitNetworkMixin.__init__(self)
+        torch.nn.Module.__init__(self)
+        self.network_type = 'lora'
+        self.torch_multiplier = None
+        self.unet_loras = []
+
+
+def build_network(dtype):
+    network = TestNetwork()
+    org_modules = []
+    for idx in range(args.num_modules):
+        org_modules.append(torch.nn.Linear(args.dim, args.dim))
+    # a different linear shape and both conv kinds
+    org_modules.append(torch.nn.Linear(args.dim, args.dim * 2))
+    org_modules.append(torch.nn.Conv2d(16, 32, 1))
+    org_modules.append(torch.nn.Conv2d(16, 32, 3, padding=1))
+    for idx, org_module in enumerate(org_modules):
+        org_module.to(device, dtype=dtype)
+        lora = LoRAModule(f"lora_{idx}", org_module, lora_dim=args.rank, alpha=args.rank // 2, network=network)
+        # lora_up starts at zero, give it weights so merging changes something
+        torch.nn.init.normal_(lora.lora_up.weight, std=0.05)
+        lora.to(device)
+        lora.apply_to()
+        network.unet_loras.append(lora)
+    network._update_torch_multiplier()
+    return network, org_modules
+
+
+for dtype in [torch.float32, torch.float16, torch.bfloat16]:
+    network, org_modules = build_network(dtype)
+    original_weights = [m.weight.detach().clone() for m in org_modules]
+
+    # merged weights should give the same output as running the lora
+    x_linear = torch.randn(2, args.dim, device=device, dtype=dtype)
+    x_conv = torch.randn(2, 16, 8, 8, device=device, dtype=dtype)
+    with torch.no_grad():
+        network.is_active = True
+        lora_outputs = [m.forward(x_conv if isinstance(m, torch.nn.Conv2d) else x_linear) for m in org_modules]
+        network.merge_in(merge_weight=1.0)
+        merged_outputs = [m.forward(x_conv if isinstance(m, torch.nn.Conv2d) else x_linear) for m in org_modules]
+        network.merge_out(1.0)
+    atol = 1e-4 if dtype == torch.float32 else 5e-2
+    max_diff = max([(a.float() - b.float()).abs().max().item() for a, b in zip(lora_outputs, merged_outputs)])
+    print(f"{dtype} merged output matches lora (max diff {max_diff:.2e})")
+    assert max_diff <= atol
+
+    start = time.time()
+    for _ in range(args.cycles):
+        network.merge_in(merge_weight=0.8)
+        network.merge_out(0.8)
+    elapsed = time.time() - start
+    print(f"{dtype} {args.cycles} merge cycles bit identical ({elapsed / args.cycles * 1000:.2f}ms per cycle)")
+    assert all([
+        torch.equal(m.weight, w) for m, w in zip(org_modules, original_weights)
+    ])
+
+print("All checks passed")
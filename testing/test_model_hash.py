@@ -0,0 +1,80 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from io import BytesIO
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import safetensors.torch
+import torch
+from safetensors import safe_open
+
+from toolkit.metadata import get_model_hashes, get_safetensors_header_bytes, get_safetensors_layout, \
+    tensor_to_bytes, save_file_with_model_hash, get_hash_metadata
+from toolkit.train_tools import addnet_hash_safetensors, addnet_hash_legacy
+
+# checks the streaming model hashes match hashing the bytes from safetensors.torch.save, and that
+# save_file_with_model_hash writes a file safetensors loads back the same.
+# safetensors writes metadata in hash map order, so the byte for byte header check only uses one metadata key
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--seed', type=int, default=42)
+args = parser.parse_args()
+
+torch.manual_seed(args.seed)
+
+
+def get_state_dict(num_bytes_scale=1):
+    state_dict = OrderedDict()
+    state_dict['b.weight'] = torch.randn(512, 256 * num_bytes_scale)
+    state_dict['a.weight'] = torch.randn(300, 700, dtype=torch.float16)
+    state_dict['a.bf16'] = torch.randn(33, 17, dtype=torch.bfloat16)
+    state_dict['c.alpha'] = torch.tensor(4.0)
+    state_dict['d.steps'] = torch.arange(7, dtype=torch.int64)
+    state_dict['e.mask'] = torch.rand(13) > 0.5
+    state_dict['f.bytes'] = torch.randint(0, 255, (1000,), dtype=torch.uint8)
+    state_dict['g.empty'] = torch.zeros(0, 4)
+    return state_dict
+
+
+def reference_hashes(state_dict, metadata):
+    # what add_model_hash_to_meta used to do
+    b = BytesIO(safetensors.torch.save(state_dict, metadata))
+    return addnet_hash_safetensors(b), addnet_hash_legacy(b)
+
+
+for scale in [1, 8]:
+    state_dict = get_state_dict(scale)
+    for metadata in [None, {}, {'ss_output_name': 'test "name"\n'}]:
+        name = f"scale {scale}, metadata {metadata}"
+        tensor_header, tensors = get_safetensors_layout(state_dict)
+        file_bytes = get_safetensors_header_bytes(tensor_header, metadata) + \
+                     b''.join([bytes(tensor_to_bytes(tensor)) for tensor in tensors])
+        print(f"{name} bytes")
+        assert file_bytes == safetensors.torch.save(state_dict, metadata)
+        print(f"{name} hashes")
+        assert get_model_hashes(state_dict, metadata) == reference_hashes(state_dict, metadata)
+
+    # more than one key, safetensors orders them itself so only check the hashes with its header
+    metadata = {'ss_output_name': 'test', 'ss_base_model_version': 'sdxl_1.0', 'other': 'x'}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, 'test.safetensors')
+        meta = OrderedDict(metadata)
+        start = time.time()
+        save_file_with_model_hash(state_dict, file_path, meta)
+        print(f"save_file_with_model_hash: {time.time() - start:.3f}s")
+        hash_metadata = get_hash_metadata(meta)
+        print(f"scale {scale} saved hashes")
+        assert (meta['sshs_model_hash'], meta['sshs_legacy_hash']) == get_model_hashes(state_dict, hash_metadata)
+        with safe_open(file_path, framework='pt') as f:
+            print(f"scale {scale} saved metadata")
+            assert f.metadata() == dict(meta)
+            print(f"scale {scale} saved tensors")
+            assert all([
+                torch.equal(f.get_tensor(key), value) for key, value in state_dict.items()
+            ]) and set(f.keys()) == set(state_dict.keys())
+
+print("All checks passed")
@@ -0,0 +1,76 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.optimizers.adafactor import Adafactor
+from toolkit.optimizers.adam8bit import Adam8bit
+from toolkit.optimizers.automagic import Automagic
+from toolkit.optimizers.prodigy_8bit import Prodigy8bit
+
+# benchmarks the grouped foreach steps of the custom optimizers against the per param path on cpu and checks
+# they end up with the same weights
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_blocks', type=int, default=24)
+parser.add_argument('--dim', type=int, default=256)
+parser.add_argument('--steps', type=int, default=5)
+parser.add_argument('--seed', type=int, default=42)
+args = parser.parse_args()
+
+torch.manual_seed(args.seed)
+
+optimizers = [
+    ('Adafactor', Adafactor, dict(lr=None, eps=(1e-30, 1e-3), relative_step=True, scale_parameter=True)),
+    ('Adafactor beta1', Adafactor, dict(lr=1e-3, relative_step=False, scale_parameter=False, beta1=0.9)),
+    ('Automagic', Automagic, dict(lr=1e-4)),
+    ('Adam8bit', Adam8bit, dict(lr=1e-3)),
+    ('Prodigy8bit', Prodigy8bit, dict(lr=1.0)),
+]
+
+
+def make_params(dtype):
+    # a transformer like mix of repeated shapes
+    params = []
+    for _ in range(args.num_blocks):
+        params.append(torch.randn(args.dim * 3, args.dim) * 0.02)
+        params.append(torch.randn(args.dim * 3) * 0.02)
+        params.append(torch.randn(args.dim, args.dim) * 0.02)
+        params.append(torch.randn(args.dim * 4, args.dim) * 0.02)
+        params.append(torch.randn(args.dim, args.dim * 4) * 0.02)
+        params.append(torch.ones(args.dim))
+    params.append(torch.randn(args.dim, args.dim // 2, 3, 3) * 0.02)
+    return [p.to(dtype) for p in params]
+
+
+def run(optimizer_class, kwargs, base_params, grads, foreach):
+    params = [torch.nn.Parameter(p.clone()) for p in base_params]
+    optimizer = optimizer_class(params, foreach=foreach, **kwargs)
+    elapsed = 0.0
+    for step in range(args.steps):
+        for p, grad in zip(params, grads[step]):
+            p.grad = grad.clone()
+        start = time.time()
+        optimizer.step()
+        elapsed += time.time() - start
+    return params, elapsed / args.steps
+
+
+for dtype, rtol in [(torch.float32, 1e-3), (torch.bfloat16, 5e-2)]:
+    base_params = make_params(dtype)
+    grads = [[torch.randn_like(p) * 0.01 for p in base_params] for _ in range(args.steps)]
+    for name, optimizer_class, kwargs in optimizers:
+        loop_params, loop_time = run(optimizer_class, kwargs, base_params, grads, foreach=False)
+        foreach_params, foreach_time = run(optimizer_class, kwargs, base_params, grads, foreach=True)
+        # relative to how far the weights moved
+        moved = max([(a.float() - b.float()).abs().max().item() for a, b in zip(loop_params, base_params)])
+        diff = max([(a.float() - b.float()).abs().max().item() for a, b in zip(loop_params, foreach_params)])
+        print(f"{name} {dtype}: loop {loop_time * 1000:.1f}ms, foreach {foreach_time * 1000:.1f}ms "
+              f"({loop_time / max(foreach_time, 1e-9):.2f}x), max diff {diff:.2e}")
+        assert diff <= max(moved, 1e-8) * rtol + (0.0 if dtype == torch.float32 else 1e-2)
+
+print("All checks passed")
@@ -0,0 +1,64 @@
+import argparse
+import copy
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.optimizers.adafactor import Adafactor
+from toolkit.optimizers.adam8bit import Adam8bit
+from toolkit.optimizers.automagic import Automagic
+from toolkit.optimizers.prodigy_8bit import Prodigy8bit
+
+# checks optimizer state saved from the foreach path loads into the per param path and the other way around,
+# and that both keep stepping to the same weights
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--steps', type=int, default=3)
+parser.add_argument('--seed', type=int, default=42)
+args = parser.parse_args()
+
+torch.manual_seed(args.seed)
+
+optimizers = [
+    ('Adafactor', Adafactor, dict(lr=1e-3, relative_step=False, scale_parameter=False, beta1=0.9)),
+    ('Automagic', Automagic, dict(lr=1e-4)),
+    ('Adam8bit', Adam8bit, dict(lr=1e-3)),
+    ('Prodigy8bit', Prodigy8bit, dict(lr=1.0)),
+]
+
+base_params = [torch.randn(64, 32), torch.randn(64, 32), torch.randn(64), torch.randn(16, 8, 3, 3)]
+grads = [[torch.randn_like(p) * 0.01 for p in base_params] for _ in range(args.steps + 1)]
+
+
+def set_grads(params, step):
+    for p, grad in zip(params, grads[step]):
+        p.grad = grad.clone()
+
+
+for name, optimizer_class, kwargs in optimizers:
+    for save_foreach in [True, False]:
+        params = [torch.nn.Parameter(p.clone()) for p in base_params]
+        optimizer = optimizer_class(params, foreach=save_foreach, **kwargs)
+        for step in range(args.steps):
+            set_grads(params, step)
+            optimizer.step()
+        state_dict = optimizer.state_dict()
+
+        results = []
+        for load_foreach in [True, False]:
+            loaded_params = [torch.nn.Parameter(p.detach().clone()) for p in params]
+            loaded = optimizer_class(loaded_params, foreach=load_foreach, **kwargs)
+            loaded.load_state_dict(copy.deepcopy(state_dict))
+            set_grads(loaded_params, args.steps)
+            loaded.step()
+            results.append(loaded_params)
+
+        diff = max([(a - b).abs().max().item() for a, b in zip(results[0], results[1])])
+        saved_with = 'foreach' if save_foreach else 'per param'
+        print(f"{name} saved with {saved_with}: max diff after loading {diff:.2e}")
+        assert diff <= 1e-5
+
+print("All checks passed")
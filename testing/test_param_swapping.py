@@ -0,0 +1,112 @@
+import argparse
+import copy
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.optimizers.adafactor import Adafactor
+from toolkit.optimizers.automagic import Automagic
+
+# checks the param swapping plan covers every param once, keeps each window in the budget, rotates in order
+# and keeps the optimizer state of the inactive params on the cpu when offloading
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_params', type=int, default=40)
+parser.add_argument('--dim', type=int, default=64)
+parser.add_argument('--factor', type=float, default=0.2)
+parser.add_argument('--swap_every', type=int, default=2)
+parser.add_argument('--device', type=str, default='cpu')
+parser.add_argument('--seed', type=int, default=42)
+args = parser.parse_args()
+
+torch.manual_seed(args.seed)
+device = torch.device(args.device)
+
+
+def make_params():
+    params = []
+    for idx in range(args.num_params):
+        shape = (args.dim, args.dim) if idx % 2 == 0 else (args.dim,)
+        params.append(torch.nn.Parameter(torch.randn(shape, device=device)))
+    return params
+
+
+def active_ids(params):
+    return [idx for idx, p in enumerate(params) if p.requires_grad]
+
+
+def expected_window(windows, num_swaps):
+    # params of the window that is active after num_swaps calls to swap_paramiters
+    return list(range(*windows[(num_swaps // args.swap_every) % len(windows)]))
+
+
+for optimizer_class, kwargs in [(Adafactor, {'lr': 1e-3, 'relative_step': False}), (Automagic, {'lr': 1e-6})]:
+    name = optimizer_class.__name__
+    params = make_params()
+    optimizer = optimizer_class(
+        params,
+        do_paramiter_swapping=True,
+        paramiter_swapping_factor=args.factor,
+        paramiter_swapping_every=args.swap_every,
+        paramiter_swapping_offload_state=device.type != 'cpu',
+        **kwargs
+    )
+    windows = optimizer._swap_windows
+    covered = [idx for start, end in windows for idx in range(start, end)]
+    print(f"{name} {len(windows)} windows cover every param once")
+    assert covered == list(range(len(params)))
+    budget = int(optimizer._total_paramiter_size * args.factor)
+    print(f"{name} windows stay in the budget")
+    assert all([
+        sum([params[idx].numel() for idx in range(start, end)]) <= budget or end - start == 1
+        for start, end in windows
+    ])
+
+    # the trainer turns every param back on between enabling swapping and the first step
+    for p in params:
+        p.requires_grad_(True)
+
+    # swaps at the start of every step like the train loop
+    num_swaps = 0
+    for step in range(len(windows) * args.swap_every):
+        optimizer.swap_paramiters()
+        num_swaps += 1
+        active = active_ids(params)
+        print(f"{name} step {step} trains only window {active[0]}-{active[-1]}")
+        assert active == expected_window(windows, num_swaps)
+        for idx in active:
+            params[idx].grad = torch.randn_like(params[idx]) * 0.01
+        optimizer.step()
+        optimizer.zero_grad()
+
+    # a resumed optimizer continues the rotation
+    state_dict = copy.deepcopy(optimizer.state_dict())
+    resumed = optimizer_class(
+        params,
+        do_paramiter_swapping=True,
+        paramiter_swapping_factor=args.factor,
+        paramiter_swapping_every=args.swap_every,
+        paramiter_swapping_offload_state=device.type != 'cpu',
+        **kwargs
+    )
+    resumed.load_state_dict(state_dict)
+    resumed.swap_paramiters()
+    print(f"{name} resumes the rotation")
+    assert active_ids(params) == expected_window(windows, num_swaps + 1)
+    optimizer = resumed
+
+    if device.type != 'cpu':
+        inactive_on_cpu = True
+        for idx, p in enumerate(params):
+            for value in optimizer.state[p].values():
+                if isinstance(value, torch.Tensor) and value.numel() > 1:
+                    on_cpu = value.device.type == 'cpu'
+                    if on_cpu == p.requires_grad:
+                        inactive_on_cpu = False
+        print(f"{name} inactive state is offloaded")
+        assert inactive_on_cpu
+
+print("All checks passed")
@@ -0,0 +1,85 @@
+import argparse
+import os
+import sys
+import tempfile
+from collections import OrderedDict
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from safetensors.torch import save_file
+
+from toolkit.metadata import save_file_with_model_hash
+from toolkit.safetensors_stream import LazySafetensors, SafetensorsStreamWriter
+
+# checks the stream writer writes the same file as save_file_with_model_hash and that the lazy reader
+# gives back every tensor from a single file and from a folder of shards
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--seed', type=int, default=42)
+args = parser.parse_args()
+
+torch.manual_seed(args.seed)
+
+state_dict = OrderedDict()
+state_dict['b.lora_up.weight'] = torch.randn(320, 16, dtype=torch.float16)
+state_dict['b.lora_down.weight'] = torch.randn(16, 320, dtype=torch.float16)
+state_dict['b.alpha'] = torch.tensor(8.0)
+state_dict['a.weight'] = torch.randn(64, 32, 3, 3, dtype=torch.bfloat16)
+state_dict['c.steps'] = torch.arange(5, dtype=torch.int64)
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    reference_path = os.path.join(tmp_dir, 'reference.safetensors')
+    stream_path = os.path.join(tmp_dir, 'stream.safetensors')
+    save_file_with_model_hash(state_dict, reference_path, OrderedDict({'ss_output_name': 'test'}))
+
+    writer = SafetensorsStreamWriter(
+        stream_path,
+        OrderedDict([(key, (value.dtype, list(value.shape))) for key, value in state_dict.items()]),
+        OrderedDict({'ss_output_name': 'test'})
+    )
+    for key in writer.keys():
+        writer.write(key, state_dict[key])
+    writer.close()
+    with open(reference_path, 'rb') as f:
+        reference_bytes = f.read()
+    with open(stream_path, 'rb') as f:
+        stream_bytes = f.read()
+    print("stream writer matches save_file_with_model_hash")
+    assert reference_bytes == stream_bytes
+
+    with LazySafetensors(stream_path) as lazy:
+        print("lazy keys")
+        assert set(lazy.keys()) == set(state_dict.keys())
+        print("lazy shapes")
+        assert all([lazy.get_shape(key) == list(value.shape) for key, value in state_dict.items()])
+        print("lazy tensors")
+        assert all([torch.equal(value, state_dict[key]) for key, value in lazy.items()])
+        print("lazy metadata")
+        assert lazy.metadata().get('ss_output_name') == 'test'
+
+    shard_dir = os.path.join(tmp_dir, 'shards')
+    os.makedirs(shard_dir)
+    keys = list(state_dict.keys())
+    save_file({key: state_dict[key] for key in keys[:2]}, os.path.join(shard_dir, 'model-00001.safetensors'))
+    save_file({key: state_dict[key] for key in keys[2:]}, os.path.join(shard_dir, 'model-00002.safetensors'))
+    with LazySafetensors(shard_dir) as lazy:
+        print("sharded tensors")
+        assert set(lazy.keys()) == set(keys) and all([
+            torch.equal(lazy[key], state_dict[key]) for key in keys
+        ])
+
+    print("out of order write raises")
+    writer = SafetensorsStreamWriter(
+        os.path.join(tmp_dir, 'bad.safetensors'),
+        OrderedDict([(key, (value.dtype, list(value.shape))) for key, value in state_dict.items()]),
+    )
+    raised = False
+    try:
+        writer.write(writer.keys()[1], state_dict[writer.keys()[1]])
+    except ValueError:
+        raised = True
+    writer.file.close()
+    assert raised
+
+print("All checks passed")
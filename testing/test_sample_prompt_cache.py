@@ -0,0 +1,69 @@
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.prompt_utils import PromptEmbeds
+from toolkit.stable_diffusion_model import StableDiffusion
+
+# checks sample prompt embeds are reused across sampling rounds only while the text encoder is not trained. The
+# text encoder is frozen before encoding like the generate device state does, so requires_grad can not tell
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--dim', type=int, default=16)
+parser.add_argument('--seed', type=int, default=42)
+args = parser.parse_args()
+
+torch.manual_seed(args.seed)
+
+prompts = ['a photo of a cat', 'a photo of a dog', 'a photo of a cat']
+
+
+def build_sd(is_training_text_encoder):
+    # only what encode_sample_prompts needs, without loading a model
+    sd = StableDiffusion.__new__(StableDiffusion)
+    sd.adapter = None
+    sd.network = None
+    sd.text_encoder = torch.nn.Linear(args.dim, args.dim)
+    sd.sample_prompt_embeds_cache = {}
+    sd.is_training_text_encoder = is_training_text_encoder
+    sd.num_encoded = 0
+
+    def encode_prompt(prompt, prompt2=None, force_all=False):
+        sd.num_encoded += len(prompt)
+        # depends on the text encoder weights so a trained text encoder changes the embeds
+        text_embeds = torch.stack([sd.text_encoder.weight.sum(dim=0) * len(p) for p in prompt])
+        return PromptEmbeds(text_embeds)
+
+    sd.encode_prompt = encode_prompt
+    return sd
+
+
+def sample_round(sd):
+    sd.text_encoder.requires_grad_(False)
+    embeds = sd.encode_sample_prompts(prompts, prompts)
+    sd.text_encoder.requires_grad_(True)
+    return embeds
+
+
+for is_training_text_encoder in [False, True]:
+    sd = build_sd(is_training_text_encoder)
+    sample_round(sd)
+    first_num_encoded = sd.num_encoded
+    # a training step on the text encoder
+    with torch.no_grad():
+        sd.text_encoder.weight.add_(1.0)
+    embeds = sample_round(sd)
+    expected = torch.stack([sd.text_encoder.weight.sum(dim=0) * len(p) for p in prompts])
+    if is_training_text_encoder:
+        print("trained text encoder bypasses the cache")
+        assert sd.num_encoded == first_num_encoded * 2 and len(sd.sample_prompt_embeds_cache) == 0
+        assert torch.equal(embeds.text_embeds, expected)
+    else:
+        print("frozen text encoder reuses the cache")
+        assert first_num_encoded == 2 and sd.num_encoded == first_num_encoded
+
+print("All checks passed")
@@ -0,0 +1,89 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.optimizers.optimizer_utils import copy_stochastic, copy_stochastic_multi, stochastic_rounder
+
+# benchmarks the counter based stochastic rounder against the randint implementation and checks the rounding is
+# unbiased and only ever lands on the two nearest values
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--numel', type=int, default=4 * 1024 * 1024)
+parser.add_argument('--iterations', type=int, default=10)
+parser.add_argument('--device', type=str, default='cpu')
+parser.add_argument('--seed', type=int, default=42)
+args = parser.parse_args()
+
+torch.manual_seed(args.seed)
+device = torch.device(args.device)
+
+
+def sync():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def benchmark(target, source, enabled):
+    stochastic_rounder.enabled = enabled
+    copy_stochastic(target, source)
+    sync()
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+    base_memory = torch.cuda.memory_allocated() if device.type == 'cuda' else 0
+    start = time.time()
+    for _ in range(args.iterations):
+        copy_stochastic(target, source)
+    sync()
+    elapsed = (time.time() - start) / args.iterations
+    peak = torch.cuda.max_memory_allocated() - base_memory if device.type == 'cuda' else 0
+    return elapsed, peak
+
+
+for dtype in [torch.bfloat16, torch.float16, torch.float8_e4m3fn]:
+    source = torch.randn(args.numel, device=device)
+    target = torch.empty(args.numel, dtype=dtype, device=device)
+    legacy_time, legacy_peak = benchmark(target, source, enabled=False)
+    engine_time, engine_peak = benchmark(target, source, enabled=True)
+    stochastic_rounder.enabled = True
+    print(f"{dtype}: randint {legacy_time * 1000:.2f}ms, counter {engine_time * 1000:.2f}ms "
+          f"({legacy_time / max(engine_time, 1e-9):.2f}x)"
+          + (f", peak {legacy_peak / 1024 ** 2:.1f}MB vs {engine_peak / 1024 ** 2:.1f}MB"
+             if device.type == 'cuda' else ""))
+
+    if dtype == torch.float8_e4m3fn:
+        # fp8 has no nextafter, check it lands within one step of the input instead
+        copy_stochastic(target, source)
+        # one step is an eighth of the value for normals, 2 ** -9 for subnormals
+        too_far = (target.float() - source).abs() > source.abs() * 0.125 + 2 ** -9
+        print(f"{dtype} stays within one step")
+        assert not bool(too_far.any())
+        continue
+
+    # a value a third of the way between two representable values
+    low = torch.tensor([1.0], dtype=dtype)
+    high = torch.nextafter(low, torch.tensor([2.0], dtype=dtype))
+    value = low.float() + (high.float() - low.float()) / 3.0
+    source = value.expand(args.numel).contiguous().to(device)
+    copy_stochastic(target, source)
+    rounded = target.float().cpu()
+    only_neighbors = bool(((rounded == low.float()) | (rounded == high.float())).all())
+    mean_error = abs(rounded.mean().item() - value.item()) / (high.float() - low.float()).item()
+    print(f"{dtype} lands on the nearest values")
+    assert only_neighbors
+    print(f"{dtype} is unbiased (mean error {mean_error:.4f} of a step)")
+    assert mean_error < 0.01
+
+# multi tensor rounding gives every target its own random bits
+sources = [torch.full((args.numel // 4,), 1.0 + 1.0 / 256, device=device) for _ in range(4)]
+targets = [torch.empty(args.numel // 4, dtype=torch.bfloat16, device=device) for _ in range(4)]
+copy_stochastic_multi(targets, sources)
+fractions = [(t.float() > 1.0).float().mean().item() for t in targets]
+print(f"multi tensor rounding fractions {[round(f, 3) for f in fractions]}")
+assert all([abs(f - 0.5) < 0.01 for f in fractions]) and not torch.equal(targets[0], targets[1])
+
+print("All checks passed")
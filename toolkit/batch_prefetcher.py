@@ -0,0 +1,104 @@
+import queue
+import threading
+from typing import Iterator, Union
+
+import torch
+
+from toolkit.data_transfer_object.data_loader import DataLoaderBatchDTO
+
+
+class _EndOfIterator:
+    pass
+
+
+class _IteratorException:
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+class BatchPrefetcher:
+    """
+    Wraps a dataloader iterator and loads the next num_prefetch batches in a background thread. On cuda the
+    batch tensors are pinned and copied to the device on a side stream, so the train step gets batches that
+    are already on the device. On cpu it only overlaps loading and collation with the step.
+    The thread starts on the first next() so the dataloader epoch can be set up after creating it.
+    """
+
+    def __init__(self, iterator: Iterator, device: Union[str, torch.device], num_prefetch: int = 2):
+        self.iterator = iterator
+        self.device = torch.device(device)
+        self.num_prefetch = max(1, num_prefetch)
+        self.is_cuda = self.device.type == 'cuda' and torch.cuda.is_available()
+        self.stream = None
+        if self.is_cuda:
+            if self.device.index is None:
+                self.device = torch.device('cuda', torch.cuda.current_device())
+            self.stream = torch.cuda.Stream(device=self.device)
+        self.queue = queue.Queue(maxsize=self.num_prefetch)
+        self.stop_event = threading.Event()
+        self.thread: Union[threading.Thread, None] = None
+        self.is_done = False
+
+    def __iter__(self):
+        return self
+
+    def _put(self, item) -> bool:
+        # keep checking for close so the thread never blocks forever on a full queue
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _load_batches(self):
+        if self.is_cuda:
+            torch.cuda.set_device(self.device)
+        try:
+            for batch in self.iterator:
+                event = None
+                if self.is_cuda and isinstance(batch, DataLoaderBatchDTO):
+                    batch.pin_memory()
+                    with torch.cuda.stream(self.stream):
+                        batch.to_device(self.device, non_blocking=True)
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                if not self._put((batch, event)):
+                    return
+            self._put(_EndOfIterator())
+        except BaseException as e:
+            self._put(_IteratorException(e))
+
+    def __next__(self):
+        if self.is_done:
+            raise StopIteration
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._load_batches, daemon=True)
+            self.thread.start()
+        item = self.queue.get()
+        if isinstance(item, _EndOfIterator):
+            self.is_done = True
+            self.thread.join()
+            raise StopIteration
+        if isinstance(item, _IteratorException):
+            self.is_done = True
+            raise item.exception
+        batch, event = item
+        if event is not None:
+            # wait for the copy and tell the allocator the tensors are now used on the compute stream
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            for tensor in batch.get_tensors():
+                tensor.record_stream(current_stream)
+        return batch
+
+    def close(self):
+        self.stop_event.set()
+        self.is_done = True
+        if self.thread is not None:
+            # free a slot in case the thread is waiting on a full queue
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,150 @@
+import random
+from collections import OrderedDict
+from typing import List, Dict, Tuple, TYPE_CHECKING, Iterator, Union
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+if TYPE_CHECKING:
+    from toolkit.data_loader import AiToolkitDataset, FileItemConcatDataset
+
+
+class BucketBatchSampler(Sampler[List[int]]):
+    """
+    Batches entries from all datasets of a FileItemConcatDataset by bucket. Buckets with the same resolution are
+    merged across datasets, datasets are weighted by their sampling_ratio and batches are sharded across ranks.
+    Every rank builds the same batches from the seed and epoch and takes every num_replicas batch.
+    """
+
+    def __init__(
+            self,
+            dataset: 'FileItemConcatDataset',
+            batch_size: int,
+            bucket_remainder: str = 'keep',
+            shuffle: bool = True,
+            num_replicas: Union[int, None] = None,
+            rank: Union[int, None] = None,
+            seed: Union[int, None] = None,
+    ):
+        super().__init__()
+        if bucket_remainder not in ['keep', 'pad', 'drop']:
+            raise ValueError(f"bucket_remainder must be keep, pad or drop, got {bucket_remainder}")
+        is_distributed = dist.is_available() and dist.is_initialized()
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if is_distributed else 1
+        if rank is None:
+            rank = dist.get_rank() if is_distributed else 0
+        if rank >= num_replicas or rank < 0:
+            raise ValueError(f"Invalid rank {rank}, rank should be in the interval [0, {num_replicas - 1}]")
+        if seed is None:
+            seed = random.randint(0, 2 ** 31 - 1)
+            if is_distributed:
+                # ranks need the same seed to build the same batches, use the one from rank 0
+                seed_list = [seed]
+                dist.broadcast_object_list(seed_list, src=0)
+                seed = seed_list[0]
+
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.bucket_remainder = bucket_remainder
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def get_bucket_groups(self) -> Dict[Tuple[int, int, bool], List[Tuple[np.ndarray, float]]]:
+        # (width, height, is caching latents) -> [(global entry indices, sampling ratio)] for each dataset
+        # datasets caching latents cannot share a batch with ones that are not
+        groups: Dict[Tuple[int, int, bool], List[Tuple[np.ndarray, float]]] = OrderedDict()
+        offset = 0
+        for dataset in self.dataset.datasets:
+            dataset: 'AiToolkitDataset' = dataset
+            for bucket in dataset.buckets.values():
+                key = (bucket.width, bucket.height, dataset.is_caching_latents)
+                if key not in groups:
+                    groups[key] = []
+                idxs = np.array(bucket.file_list_idx, dtype=np.int64) + offset
+                groups[key].append((idxs, dataset.dataset_config.sampling_ratio))
+            offset += len(dataset.file_index)
+        return groups
+
+    @staticmethod
+    def get_num_samples(num_entries: int, sampling_ratio: float) -> int:
+        return int(round(num_entries * sampling_ratio))
+
+    def sample_entries(self, rng: np.random.Generator, idxs: np.ndarray, sampling_ratio: float) -> np.ndarray:
+        num_samples = self.get_num_samples(len(idxs), sampling_ratio)
+        if len(idxs) == 0 or num_samples == 0:
+            return idxs[:0]
+        # every entry for each full multiple of the ratio, then a random subset for the rest
+        num_full, num_rest = divmod(num_samples, len(idxs))
+        parts = [idxs] * num_full
+        if num_rest > 0:
+            parts.append(rng.choice(idxs, num_rest, replace=False))
+        return np.concatenate(parts)
+
+    def build_batches(self, epoch: int) -> List[List[int]]:
+        # same generator on every rank
+        rng = np.random.default_rng([self.seed, epoch])
+        batches: List[np.ndarray] = []
+        for parts in self.get_bucket_groups().values():
+            idxs = np.concatenate([self.sample_entries(rng, part_idxs, ratio) for part_idxs, ratio in parts])
+            if len(idxs) == 0:
+                continue
+            if self.shuffle:
+                rng.shuffle(idxs)
+            num_full = len(idxs) // self.batch_size
+            for batch_idx in range(num_full):
+                batches.append(idxs[batch_idx * self.batch_size:(batch_idx + 1) * self.batch_size])
+            remainder = idxs[num_full * self.batch_size:]
+            if len(remainder) == 0 or self.bucket_remainder == 'drop':
+                continue
+            if self.bucket_remainder == 'pad':
+                num_pad = self.batch_size - len(remainder)
+                used = idxs[:num_full * self.batch_size]
+                if len(used) >= num_pad:
+                    # fill with other images from the same bucket
+                    pad = rng.choice(used, num_pad, replace=False)
+                else:
+                    # bucket is smaller than a batch, repeat what we have
+                    pad = rng.choice(idxs, num_pad, replace=True)
+                remainder = np.concatenate([remainder, pad])
+            batches.append(remainder)
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        if self.num_replicas > 1:
+            if self.bucket_remainder == 'drop':
+                # every rank gets the same number of batches
+                batches = batches[:len(batches) - len(batches) % self.num_replicas]
+            elif len(batches) % self.num_replicas != 0:
+                num_pad = self.num_replicas - len(batches) % self.num_replicas
+                batches = batches + [batches[i % len(batches)] for i in range(num_pad)]
+            batches = batches[self.rank::self.num_replicas]
+
+        return [batch.tolist() for batch in batches]
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = self.build_batches(self.epoch)
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self) -> int:
+        num_batches = 0
+        for parts in self.get_bucket_groups().values():
+            num_samples = sum([self.get_num_samples(len(idxs), ratio) for idxs, ratio in parts])
+            num_full, remainder = divmod(num_samples, self.batch_size)
+            num_batches += num_full
+            if remainder > 0 and self.bucket_remainder != 'drop':
+                num_batches += 1
+        if self.num_replicas > 1:
+            if self.bucket_remainder == 'drop':
+                return num_batches // self.num_replicas
+            return (num_batches + self.num_replicas - 1) // self.num_replicas
+        return num_batches
@@ -1,4 +1,7 @@
-from typing import Type, List, Union, TypedDict
+from functools import lru_cache
+from typing import Type, List, Union, TypedDict, Tuple
+
+import numpy as np
 
 
 class BucketResolution(TypedDict):
@@ -172,3 +175,71 @@ def get_bucket_for_image_size(
         raise ValueError("No suitable bucket found")
 
     return closest_bucket
+
+
+# images bucketed at once by get_buckets_for_image_sizes
+BUCKET_CHUNK_SIZE = 65536
+
+
+@lru_cache(maxsize=None)
+def get_bucket_size_arrays(resolution: int = 512, divisibility: int = 8) -> Tuple[np.ndarray, np.ndarray]:
+    # same as get_bucket_sizes as width and height arrays, only built once per resolution and divisibility
+    bucket_size_list = get_bucket_sizes(resolution=resolution, divisibility=divisibility)
+    widths = np.array([bucket["width"] for bucket in bucket_size_list], dtype=np.int64)
+    heights = np.array([bucket["height"] for bucket in bucket_size_list], dtype=np.int64)
+    widths.flags.writeable = False
+    heights.flags.writeable = False
+    return widths, heights
+
+
+def get_resolutions(widths: np.ndarray, heights: np.ndarray) -> np.ndarray:
+    # vectorized get_resolution
+    num_pixels = widths.astype(np.int64) * heights.astype(np.int64)
+    return np.sqrt(num_pixels.astype(np.float64)).astype(np.int64)
+
+
+def get_buckets_for_image_sizes(
+        widths: np.ndarray,
+        heights: np.ndarray,
+        resolution: int,
+        divisibility: int = 8
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized get_bucket_for_image_size with a resolution. Returns the bucket width and height for every size.
+    Sizes are grouped by the resolution they end up using, so only images smaller than the resolution
+    need their own bucket table.
+    """
+    widths = np.asarray(widths, dtype=np.int64)
+    heights = np.asarray(heights, dtype=np.int64)
+    bucket_widths = np.zeros_like(widths)
+    bucket_heights = np.zeros_like(heights)
+
+    # if real resolution is smaller, use that instead
+    image_resolutions = np.minimum(get_resolutions(widths, heights), resolution)
+
+    for image_resolution in np.unique(image_resolutions):
+        table_widths, table_heights = get_bucket_size_arrays(int(image_resolution), divisibility)
+        resolution_idxs = np.nonzero(image_resolutions == image_resolution)[0]
+        # work in chunks so the (num images, num buckets) arrays stay small
+        for start_idx in range(0, len(resolution_idxs), BUCKET_CHUNK_SIZE):
+            idxs = resolution_idxs[start_idx:start_idx + BUCKET_CHUNK_SIZE]
+            w = widths[idxs, None]
+            h = heights[idxs, None]
+
+            # To minimize pixels, we use the larger scale factor to minimize the amount that has to be cropped.
+            scale = np.maximum(table_widths[None, :] / w, table_heights[None, :] / h)
+            new_widths = (w * scale).astype(np.int64)
+            new_heights = (h * scale).astype(np.int64)
+            removed_pixels = (new_widths - table_widths[None, :]) * new_heights + \
+                             (new_heights - table_heights[None, :]) * new_widths
+            # argmin keeps the first bucket on ties like the loop does
+            bucket_idxs = np.argmin(removed_pixels, axis=1)
+
+            # exact matches win
+            exact = (table_widths[None, :] == w) & (table_heights[None, :] == h)
+            bucket_idxs = np.where(exact.any(axis=1), np.argmax(exact, axis=1), bucket_idxs)
+
+            bucket_widths[idxs] = table_widths[bucket_idxs]
+            bucket_heights[idxs] = table_heights[bucket_idxs]
+
+    return bucket_widths, bucket_heights
@@ -0,0 +1,86 @@
+import queue
+import threading
+import traceback
+from collections import OrderedDict
+from typing import Callable, Union
+
+import torch
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints on a background thread. The training thread snapshots the tensors to cpu with snapshot(),
+    pinned when they come from cuda, and submits the hashing, serialization and cleanup as jobs. Jobs run in the
+    order they were submitted. The queue is bounded, submit blocks until there is room for the job.
+    """
+
+    def __init__(self, max_pending: int = 16):
+        self.queue = queue.Queue(maxsize=max(1, max_pending))
+        self.thread: Union[threading.Thread, None] = None
+        self.errors = []
+
+    def _snapshot_tensor(self, tensor: torch.Tensor, dtype: Union[torch.dtype, None] = None) -> torch.Tensor:
+        tensor = tensor.detach()
+        if dtype is None or not tensor.is_floating_point():
+            dtype = tensor.dtype
+        if tensor.is_cuda:
+            cpu_tensor = torch.empty(tensor.shape, dtype=dtype, device='cpu', pin_memory=True)
+            cpu_tensor.copy_(tensor, non_blocking=True)
+            return cpu_tensor
+        return tensor.to(dtype).clone()
+
+    def _snapshot(self, value, dtype: Union[torch.dtype, None] = None):
+        if isinstance(value, torch.Tensor):
+            return self._snapshot_tensor(value, dtype)
+        if isinstance(value, OrderedDict):
+            return OrderedDict([(k, self._snapshot(v, dtype)) for k, v in value.items()])
+        if isinstance(value, dict):
+            return {k: self._snapshot(v, dtype) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return type(value)([self._snapshot(v, dtype) for v in value])
+        return value
+
+    def snapshot(self, value, dtype: Union[torch.dtype, None] = None):
+        # copies every tensor in a (nested) state dict to cpu, floating point ones to dtype if it is set
+        snapshot = self._snapshot(value, dtype)
+        if torch.cuda.is_available():
+            # one sync for all the non blocking copies
+            torch.cuda.synchronize()
+        return snapshot
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                fn, args, kwargs = job
+                fn(*args, **kwargs)
+            except Exception as e:
+                traceback.print_exc()
+                print(f"Error writing checkpoint: {e}")
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, fn: Callable, *args, **kwargs):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        self.queue.put((fn, args, kwargs))
+
+    def flush(self):
+        # wait for everything submitted to be written
+        if self.thread is not None:
+            self.queue.join()
+        if len(self.errors) > 0:
+            errors = self.errors
+            self.errors = []
+            raise errors[0]
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.thread = None
+        self.flush()
@@ -28,6 +28,9 @@ class SaveConfig:
         self.push_to_hub: bool = kwargs.get("push_to_hub", False)
         self.hf_repo_id: Optional[str] = kwargs.get("hf_repo_id", None)
         self.hf_private: Optional[str] = kwargs.get("hf_private", False)
+        # snapshot the weights to cpu and write checkpoints, optimizer state and cleanup on a background thread
+        # so training continues during the save. Needs cpu memory for a copy of what is saved
+        self.async_save: bool = kwargs.get("async_save", False)
 
 class LoggingConfig:
     def __init__(self, **kwargs):
@@ -57,6 +60,12 @@ class SampleConfig:
         self.refiner_start_at = kwargs.get('refiner_start_at',
                                            0.5)  # step to start using refiner on sample if it exists
         self.extra_values = kwargs.get('extra_values', [])
+        # number of samples with the same size and settings to generate in one pipeline call
+        self.batch_size: int = kwargs.get('batch_size', 1)
+        # render samples in a separate process with its own copy of the model while training continues
+        self.async_sampling: bool = kwargs.get('async_sampling', False)
+        # device for the sampling process, defaults to the training device which then holds a second copy of the model
+        self.sample_device: Optional[str] = kwargs.get('sample_device', None)
 
 
 class LormModuleSettingsConfig:
@@ -394,10 +403,27 @@ class TrainConfig:
         # will cache a blank prompt or the trigger word, and unload the text encoder to cpu
         # will make training faster and use less vram
         self.unload_text_encoder = kwargs.get('unload_text_encoder', False)
+        # encodes every caption the datasets can produce once, caches them to disk and serves them from the
+        # dataloader. The text encoder is moved to cpu for training. Captions must be deterministic
+        self.cache_text_embeddings = kwargs.get('cache_text_embeddings', False)
+        if self.cache_text_embeddings:
+            if self.train_text_encoder:
+                raise ValueError("Cannot cache text embeddings while training the text encoder")
+            if self.prompt_saturation_chance > 0.0:
+                raise ValueError("prompt_saturation_chance is not supported when caching text embeddings")
+            if self.short_and_long_captions_encoder_split:
+                raise ValueError("short_and_long_captions_encoder_split is not supported when caching text embeddings")
+        # number of batches to load ahead in a background thread. On cuda they are copied to the device
+        # on a side stream so the step does not wait on the transfer. 0 disables it
+        self.prefetch_batches: int = kwargs.get('prefetch_batches', 2)
         # for swapping which parameters are trained during training
         self.do_paramiter_swapping = kwargs.get('do_paramiter_swapping', False)
         # 0.1 is 10% of the parameters active at a time lower is less vram, higher is more
         self.paramiter_swapping_factor = kwargs.get('paramiter_swapping_factor', 0.1)
+        # rotate to the next window of parameters every n steps. Params are rotated in order so each gets trained
+        self.paramiter_swapping_every = kwargs.get('paramiter_swapping_every', 1)
+        # keep the optimizer state of the inactive parameters on the cpu
+        self.paramiter_swapping_offload_state = kwargs.get('paramiter_swapping_offload_state', False)
         # bypass the guidance embedding for training. For open flux with guidance embedding
         self.bypass_guidance_embedding = kwargs.get('bypass_guidance_embedding', False)
 
@@ -488,6 +514,15 @@ class EMAConfig:
         # only use for things without a bias like lora
         # similar to a decay in an optimizer but the opposite
         self.param_multiplier: float = kwargs.get('param_multiplier', 1.0)
+        # update the shadow params in flat groups instead of one tensor at a time
+        self.use_foreach: bool = kwargs.get('use_foreach', True)
+        # only update the ema every n optimizer steps. The decay is adjusted to match
+        self.update_every: int = kwargs.get('update_every', 1)
+        # keep the ema weights in pinned cpu memory and average them on cpu threads while the next step runs
+        self.offload_to_cpu: bool = kwargs.get('offload_to_cpu', False)
+        # dtype of the offloaded ema weights. Defaults to the param dtype. bf16 or fp8 use stochastic rounding
+        self.shadow_dtype: str = kwargs.get('shadow_dtype', None)
+        self.offload_workers: int = kwargs.get('offload_workers', 4)
 
 
 class ReferenceDatasetConfig:
@@ -616,10 +651,22 @@ class DatasetConfig:
         self.poi: Union[str, None] = kwargs.get('poi',
                                                 None)  # if one is set and in json data, will be used as auto crop scale point of interes
         self.num_repeats: int = kwargs.get('num_repeats', 1)  # number of times to repeat dataset
+        # how often this dataset is sampled relative to its size when buckets are shared across datasets. 2.0 is twice per epoch
+        self.sampling_ratio: float = float(kwargs.get('sampling_ratio', 1.0))
+        # partial batch at the end of a bucket. keep it, pad it with other images from the bucket, or drop it
+        self.bucket_remainder: str = kwargs.get('bucket_remainder', 'keep')
+        if self.bucket_remainder not in ['keep', 'pad', 'drop']:
+            raise ValueError(f"bucket_remainder must be keep, pad or drop, got {self.bucket_remainder}")
         # cache latents will store them in memory
         self.cache_latents: bool = kwargs.get('cache_latents', False)
         # cache latents to disk will store them on disk. If both are true, it will save to disk, but keep in memory
         self.cache_latents_to_disk: bool = kwargs.get('cache_latents_to_disk', False)
+        # store disk latents in a few large memory mapped shards per folder instead of one file per image
+        self.sharded_latent_cache: bool = kwargs.get('sharded_latent_cache', False)
+        # number of images to run through the vae at once when caching latents. Images are grouped by bucket
+        self.cache_batch_size: int = kwargs.get('cache_batch_size', 1)
+        # number of threads used to load and process images while caching. 0 loads them on the main thread
+        self.cache_num_workers: int = kwargs.get('cache_num_workers', 2)
         self.cache_clip_vision_to_disk: bool = kwargs.get('cache_clip_vision_to_disk', False)
 
         self.standardize_images: bool = kwargs.get('standardize_images', False)
@@ -1,10 +1,11 @@
-import copy
+import bisect
 import json
 import os
 import random
 import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from functools import lru_cache
-from typing import List, TYPE_CHECKING
+from typing import List, TYPE_CHECKING, Union
 
 import cv2
 import numpy as np
@@ -16,10 +17,14 @@ from torch.utils.data import Dataset, DataLoader, ConcatDataset
 from tqdm import tqdm
 import albumentations as A
 
+from toolkit import image_utils
+from toolkit.bucket_sampler import BucketBatchSampler
 from toolkit.buckets import get_bucket_for_image_size, BucketResolution
 from toolkit.config_modules import DatasetConfig, preprocess_dataset_raw_config
-from toolkit.dataloader_mixins import CaptionMixin, BucketsMixin, LatentCachingMixin, Augments, CLIPCachingMixin
+from toolkit.dataloader_mixins import CaptionMixin, BucketsMixin, LatentCachingMixin, Augments, CLIPCachingMixin, \
+    TextEmbeddingCachingMixin
 from toolkit.data_transfer_object.data_loader import FileItemDTO, DataLoaderBatchDTO
+from toolkit.file_index import FileIndex
 
 import platform
 
@@ -30,6 +35,14 @@ if TYPE_CHECKING:
     from toolkit.stable_diffusion_model import StableDiffusion
 
 
+def _probe_image_size(path):
+    # runs in a worker process, errors are handled by the caller
+    try:
+        return image_utils.probe_image_size(path)
+    except Exception:
+        return None
+
+
 class RescaleTransform:
     """Transform to rescale images to the range [-1, 1]."""
 
@@ -366,7 +379,7 @@ class PairedImageDataset(Dataset):
         return img, prompt, (self.neg_weight, self.pos_weight)
 
 
-class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, CaptionMixin, Dataset):
+class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, TextEmbeddingCachingMixin, BucketsMixin, CaptionMixin, Dataset):
 
     def __init__(
             self,
@@ -413,10 +426,6 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
                 # keys are file paths
                 file_list = list(self.caption_dict.keys())
 
-        if self.dataset_config.num_repeats > 1:
-            # repeat the list
-            file_list = file_list * self.dataset_config.num_repeats
-
         if self.dataset_config.standardize_images:
             if self.sd.is_xl or self.sd.is_vega or self.sd.is_ssd:
                 NormalizeMethod = NormalizeSDXLTransform
@@ -441,7 +450,7 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
         if not os.path.isdir(self.dataset_path):
             dataset_folder = os.path.dirname(dataset_folder)
         dataset_size_file = os.path.join(dataset_folder, '.aitk_size.json')
-        dataloader_version = "0.1.1"
+        dataloader_version = "0.1.2"
         if os.path.exists(dataset_size_file):
             try:
                 with open(dataset_size_file, 'r') as f:
@@ -459,6 +468,7 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
             self.size_database = {}
         
         self.size_database["__version__"] = dataloader_version
+        self.update_size_database(file_list, dataset_folder)
 
         bad_count = 0
         for file in tqdm(file_list):
@@ -492,9 +502,7 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
             current_file_list = [x for x in self.file_list]
             for file_item in current_file_list:
                 # create a copy that is flipped on the x axis
-                new_file_item = copy.deepcopy(file_item)
-                new_file_item.flip_x = True
-                self.file_list.append(new_file_item)
+                self.file_list.append(file_item.copy_flipped(flip_x=True))
 
         # handle y axis flips
         if self.dataset_config.flip_y:
@@ -502,16 +510,52 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
             current_file_list = [x for x in self.file_list]
             for file_item in current_file_list:
                 # create a copy that is flipped on the y axis
-                new_file_item = copy.deepcopy(file_item)
-                new_file_item.flip_y = True
-                self.file_list.append(new_file_item)
+                self.file_list.append(file_item.copy_flipped(flip_y=True))
 
         if self.dataset_config.flip_x or self.dataset_config.flip_y:
             print(f"  -  Found {len(self.file_list)} images after adding flips")
 
+        # repeats are not materialized, they are entries in the file index pointing to the same file item
+        self.file_index = FileIndex(self.file_list, num_repeats=self.dataset_config.num_repeats)
+        if self.file_index.num_repeats > 1:
+            print(f"  -  {len(self.file_index)} entries with {self.file_index.num_repeats} repeats")
 
         self.setup_epoch()
 
+    def update_size_database(self, file_list: List[str], dataset_folder: str):
+        # entries are (width, height, mtime_ns, file_size). Only new or changed files get probed
+        to_probe = []
+        for file in dict.fromkeys(file_list):
+            file_key = file.replace(dataset_folder, '')
+            try:
+                file_stat = os.stat(file)
+            except OSError:
+                # FileItemDTO will report it
+                continue
+            entry = self.size_database.get(file_key, None)
+            if entry is not None and entry[2] == file_stat.st_mtime_ns and entry[3] == file_stat.st_size:
+                continue
+            to_probe.append((file, file_key, file_stat))
+        if len(to_probe) == 0:
+            return
+
+        paths = [x[0] for x in to_probe]
+        num_workers = min(32, os.cpu_count() or 1)
+        if len(paths) < 256 or num_workers < 2:
+            sizes = [_probe_image_size(path) for path in tqdm(paths)]
+        else:
+            # spawning processes on windows re-imports everything, header reads are io bound anyway
+            pool_class = ThreadPoolExecutor if is_native_windows() else ProcessPoolExecutor
+            with pool_class(max_workers=num_workers) as executor:
+                sizes = list(tqdm(executor.map(_probe_image_size, paths, chunksize=64), total=len(paths)))
+
+        for (file, file_key, file_stat), size in zip(to_probe, sizes):
+            if size is None:
+                # leave it out, FileItemDTO will try again and report the error
+                self.size_database.pop(file_key, None)
+                continue
+            self.size_database[file_key] = (size[0], size[1], file_stat.st_mtime_ns, file_stat.st_size)
+
     def setup_epoch(self):
         if self.epoch_num == 0:
             # initial setup
@@ -533,10 +577,21 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
     def __len__(self):
         if self.dataset_config.buckets:
             return len(self.batch_indices)
-        return len(self.file_list)
+        return len(self.file_index)
+
+    def get_file_item(self, index) -> 'FileItemDTO':
+        # builds the file item for an entry in the file index. It is a copy, only use it for a single sample
+        file_item = self.file_list[self.file_index.get_item_idx(index)].copy_for_sample()
+        self.file_index.apply_to_file_item(index, file_item)
+        if file_item.is_caching_to_memory:
+            if file_item._latent_path is None:
+                # crop changed since the path was cached, keep the recalculated one for the next time
+                self.file_index.latent_paths[index] = file_item.get_latent_path()
+            file_item._encoded_latent = self.latent_cache.get(file_item._latent_path, None)
+        return file_item
 
     def _get_single_item(self, index) -> 'FileItemDTO':
-        file_item = copy.deepcopy(self.file_list[index])
+        file_item = self.get_file_item(index)
         file_item.load_and_process_image(self.transform)
         file_item.load_caption(self.caption_dict)
         return file_item
@@ -556,10 +611,34 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
             return self._get_single_item(item)
 
 
+class FileItemConcatDataset(Dataset):
+    """
+    Single file items from several AiToolkitDatasets, indexed by file index entry with the entries of the
+    datasets before it added. Batches come from a BucketBatchSampler
+    """
+
+    def __init__(self, datasets: List[AiToolkitDataset]):
+        self.datasets = datasets
+        self.cumulative_sizes: List[int] = []
+        total = 0
+        for dataset in datasets:
+            total += len(dataset.file_index)
+            self.cumulative_sizes.append(total)
+
+    def __len__(self):
+        return self.cumulative_sizes[-1] if len(self.cumulative_sizes) > 0 else 0
+
+    def __getitem__(self, idx) -> 'FileItemDTO':
+        dataset_idx = bisect.bisect_right(self.cumulative_sizes, idx)
+        offset = self.cumulative_sizes[dataset_idx - 1] if dataset_idx > 0 else 0
+        return self.datasets[dataset_idx]._get_single_item(idx - offset)
+
+
 def get_dataloader_from_datasets(
         dataset_options,
         batch_size=1,
         sd: 'StableDiffusion' = None,
+        seed: Union[int, None] = None,
 ) -> DataLoader:
     if dataset_options is None or len(dataset_options) == 0:
         return None
@@ -591,11 +670,6 @@ def get_dataloader_from_datasets(
         else:
             raise ValueError(f"invalid dataset type: {config.type}")
 
-    concatenated_dataset = ConcatDataset(datasets)
-
-    # todo build scheduler that can get buckets from all datasets that match
-    # todo and evenly distribute reg images
-
     def dto_collation(batch: List['FileItemDTO']):
         # create DTO batch
         batch = DataLoaderBatchDTO(
@@ -618,15 +692,22 @@ def get_dataloader_from_datasets(
         for dataset in datasets:
             assert dataset.dataset_config.buckets, f"buckets not found on dataset {dataset.dataset_config.folder_path}, you either need all buckets or none"
 
+        # buckets of the same size are shared across datasets
+        file_item_dataset = FileItemConcatDataset(datasets)
+        batch_sampler = BucketBatchSampler(
+            file_item_dataset,
+            batch_size=batch_size,
+            bucket_remainder=dataset_config_list[0].bucket_remainder,
+            seed=seed,
+        )
         data_loader = DataLoader(
-            concatenated_dataset,
-            batch_size=None,  # we batch in the datasets for now
-            drop_last=False,
-            shuffle=True,
+            file_item_dataset,
+            batch_sampler=batch_sampler,
             collate_fn=dto_collation,  # Use the custom collate function
             **dataloader_kwargs
         )
     else:
+        concatenated_dataset = ConcatDataset(datasets)
         data_loader = DataLoader(
             concatenated_dataset,
             batch_size=batch_size,
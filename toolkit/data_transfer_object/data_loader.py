@@ -1,3 +1,4 @@
+import copy
 import os
 import weakref
 from _weakref import ReferenceType
@@ -5,13 +6,11 @@ from typing import TYPE_CHECKING, List, Union
 import torch
 import random
 
-from PIL import Image
-from PIL.ImageOps import exif_transpose
-
 from toolkit import image_utils
 from toolkit.dataloader_mixins import CaptionProcessingDTOMixin, ImageProcessingDTOMixin, LatentCachingFileItemDTOMixin, \
     ControlFileItemDTOMixin, ArgBreakMixin, PoiFileItemDTOMixin, MaskFileItemDTOMixin, AugmentationFileItemDTOMixin, \
-    UnconditionalFileItemDTOMixin, ClipImageFileItemDTOMixin
+    UnconditionalFileItemDTOMixin, ClipImageFileItemDTOMixin, TextEmbeddingFileItemDTOMixin
+from toolkit.prompt_utils import PromptEmbeds, concat_prompt_embeds
 
 
 if TYPE_CHECKING:
@@ -30,6 +29,7 @@ def print_once(msg):
 
 class FileItemDTO(
     LatentCachingFileItemDTOMixin,
+    TextEmbeddingFileItemDTOMixin,
     CaptionProcessingDTOMixin,
     ImageProcessingDTOMixin,
     ControlFileItemDTOMixin,
@@ -51,18 +51,12 @@ class FileItemDTO(
         else:
             file_key = os.path.basename(self.path)
         if file_key in size_database:
-            w, h = size_database[file_key]
+            w, h = size_database[file_key][:2]
         else:
-            # original method is significantly faster, but some images are read sideways. Not sure why. Do slow method for now.
-            # process width and height
-            # try:
-            #     w, h = image_utils.get_image_size(self.path)
-            # except image_utils.UnknownImageFormat:
-            #     print_once(f'Warning: Some images in the dataset cannot be fast read. ' + \
-            #                f'This process is faster for png, jpeg')
-            img = exif_transpose(Image.open(self.path))
-            w, h = img.size
-            size_database[file_key] = (w, h)
+            # reads the headers when it can, accounts for exif rotation
+            w, h = image_utils.probe_image_size(self.path)
+            file_stat = os.stat(self.path)
+            size_database[file_key] = (w, h, file_stat.st_mtime_ns, file_stat.st_size)
         self.width: int = w
         self.height: int = h
         self.dataloader_transforms = kwargs.get('dataloader_transforms', None)
@@ -87,6 +81,27 @@ class FileItemDTO(
         self.is_reg = self.dataset_config.is_reg
         self.tensor: Union[torch.Tensor, None] = None
 
+    def copy_for_sample(self) -> 'FileItemDTO':
+        # a shallow copy is enough here. Loading a sample only assigns new values to the copy and never
+        # modifies shared values in place, so the config, transforms, processors and latents cached
+        # in memory stay shared with the dataset item instead of being deep copied for every sample
+        return copy.copy(self)
+
+    def copy_flipped(self, flip_x=False, flip_y=False) -> 'FileItemDTO':
+        # flipped items share everything with the original except the flip and what depends on it
+        file_item = copy.copy(self)
+        if flip_x:
+            file_item.flip_x = True
+            if file_item.has_point_of_interest:
+                file_item.poi_x = file_item.width - file_item.poi_x - file_item.poi_width
+        if flip_y:
+            file_item.flip_y = True
+            if file_item.has_point_of_interest:
+                file_item.poi_y = file_item.height - file_item.poi_y - file_item.poi_height
+        file_item._latent_path = None
+        file_item._clip_vision_embeddings_path = None
+        return file_item
+
     def cleanup(self):
         self.tensor = None
         self.cleanup_latent()
@@ -94,6 +109,7 @@ class FileItemDTO(
         self.cleanup_clip_image()
         self.cleanup_mask()
         self.cleanup_unconditional()
+        self.cleanup_text_embeddings()
 
 
 class DataLoaderBatchDTO:
@@ -112,6 +128,9 @@ class DataLoaderBatchDTO:
             self.clip_image_embeds: Union[List[dict], None] = None
             self.clip_image_embeds_unconditional: Union[List[dict], None] = None
             self.sigmas: Union[torch.Tensor, None] = None  # can be added elseware and passed along training code
+            # cached text embeddings, only set when every item has them
+            self.prompt_embeds: Union[PromptEmbeds, None] = None
+            self.prompt_embeds_short: Union[PromptEmbeds, None] = None
             self.extra_values: Union[torch.Tensor, None] = torch.tensor([x.extra_values for x in self.file_items]) if len(self.file_items[0].extra_values) > 0 else None
             if not is_latents_cached:
                 # only return a tensor if latents are not cached
@@ -140,6 +159,11 @@ class DataLoaderBatchDTO:
 
             self.loss_multiplier_list: List[float] = [x.loss_multiplier for x in self.file_items]
 
+            if all([x.prompt_embeds is not None for x in self.file_items]):
+                self.prompt_embeds = concat_prompt_embeds([x.prompt_embeds for x in self.file_items])
+            if all([x.prompt_embeds_short is not None for x in self.file_items]):
+                self.prompt_embeds_short = concat_prompt_embeds([x.prompt_embeds_short for x in self.file_items])
+
             if any([x.clip_image_tensor is not None for x in self.file_items]):
                 # find one to use as a base
                 base_clip_image_tensor = None
@@ -222,6 +246,39 @@ class DataLoaderBatchDTO:
             print(e)
             raise e
 
+    def _apply(self, fn):
+        # runs fn on every tensor that goes to the device with the batch and stores the result
+        for name in ['tensor', 'latents', 'control_tensor', 'clip_image_tensor', 'mask_tensor',
+                     'unaugmented_tensor', 'unconditional_tensor', 'unconditional_latents', 'extra_values']:
+            tensor = getattr(self, name, None)
+            if isinstance(tensor, torch.Tensor):
+                setattr(self, name, fn(tensor))
+        for prompt_embeds in [getattr(self, 'prompt_embeds', None), getattr(self, 'prompt_embeds_short', None)]:
+            if prompt_embeds is None:
+                continue
+            if isinstance(prompt_embeds.text_embeds, torch.Tensor):
+                prompt_embeds.text_embeds = fn(prompt_embeds.text_embeds)
+            else:
+                prompt_embeds.text_embeds = [fn(x) for x in prompt_embeds.text_embeds]
+            if prompt_embeds.pooled_embeds is not None:
+                prompt_embeds.pooled_embeds = fn(prompt_embeds.pooled_embeds)
+            if prompt_embeds.attention_mask is not None:
+                prompt_embeds.attention_mask = fn(prompt_embeds.attention_mask)
+        return self
+
+    def get_tensors(self) -> List[torch.Tensor]:
+        tensors = []
+        self._apply(lambda x: tensors.append(x) or x)
+        return tensors
+
+    def pin_memory(self):
+        # called by the torch DataLoader when pin_memory=True and by the BatchPrefetcher
+        return self._apply(lambda x: x if x.is_cuda or x.is_pinned() else x.pin_memory())
+
+    def to_device(self, device: Union[str, torch.device], non_blocking: bool = False):
+        # moves the batch tensors, keeping their dtype. non_blocking only overlaps when they are pinned
+        return self._apply(lambda x: x.to(device, non_blocking=non_blocking))
+
     def get_is_reg_list(self):
         return [x.is_reg for x in self.file_items]
 
@@ -248,5 +305,7 @@ class DataLoaderBatchDTO:
         del self.latents
         del self.tensor
         del self.control_tensor
+        del self.prompt_embeds
+        del self.prompt_embeds_short
         for file_item in self.file_items:
             file_item.cleanup()
@@ -6,6 +6,7 @@ import math
 import os
 import random
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import TYPE_CHECKING, List, Dict, Union
 
 import cv2
@@ -16,10 +17,11 @@ from tqdm import tqdm
 from transformers import CLIPImageProcessor, CLIPVisionModelWithProjection, SiglipImageProcessor
 
 from toolkit.basic import flush, value_map
-from toolkit.buckets import get_bucket_for_image_size, get_resolution
+from toolkit.buckets import get_bucket_for_image_size, get_buckets_for_image_sizes, get_resolution
+from toolkit.latent_store import get_sharded_latent_store
 from toolkit.metadata import get_meta_for_safetensors
 from toolkit.models.pixtral_vision import PixtralVisionImagePreprocessorCompatible
-from toolkit.prompt_utils import inject_trigger_into_prompt
+from toolkit.prompt_utils import inject_trigger_into_prompt, PromptEmbeds, split_prompt_embeds
 from torchvision import transforms
 from PIL import Image, ImageFilter, ImageOps
 from PIL.ImageOps import exif_transpose
@@ -30,6 +32,8 @@ from toolkit.train_tools import get_torch_dtype
 if TYPE_CHECKING:
     from toolkit.data_loader import AiToolkitDataset
     from toolkit.data_transfer_object.data_loader import FileItemDTO
+    from toolkit.file_index import FileIndex
+    from toolkit.latent_store import ShardedLatentStore
     from toolkit.stable_diffusion_model import StableDiffusion
 
 # def get_associated_caption_from_img_path(img_path):
@@ -200,76 +204,84 @@ class BucketsMixin:
         config: 'DatasetConfig' = self.dataset_config
         resolution = config.resolution
         bucket_tolerance = config.bucket_tolerance
-        file_list: List['FileItemDTO'] = self.file_list
-
-        # for file_item in enumerate(file_list):
-        for idx, file_item in enumerate(file_list):
-            file_item: 'FileItemDTO' = file_item
-            width = int(file_item.width * file_item.dataset_config.scale)
-            height = int(file_item.height * file_item.dataset_config.scale)
-
-            did_process_poi = False
-            if file_item.has_point_of_interest:
-                # Attempt to process the poi if we can. It wont process if the image is smaller than the resolution
-                did_process_poi = file_item.setup_poi_bucket()
-            if self.dataset_config.square_crop:
-                # we scale first so smallest size matches resolution
-                scale_factor_x = resolution / width
-                scale_factor_y = resolution / height
-                scale_factor = max(scale_factor_x, scale_factor_y)
-                file_item.scale_to_width = math.ceil(width * scale_factor)
-                file_item.scale_to_height = math.ceil(height * scale_factor)
-                file_item.crop_width = resolution
-                file_item.crop_height = resolution
-                if width > height:
-                    file_item.crop_x = int(file_item.scale_to_width / 2 - resolution / 2)
-                    file_item.crop_y = 0
-                else:
-                    file_item.crop_x = 0
-                    file_item.crop_y = int(file_item.scale_to_height / 2 - resolution / 2)
-            elif not did_process_poi:
-                bucket_resolution = get_bucket_for_image_size(
-                    width, height,
-                    resolution=resolution,
-                    divisibility=bucket_tolerance
+        file_index: 'FileIndex' = self.file_index
+        num_entries = len(file_index)
+        widths = (file_index.entry_width * config.scale).astype(np.int64)
+        heights = (file_index.entry_height * config.scale).astype(np.int64)
+
+        # poi cropping is random per entry, these still go one at a time
+        did_process_poi = np.zeros(num_entries, dtype=bool)
+        item_has_poi = np.array([file_item.has_point_of_interest for file_item in self.file_list], dtype=bool)
+        for idx in np.nonzero(item_has_poi[file_index.item_idx])[0].tolist():
+            # Attempt to process the poi if we can. It wont process if the image is smaller than the resolution
+            file_item: 'FileItemDTO' = self.get_file_item(idx)
+            if file_item.setup_poi_bucket():
+                did_process_poi[idx] = True
+                file_index.set_entry(
+                    idx,
+                    file_item.scale_to_width,
+                    file_item.scale_to_height,
+                    file_item.crop_x,
+                    file_item.crop_y,
+                    file_item.crop_width,
+                    file_item.crop_height,
                 )
 
-                # Calculate scale factors for width and height
-                width_scale_factor = bucket_resolution["width"] / width
-                height_scale_factor = bucket_resolution["height"] / height
-
-                # Use the maximum of the scale factors to ensure both dimensions are scaled above the bucket resolution
-                max_scale_factor = max(width_scale_factor, height_scale_factor)
-
-                # round up
-                file_item.scale_to_width = int(math.ceil(width * max_scale_factor))
-                file_item.scale_to_height = int(math.ceil(height * max_scale_factor))
-
-                file_item.crop_height = bucket_resolution["height"]
-                file_item.crop_width = bucket_resolution["width"]
-
-                new_width = bucket_resolution["width"]
-                new_height = bucket_resolution["height"]
+        if self.dataset_config.square_crop:
+            idxs = np.arange(num_entries)
+            # we scale first so smallest size matches resolution
+            scale_factor = np.maximum(resolution / widths, resolution / heights)
+            scale_to_width = np.ceil(widths * scale_factor).astype(np.int64)
+            scale_to_height = np.ceil(heights * scale_factor).astype(np.int64)
+            crop_width = np.full(num_entries, resolution, dtype=np.int64)
+            crop_height = np.full(num_entries, resolution, dtype=np.int64)
+            is_landscape = widths > heights
+            crop_x = np.where(is_landscape, np.trunc(scale_to_width / 2 - resolution / 2), 0).astype(np.int64)
+            crop_y = np.where(is_landscape, 0, np.trunc(scale_to_height / 2 - resolution / 2)).astype(np.int64)
+        else:
+            idxs = np.nonzero(~did_process_poi)[0]
+            widths = widths[idxs]
+            heights = heights[idxs]
+            crop_width, crop_height = get_buckets_for_image_sizes(
+                widths, heights,
+                resolution=resolution,
+                divisibility=bucket_tolerance
+            )
 
-                if self.dataset_config.random_crop:
-                    # random crop
-                    crop_x = random.randint(0, file_item.scale_to_width - new_width)
-                    crop_y = random.randint(0, file_item.scale_to_height - new_height)
-                    file_item.crop_x = crop_x
-                    file_item.crop_y = crop_y
-                else:
-                    # do central crop
-                    file_item.crop_x = int((file_item.scale_to_width - new_width) / 2)
-                    file_item.crop_y = int((file_item.scale_to_height - new_height) / 2)
+            # Use the maximum of the scale factors to ensure both dimensions are scaled above the bucket resolution
+            max_scale_factor = np.maximum(crop_width / widths, crop_height / heights)
 
-                if file_item.crop_y < 0 or file_item.crop_x < 0:
-                    print('debug')
+            # round up
+            scale_to_width = np.ceil(widths * max_scale_factor).astype(np.int64)
+            scale_to_height = np.ceil(heights * max_scale_factor).astype(np.int64)
 
-            # check if bucket exists, if not, create it
-            bucket_key = f'{file_item.crop_width}x{file_item.crop_height}'
-            if bucket_key not in self.buckets:
-                self.buckets[bucket_key] = Bucket(file_item.crop_width, file_item.crop_height)
-            self.buckets[bucket_key].file_list_idx.append(idx)
+            if self.dataset_config.random_crop:
+                # random crop, seeded from random so the training seed still applies
+                rng = np.random.default_rng(random.randint(0, 2 ** 32 - 1))
+                crop_x = rng.integers(0, scale_to_width - crop_width + 1)
+                crop_y = rng.integers(0, scale_to_height - crop_height + 1)
+            else:
+                # do central crop
+                crop_x = np.trunc((scale_to_width - crop_width) / 2).astype(np.int64)
+                crop_y = np.trunc((scale_to_height - crop_height) / 2).astype(np.int64)
+
+        file_index.set_entries(idxs, scale_to_width, scale_to_height, crop_x, crop_y, crop_width, crop_height)
+
+        # group entries by crop size, buckets keep the order they first show up in
+        crop_sizes = np.stack([file_index.crop_width, file_index.crop_height], axis=1)
+        unique_sizes, first_idxs, bucket_ids = np.unique(crop_sizes, axis=0, return_index=True, return_inverse=True)
+        bucket_order = np.argsort(first_idxs)
+        bucket_remap = np.empty_like(bucket_order)
+        bucket_remap[bucket_order] = np.arange(len(bucket_order))
+        file_index.bucket_id[:] = bucket_remap[bucket_ids.reshape(-1)]
+
+        sorted_idxs = np.argsort(file_index.bucket_id, kind='stable')
+        bucket_counts = np.bincount(file_index.bucket_id, minlength=len(bucket_order))
+        for bucket_idxs, unique_idx in zip(np.split(sorted_idxs, np.cumsum(bucket_counts)[:-1]), bucket_order):
+            bucket_width, bucket_height = int(unique_sizes[unique_idx][0]), int(unique_sizes[unique_idx][1])
+            bucket = Bucket(bucket_width, bucket_height)
+            bucket.file_list_idx = bucket_idxs.tolist()
+            self.buckets[f'{bucket_width}x{bucket_height}'] = bucket
 
         # print the buckets
         self.shuffle_buckets()
@@ -344,13 +356,16 @@ class CaptionProcessingDTOMixin:
         self.caption = self.get_caption()
         if self.raw_caption_short is not None:
             self.caption_short = self.get_caption(short_caption=True)
+        if self.text_embedding_paths is not None:
+            self.load_text_embeddings()
 
     def get_caption(
             self: 'FileItemDTO',
             trigger=None,
             to_replace_list=None,
             add_if_not_present=False,
-            short_caption=False
+            short_caption=False,
+            caption_dropout=True
     ):
         if short_caption:
             raw_caption = self.raw_caption_short
@@ -359,7 +374,7 @@ class CaptionProcessingDTOMixin:
         if raw_caption is None:
             raw_caption = ''
         # handle dropout
-        if self.dataset_config.caption_dropout_rate > 0 and not short_caption:
+        if self.dataset_config.caption_dropout_rate > 0 and not short_caption and caption_dropout:
             # get a random float form 0 to 1
             rand = random.random()
             if rand < self.dataset_config.caption_dropout_rate:
@@ -1284,6 +1299,36 @@ class PoiFileItemDTOMixin:
         return True
 
 
+class TextEmbeddingFileItemDTOMixin:
+    def __init__(self, *args, **kwargs):
+        # if we have super, call it
+        if hasattr(super(), '__init__'):
+            super().__init__(*args, **kwargs)
+        # caption -> path of the cached prompt embeds for the conditioned caption
+        self.text_embedding_paths: Union[Dict[str, str], None] = None
+        self.prompt_embeds: Union[PromptEmbeds, None] = None
+        self.prompt_embeds_short: Union[PromptEmbeds, None] = None
+
+    def get_caption_variants(self: 'FileItemDTO', caption_dict: Union[dict, None]) -> List[str]:
+        # every caption this item can produce. Only valid when captions are deterministic
+        self.load_caption(caption_dict)
+        variants = [self.get_caption(caption_dropout=False)]
+        if self.raw_caption_short is not None:
+            variants.append(self.get_caption(short_caption=True))
+        if self.dataset_config.caption_dropout_rate > 0:
+            variants.append('')
+        return list(OrderedDict.fromkeys(variants))
+
+    def load_text_embeddings(self: 'FileItemDTO'):
+        self.prompt_embeds = PromptEmbeds.load(self.text_embedding_paths[self.caption])
+        if self.caption_short is not None and self.caption_short in self.text_embedding_paths:
+            self.prompt_embeds_short = PromptEmbeds.load(self.text_embedding_paths[self.caption_short])
+
+    def cleanup_text_embeddings(self: 'FileItemDTO'):
+        self.prompt_embeds = None
+        self.prompt_embeds_short = None
+
+
 class ArgBreakMixin:
     # just stops super calls form hitting object
     def __init__(self, *args, **kwargs):
@@ -1301,6 +1346,8 @@ class LatentCachingFileItemDTOMixin:
         self.is_caching_to_disk = False
         self.is_caching_to_memory = False
         self.latent_load_device = 'cpu'
+        # set when latents are stored in shards instead of one file per image
+        self.latent_store: Union['ShardedLatentStore', None] = None
         # sd1 or sdxl or others
         self.latent_space_version = 'sd1'
         # todo, increment this if we change the latent format to invalidate cache
@@ -1342,6 +1389,25 @@ class LatentCachingFileItemDTOMixin:
 
         return self._latent_path
 
+    def get_latent_key(self: 'FileItemDTO'):
+        # key used in the sharded latent store, same as the latent filename
+        return os.path.splitext(os.path.basename(self.get_latent_path()))[0]
+
+    def is_latent_on_disk(self: 'FileItemDTO'):
+        if self.latent_store is not None:
+            return self.get_latent_key() in self.latent_store
+        return os.path.exists(self.get_latent_path())
+
+    def load_latent_from_disk(self: 'FileItemDTO') -> torch.Tensor:
+        if self.latent_store is not None:
+            return self.latent_store.get(self.get_latent_key())
+        state_dict = load_file(
+            self.get_latent_path(),
+            # device=device if device is not None else self.latent_load_device
+            device='cpu'
+        )
+        return state_dict['latent']
+
     def cleanup_latent(self):
         if self._encoded_latent is not None:
             if not self.is_caching_to_memory:
@@ -1356,12 +1422,7 @@ class LatentCachingFileItemDTOMixin:
             return None
         if self._encoded_latent is None:
             # load it from disk
-            state_dict = load_file(
-                self.get_latent_path(),
-                # device=device if device is not None else self.latent_load_device
-                device='cpu'
-            )
-            self._encoded_latent = state_dict['latent']
+            self._encoded_latent = self.load_latent_from_disk()
         return self._encoded_latent
 
 
@@ -1372,11 +1433,29 @@ class LatentCachingMixin:
             super().__init__(**kwargs)
         self.latent_cache = {}
 
+    def get_latent_space_version(self: 'AiToolkitDataset'):
+        if self.sd.model_config.latent_space_version is not None:
+            return self.sd.model_config.latent_space_version
+        elif self.sd.is_xl:
+            return 'sdxl'
+        elif self.sd.is_v3:
+            return 'sd3'
+        elif self.sd.is_auraflow:
+            return 'sdxl'
+        elif self.sd.is_flux:
+            return 'flux1'
+        elif self.sd.model_config.is_pixart_sigma:
+            return 'sdxl'
+        else:
+            return 'sd1'
+
     def cache_latents_all_latents(self: 'AiToolkitDataset'):
         print(f"Caching latents for {self.dataset_path}")
         # cache all latents to disk
         to_disk = self.is_caching_latents_to_disk
         to_memory = self.is_caching_latents_to_memory
+        cache_batch_size = max(1, self.dataset_config.cache_batch_size)
+        cache_num_workers = max(0, self.dataset_config.cache_num_workers)
 
         if to_disk:
             print(" - Saving latents to disk")
@@ -1385,73 +1464,148 @@ class LatentCachingMixin:
         # move sd items to cpu except for vae
         self.sd.set_device_state_preset('cache_latents')
 
-        # use tqdm to show progress
-        i = 0
-        for file_item in tqdm(self.file_list, desc=f'Caching latents{" to disk" if to_disk else ""}'):
-            # set latent space version
-            if self.sd.model_config.latent_space_version is not None:
-                file_item.latent_space_version = self.sd.model_config.latent_space_version
-            elif self.sd.is_xl:
-                file_item.latent_space_version = 'sdxl'
-            elif self.sd.is_v3:
-                file_item.latent_space_version = 'sd3'
-            elif self.sd.is_auraflow:
-                file_item.latent_space_version = 'sdxl'
-            elif self.sd.is_flux:
-                file_item.latent_space_version = 'flux1'
-            elif self.sd.model_config.is_pixart_sigma:
-                file_item.latent_space_version = 'sdxl'
-            else:
-                file_item.latent_space_version = 'sd1'
+        latent_space_version = self.get_latent_space_version()
+
+        # store latents in a few large shards per folder instead of one file per image
+        use_latent_shards = to_disk and self.dataset_config.sharded_latent_cache
+        latent_stores = set()
+
+        for file_item in self.file_list:
+            file_item.latent_space_version = latent_space_version
             file_item.is_caching_to_disk = to_disk
             file_item.is_caching_to_memory = to_memory
             file_item.latent_load_device = self.sd.device
-
+            if use_latent_shards:
+                latent_dir = os.path.join(os.path.dirname(file_item.path), '_latent_cache')
+                file_item.latent_store = get_sharded_latent_store(latent_dir)
+                latent_stores.add(file_item.latent_store)
+
+        # find what still needs encoding by latent path. Repeats often share a path, so we only encode them once
+        items_to_encode: Dict[str, 'FileItemDTO'] = OrderedDict()
+        for idx in range(len(self.file_index)):
+            file_item = self.get_file_item(idx)
             latent_path = file_item.get_latent_path(recalculate=True)
+            self.file_index.latent_paths[idx] = latent_path
+            if latent_path in items_to_encode or latent_path in self.latent_cache:
+                continue
             # check if it is saved to disk already
-            if os.path.exists(latent_path):
+            if file_item.is_latent_on_disk():
                 if to_memory:
                     # load it into memory
-                    state_dict = load_file(latent_path, device='cpu')
-                    file_item._encoded_latent = state_dict['latent'].to('cpu', dtype=self.sd.torch_dtype)
+                    latent = file_item.load_latent_from_disk()
+                    self.latent_cache[latent_path] = latent.to('cpu', dtype=self.sd.torch_dtype)
             else:
-                # not saved to disk, calculate
-                # load the image first
-                file_item.load_and_process_image(self.transform, only_load_latents=True)
-                dtype = self.sd.torch_dtype
-                device = self.sd.device_torch
-                # add batch dimension
-                try:
-                    imgs = file_item.tensor.unsqueeze(0).to(device, dtype=dtype)
-                    latent = self.sd.encode_images(imgs).squeeze(0)
-                except Exception as e:
-                    print(f"Error processing image: {file_item.path}")
-                    print(f"Error: {str(e)}")
-                    raise e
-                # save_latent
-                if to_disk:
-                    state_dict = OrderedDict([
-                        ('latent', latent.clone().detach().cpu()),
-                    ])
-                    # metadata
-                    meta = get_meta_for_safetensors(file_item.get_latent_info_dict())
-                    os.makedirs(os.path.dirname(latent_path), exist_ok=True)
-                    save_file(state_dict, latent_path, metadata=meta)
-
-                if to_memory:
-                    # keep it in memory
-                    file_item._encoded_latent = latent.to('cpu', dtype=self.sd.torch_dtype)
-
-                del imgs
-                del latent
-                del file_item.tensor
+                items_to_encode[latent_path] = file_item
 
-                # flush(garbage_collect=False)
+        # group by bucket resolution so they can be batched through the vae
+        buckets: Dict[str, List['FileItemDTO']] = OrderedDict()
+        for file_item in items_to_encode.values():
+            if self.dataset_config.buckets:
+                bucket_key = f'{file_item.crop_width}x{file_item.crop_height}'
+            else:
+                bucket_key = f'{self.dataset_config.resolution}x{self.dataset_config.resolution}'
+            if bucket_key not in buckets:
+                buckets[bucket_key] = []
+            buckets[bucket_key].append(file_item)
+
+        batches: List[List['FileItemDTO']] = []
+        for bucket_items in buckets.values():
+            for start_idx in range(0, len(bucket_items), cache_batch_size):
+                batches.append(bucket_items[start_idx:start_idx + cache_batch_size])
+
+        def load_image(file_item: 'FileItemDTO'):
+            file_item.load_and_process_image(self.transform, only_load_latents=True)
+
+        # images for the next batch are loaded by the pool while the vae encodes the current one
+        load_pool = ThreadPoolExecutor(max_workers=cache_num_workers) if cache_num_workers > 0 else None
+        # a single writer so saving to disk overlaps with encoding
+        save_pool = ThreadPoolExecutor(max_workers=1) if to_disk else None
+        save_futures = []
+
+        def submit_batch(batch):
+            if load_pool is None:
+                return None
+            return [load_pool.submit(load_image, file_item) for file_item in batch]
+
+        dtype = self.sd.torch_dtype
+        device = self.sd.device_torch
+        num_to_encode = sum([len(batch) for batch in batches])
+        progress_bar = tqdm(total=num_to_encode, desc=f'Caching latents{" to disk" if to_disk else ""}', unit='img')
+        try:
+            next_futures = submit_batch(batches[0]) if len(batches) > 0 else None
+            for batch_idx, batch in enumerate(batches):
+                futures = next_futures
+                if batch_idx + 1 < len(batches):
+                    next_futures = submit_batch(batches[batch_idx + 1])
+                if futures is None:
+                    for file_item in batch:
+                        load_image(file_item)
+                else:
+                    for future in futures:
+                        future.result()
+
+                # in case a transform produced different sizes, only stack matching shapes
+                shape_groups: Dict[tuple, List['FileItemDTO']] = OrderedDict()
+                for file_item in batch:
+                    shape = tuple(file_item.tensor.shape)
+                    if shape not in shape_groups:
+                        shape_groups[shape] = []
+                    shape_groups[shape].append(file_item)
+
+                for shape_batch in shape_groups.values():
+                    try:
+                        imgs = [x.tensor.to(device, dtype=dtype) for x in shape_batch]
+                        latents = self.sd.encode_images(imgs)
+                    except Exception as e:
+                        print(f"Error processing images: {', '.join([x.path for x in shape_batch])}")
+                        print(f"Error: {str(e)}")
+                        raise e
+
+                    for file_item, latent in zip(shape_batch, latents):
+                        # save_latent
+                        if use_latent_shards:
+                            save_futures.append(save_pool.submit(
+                                file_item.latent_store.put,
+                                file_item.get_latent_key(),
+                                latent.clone().detach().cpu()
+                            ))
+                        elif to_disk:
+                            state_dict = OrderedDict([
+                                ('latent', latent.clone().detach().cpu()),
+                            ])
+                            # metadata
+                            meta = get_meta_for_safetensors(file_item.get_latent_info_dict())
+                            latent_path = file_item.get_latent_path()
+                            os.makedirs(os.path.dirname(latent_path), exist_ok=True)
+                            save_futures.append(save_pool.submit(save_file, state_dict, latent_path, metadata=meta))
+
+                        if to_memory:
+                            # keep it in memory
+                            self.latent_cache[file_item.get_latent_path()] = latent.to('cpu', dtype=self.sd.torch_dtype)
+
+                        file_item.tensor = None
+
+                    del imgs
+                    del latents
+
+                # do not let the writer fall too far behind
+                while len(save_futures) > cache_batch_size * 4:
+                    save_futures.pop(0).result()
+                progress_bar.update(len(batch))
+
+            for future in save_futures:
+                future.result()
+        finally:
+            progress_bar.close()
+            if load_pool is not None:
+                load_pool.shutdown(wait=True)
+            if save_pool is not None:
+                save_pool.shutdown(wait=True)
+            for latent_store in latent_stores:
+                latent_store.save_index()
+
+        for file_item in self.file_list:
             file_item.is_latent_cached = True
-            i += 1
-            # flush every 100
-            # if i % 100 == 0:
-            #     flush()
 
         # restore device state
         self.sd.restore_device_state()
@@ -1628,3 +1782,62 @@ class CLIPCachingMixin:
 
         # restore device state
         self.sd.restore_device_state()
+
+
+class TextEmbeddingCachingMixin:
+    def __init__(self: 'AiToolkitDataset', **kwargs):
+        # if we have super, call it
+        if hasattr(super(), '__init__'):
+            super().__init__(**kwargs)
+        self.is_text_embeddings_cached = False
+
+    def get_text_embedding_info_dict(self: 'AiToolkitDataset', prompt: str):
+        return OrderedDict([
+            ("prompt", prompt),
+            ("model", self.sd.model_config.name_or_path_original),
+            ("latent_space_version", self.get_latent_space_version()),
+            ("attn_masking", self.sd.model_config.attn_masking),
+            ("text_embedding_version", 1),
+        ])
+
+    def get_text_embedding_path(self: 'AiToolkitDataset', file_item: 'FileItemDTO', prompt: str):
+        # stored in a folder next to the latent cache, named after the hash of the prompt and model
+        embedding_dir = os.path.join(os.path.dirname(file_item.path), '_text_embedding_cache')
+        hash_input = json.dumps(self.get_text_embedding_info_dict(prompt), sort_keys=True).encode('utf-8')
+        hash_str = base64.urlsafe_b64encode(hashlib.md5(hash_input).digest()).decode('ascii')
+        hash_str = hash_str.replace('=', '')
+        return os.path.join(embedding_dir, f'{hash_str}.safetensors')
+
+    def cache_text_embeddings(self: 'AiToolkitDataset', condition_prompt):
+        # condition_prompt(prompt, is_reg) applies the trainer trigger words, etc to a caption
+        config: 'DatasetConfig' = self.dataset_config
+        if config.shuffle_tokens or config.token_dropout_rate > 0 or len(config.random_triggers) > 0:
+            raise ValueError(
+                f"Cannot cache text embeddings for {self.dataset_path}. shuffle_tokens, token_dropout_rate "
+                f"and random_triggers make captions random"
+            )
+        print(f"Caching text embeddings for {self.dataset_path}")
+
+        # conditioned prompt -> path for everything not on disk yet
+        prompts_to_encode: Dict[str, str] = OrderedDict()
+        for file_item in tqdm(self.file_list, desc='Finding captions'):
+            text_embedding_paths = {}
+            for caption in file_item.get_caption_variants(self.caption_dict):
+                prompt = condition_prompt(caption, file_item.is_reg)
+                embedding_path = self.get_text_embedding_path(file_item, prompt)
+                if embedding_path not in prompts_to_encode and not os.path.exists(embedding_path):
+                    prompts_to_encode[embedding_path] = prompt
+                text_embedding_paths[caption] = embedding_path
+            file_item.text_embedding_paths = text_embedding_paths
+
+        batch_size = max(1, config.cache_batch_size)
+        items = list(prompts_to_encode.items())
+        with torch.no_grad():
+            for start_idx in tqdm(range(0, len(items), batch_size), desc='Caching text embeddings to disk'):
+                batch = items[start_idx:start_idx + batch_size]
+                prompt_embeds = self.sd.encode_prompt([prompt for _, prompt in batch])
+                for (embedding_path, prompt), embeds in zip(batch, split_prompt_embeds(prompt_embeds)):
+                    meta = get_meta_for_safetensors(self.get_text_embedding_info_dict(prompt))
+                    os.makedirs(os.path.dirname(embedding_path), exist_ok=True)
+                    embeds.save(embedding_path, meta=meta)
+        self.is_text_embeddings_cached = True
@@ -1,7 +1,8 @@
 from __future__ import division
 from __future__ import unicode_literals
 
-from typing import Iterable, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
 import weakref
 import copy
 import contextlib
@@ -10,6 +11,26 @@ from toolkit.optimizers.optimizer_utils import copy_stochastic
 import torch
 
 
+class EMAParamGroup:
+    """
+    Shadow params that share a dtype and device, stored as views into one flat buffer so a chunk of them can be
+    updated and stochastically rounded in a single pass.
+    """
+
+    def __init__(
+            self,
+            indices: List[int],
+            flat: torch.Tensor,
+            chunks: List[tuple],
+            param_dtype: torch.dtype,
+    ):
+        self.indices = indices
+        self.flat = flat
+        # (start idx, end idx, start offset, end offset) into indices and flat
+        self.chunks = chunks
+        self.param_dtype = param_dtype
+
+
 # Partially based on:
 # https://github.com/tensorflow/tensorflow/blob/r1.13/tensorflow/python/training/moving_averages.py
 class ExponentialMovingAverage:
@@ -38,6 +59,24 @@ class ExponentialMovingAverage:
 
         use_num_updates: Whether to use number of updates when computing
             averages.
+
+        use_foreach: Update groups of shadow params stored in flat buffers
+            instead of one tensor at a time.
+
+        update_every: Only update every k calls. The decay is raised to the
+            power of k so the average covers the same number of steps.
+
+        offload_to_cpu: Keep the shadow params in pinned cpu memory. The live
+            params are copied to the host on a side stream and averaged on cpu
+            worker threads while the next step runs. Call `wait_for_transfer`
+            before the params are changed again.
+
+        shadow_dtype: Dtype of the offloaded shadow params. Stochastic
+            rounding is used when it is lower precision than float32.
+
+        num_offload_workers: Cpu threads averaging the offloaded chunks. The
+            live params are copied through num_offload_workers + 1 pinned
+            staging buffers of up to max_chunk_numel elements each.
     """
 
     def __init__(
@@ -47,21 +86,47 @@ class ExponentialMovingAverage:
             use_num_updates: bool = False,
             # feeds back the decat to the parameter
             use_feedback: bool = False,
-            param_multiplier: float = 1.0
+            param_multiplier: float = 1.0,
+            use_foreach: bool = True,
+            update_every: int = 1,
+            # max elements updated in one pass, limits the float32 scratch memory
+            max_chunk_numel: int = 64 * 1024 * 1024,
+            offload_to_cpu: bool = False,
+            shadow_dtype: Optional[torch.dtype] = None,
+            num_offload_workers: int = 4,
     ):
         if parameters is None:
             raise ValueError("parameters must be provided")
         if decay < 0.0 or decay > 1.0:
             raise ValueError('Decay must be between 0 and 1')
+        if update_every < 1:
+            raise ValueError('update_every must be at least 1')
+        if offload_to_cpu and (use_feedback or param_multiplier != 1.0):
+            # these write to the live params, which the async update can not do
+            raise ValueError('offload_to_cpu does not support use_feedback or param_multiplier')
         self.decay = decay
+        self.use_foreach = use_foreach
+        self.update_every = update_every
+        self.max_chunk_numel = max_chunk_numel
+        self.num_calls = 0
+        self.groups: Optional[List[EMAParamGroup]] = None
+        self.offload_to_cpu = offload_to_cpu
+        self.shadow_dtype = shadow_dtype
+        self.num_offload_workers = num_offload_workers
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.copy_stream = None
+        self.pending_updates = []
+        self.transfer_events = []
+        # param dtype -> ring of pinned buffers the live params are copied into, and the update reading each one
+        self.staging_buffers: Dict[torch.dtype, List[torch.Tensor]] = {}
+        self.staging_futures: Dict[torch.dtype, List[Optional[Future]]] = {}
+        self.staging_idx = 0
         self.num_updates = 0 if use_num_updates else None
         self.use_feedback = use_feedback
         self.param_multiplier = param_multiplier
         parameters = list(parameters)
-        self.shadow_params = [
-            p.clone().detach()
-            for p in parameters
-        ]
+        # replaced with the shadow copies in _build_groups
+        self.shadow_params = list(parameters)
         self.collected_params = None
         self._is_train_mode = True
         # By maintaining only a weakref to each parameter,
@@ -70,6 +135,85 @@ class ExponentialMovingAverage:
         # is kept, no references to the model or its parameters will be
         # maintained, and the model will be cleaned up.
         self._params_refs = [weakref.ref(p) for p in parameters]
+        self._build_groups(from_params=True)
+
+    def _get_shadow_dtype(self, param: torch.Tensor) -> torch.dtype:
+        if self.offload_to_cpu and self.shadow_dtype is not None and param.is_floating_point():
+            return self.shadow_dtype
+        return param.dtype
+
+    def _make_shadow(self, param: torch.Tensor) -> torch.Tensor:
+        if self.offload_to_cpu:
+            # never make a second copy on the device
+            return param.detach().to('cpu', dtype=self._get_shadow_dtype(param), copy=True)
+        return param.clone().detach()
+
+    def _build_groups(self, from_params: bool = False):
+        # moves the shadow params into one flat buffer per dtype and device and makes them views into it.
+        # With from_params the shadow params are still the live params and are copied straight into the buffers
+        self.wait()
+        self.groups = None
+        self.staging_buffers = {}
+        self.staging_futures = {}
+        grouped = {}
+        if self.use_foreach or self.offload_to_cpu:
+            for idx, s_param in enumerate(self.shadow_params):
+                param = self._params_refs[idx]() if idx < len(self._params_refs) else None
+                if type(s_param) not in (torch.Tensor, torch.nn.Parameter) or not s_param.is_floating_point() or \
+                        (param is not None and type(param) not in (torch.Tensor, torch.nn.Parameter)):
+                    # quantized and other tensor subclasses use the per tensor path
+                    continue
+                param_dtype = param.dtype if param is not None else s_param.dtype
+                param_device = param.device if param is not None else s_param.device
+                if from_params:
+                    shadow_dtype = self._get_shadow_dtype(s_param)
+                    shadow_device = torch.device('cpu') if self.offload_to_cpu else s_param.device
+                else:
+                    shadow_dtype = s_param.dtype
+                    shadow_device = s_param.device
+                grouped.setdefault((shadow_dtype, shadow_device, param_dtype, param_device), []).append(idx)
+            self.groups = []
+        grouped_indices = set()
+        pin_memory = self.offload_to_cpu and torch.cuda.is_available()
+        for (dtype, device, param_dtype, param_device), indices in grouped.items():
+            total_numel = sum([self.shadow_params[idx].numel() for idx in indices])
+            flat = torch.empty(total_numel, dtype=dtype, device=device, pin_memory=pin_memory)
+            chunks = []
+            offset = 0
+            chunk_start = 0
+            chunk_offset = 0
+            for i, idx in enumerate(indices):
+                s_param = self.shadow_params[idx]
+                numel = s_param.numel()
+                if offset - chunk_offset > 0 and offset + numel - chunk_offset > self.max_chunk_numel:
+                    chunks.append((chunk_start, i, chunk_offset, offset))
+                    chunk_start = i
+                    chunk_offset = offset
+                view = flat[offset:offset + numel].view(s_param.shape)
+                view.copy_(s_param.detach())
+                self.shadow_params[idx] = view
+                offset += numel
+            chunks.append((chunk_start, len(indices), chunk_offset, offset))
+            self.groups.append(EMAParamGroup(indices, flat, chunks, param_dtype))
+            grouped_indices.update(indices)
+        if self.offload_to_cpu:
+            # staging buffers only hold a chunk each and are reused, not a copy of the whole model
+            staging_numel = {}
+            for group in self.groups:
+                for _, _, flat_start, flat_end in group.chunks:
+                    numel = max(staging_numel.get(group.param_dtype, 0), flat_end - flat_start)
+                    staging_numel[group.param_dtype] = numel
+            for param_dtype, numel in staging_numel.items():
+                self.staging_buffers[param_dtype] = [
+                    torch.empty(numel, dtype=param_dtype, device='cpu', pin_memory=pin_memory)
+                    for _ in range(self.num_offload_workers + 1)
+                ]
+                self.staging_futures[param_dtype] = [None] * (self.num_offload_workers + 1)
+        if from_params:
+            # the params that are not in a flat buffer get their own copy
+            for idx, s_param in enumerate(self.shadow_params):
+                if idx not in grouped_indices:
+                    self.shadow_params[idx] = self._make_shadow(s_param)
 
     def _get_parameters(
             self,
@@ -113,23 +257,41 @@ class ExponentialMovingAverage:
                 parameters with which this `ExponentialMovingAverage` was
                 initialized will be used.
         """
+        self.num_calls += 1
+        if self.num_calls % self.update_every != 0:
+            return
+        # the previous async update has to finish before the staging buffers are reused
+        self.wait()
         parameters = self._get_parameters(parameters)
         decay = self.decay
         if self.num_updates is not None:
-            self.num_updates += 1
+            self.num_updates += self.update_every
             decay = min(
                 decay,
                 (1 + self.num_updates) / (10 + self.num_updates)
             )
+        # one update stands in for update_every steps
+        decay = decay ** self.update_every
         one_minus_decay = 1.0 - decay
         with torch.no_grad():
-            for s_param, param in zip(self.shadow_params, parameters):
+            grouped_indices = set()
+            if self.groups is not None:
+                for group in self.groups:
+                    if self.offload_to_cpu:
+                        self._update_group_offloaded(group, parameters, one_minus_decay)
+                    else:
+                        self._update_group(group, parameters, one_minus_decay)
+                    grouped_indices.update(group.indices)
+            for idx, (s_param, param) in enumerate(zip(self.shadow_params, parameters)):
+                if idx in grouped_indices:
+                    continue
                 s_param_float = s_param.float()
                 if s_param.dtype != torch.float32:
                     s_param_float = s_param_float.to(torch.float32)
                 param_float = param
                 if param.dtype != torch.float32:
                     param_float = param_float.to(torch.float32)
+                param_float = param_float.to(s_param_float.device)
                 tmp = (s_param_float - param_float)
                 # tmp will be a new tensor so we can do in-place
                 tmp.mul_(one_minus_decay)
@@ -149,7 +311,134 @@ class ExponentialMovingAverage:
                 
                 if update_param and param.dtype != torch.float32:
                     copy_stochastic(param, param_float)
-                
+
+    def _update_group(self, group: EMAParamGroup, parameters: List[torch.nn.Parameter], one_minus_decay: float):
+        update_param = self.use_feedback or self.param_multiplier != 1.0
+        for start, end, flat_start, flat_end in group.chunks:
+            s_flat = group.flat[flat_start:flat_end]
+            params = [parameters[idx] for idx in group.indices[start:end]]
+            can_foreach = not update_param and s_flat.dtype == torch.float32 and all([
+                p.dtype == torch.float32 and p.device == s_flat.device for p in params
+            ])
+            if can_foreach:
+                # no scratch memory needed, lerp straight into the shadow views
+                shadows = [self.shadow_params[idx] for idx in group.indices[start:end]]
+                torch._foreach_lerp_(shadows, [p.detach() for p in params], one_minus_decay)
+                continue
+
+            param_flat = torch.cat([p.detach().reshape(-1) for p in params]).to(
+                device=s_flat.device, dtype=torch.float32
+            )
+            s_flat_float = s_flat if s_flat.dtype == torch.float32 else s_flat.to(torch.float32)
+            if self.use_feedback:
+                tmp = (s_flat_float - param_flat)
+                tmp.mul_(one_minus_decay)
+                s_flat_float.sub_(tmp)
+                param_flat.add_(tmp)
+                del tmp
+            else:
+                s_flat_float.lerp_(param_flat, one_minus_decay)
+            if self.param_multiplier != 1.0:
+                param_flat.mul_(self.param_multiplier)
+
+            if s_flat.dtype != torch.float32:
+                # stochastic rounding for the whole chunk at once
+                copy_stochastic(s_flat, s_flat_float)
+
+            if update_param:
+                offset = 0
+                for param in params:
+                    numel = param.numel()
+                    param_float = param_flat[offset:offset + numel].view(param.shape)
+                    if param.dtype != torch.float32:
+                        copy_stochastic(param.data, param_float.to(param.device))
+                    else:
+                        param.data.copy_(param_float)
+                    offset += numel
+            del param_flat, s_flat_float
+
+    def _update_group_offloaded(
+            self,
+            group: EMAParamGroup,
+            parameters: List[torch.nn.Parameter],
+            one_minus_decay: float
+    ):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.num_offload_workers)
+        first_param = parameters[group.indices[0]]
+        use_stream = first_param.device.type == 'cuda'
+        if use_stream:
+            if self.copy_stream is None:
+                self.copy_stream = torch.cuda.Stream(device=first_param.device)
+            # the copies read the params written by the optimizer step
+            self.copy_stream.wait_stream(torch.cuda.current_stream(first_param.device))
+        staging_buffers = self.staging_buffers[group.param_dtype]
+        staging_futures = self.staging_futures[group.param_dtype]
+        for start, end, flat_start, flat_end in group.chunks:
+            event = None
+            ring_idx = self.staging_idx % len(staging_buffers)
+            self.staging_idx += 1
+            if staging_futures[ring_idx] is not None:
+                # the buffer is free once the update reading it is done
+                staging_futures[ring_idx].result()
+            staging_flat = staging_buffers[ring_idx][:flat_end - flat_start]
+            offset = 0
+            with torch.cuda.stream(self.copy_stream) if use_stream else contextlib.nullcontext():
+                for idx in group.indices[start:end]:
+                    param = parameters[idx]
+                    numel = param.numel()
+                    staging = staging_flat[offset:offset + numel].view(param.shape)
+                    staging.copy_(param.detach(), non_blocking=use_stream)
+                    offset += numel
+                if use_stream:
+                    event = torch.cuda.Event()
+                    event.record(self.copy_stream)
+                    self.transfer_events.append(event)
+            future = self.executor.submit(
+                self._lerp_offloaded_chunk,
+                group.flat[flat_start:flat_end],
+                staging_flat,
+                one_minus_decay,
+                event
+            )
+            staging_futures[ring_idx] = future
+            self.pending_updates.append(future)
+
+    @staticmethod
+    def _lerp_offloaded_chunk(
+            s_flat: torch.Tensor,
+            staging: torch.Tensor,
+            one_minus_decay: float,
+            event=None
+    ):
+        # runs on a worker thread once the chunk is on the host
+        if event is not None:
+            event.synchronize()
+        with torch.no_grad():
+            param_flat = staging.to(torch.float32)
+            s_flat_float = s_flat if s_flat.dtype == torch.float32 else s_flat.to(torch.float32)
+            s_flat_float.lerp_(param_flat, one_minus_decay)
+            if s_flat.dtype != torch.float32:
+                copy_stochastic(s_flat, s_flat_float)
+
+    def wait_for_transfer(self):
+        """
+        Makes the current stream wait until the live params have been copied to the host. Call it before the
+        optimizer changes the params again. Does not block the cpu.
+        """
+        for event in self.transfer_events:
+            torch.cuda.current_stream().wait_event(event)
+        self.transfer_events = []
+
+    def wait(self):
+        """
+        Blocks until the offloaded update has finished.
+        """
+        for future in self.pending_updates:
+            future.result()
+        self.pending_updates = []
+        self.transfer_events = []
+
 
     def copy_to(
             self,
@@ -164,6 +453,7 @@ class ExponentialMovingAverage:
                 parameters with which this `ExponentialMovingAverage` was
                 initialized will be used.
         """
+        self.wait()
         parameters = self._get_parameters(parameters)
         for s_param, param in zip(self.shadow_params, parameters):
             param.data.copy_(s_param.data)
@@ -181,10 +471,17 @@ class ExponentialMovingAverage:
                 `ExponentialMovingAverage` was initialized will be used.
         """
         parameters = self._get_parameters(parameters)
-        self.collected_params = [
-            param.clone()
-            for param in parameters
-        ]
+        if self.offload_to_cpu:
+            # keep the device free, the stored params go to the host too
+            self.collected_params = [
+                param.detach().to('cpu', copy=True)
+                for param in parameters
+            ]
+        else:
+            self.collected_params = [
+                param.clone()
+                for param in parameters
+            ]
 
     def restore(
             self,
@@ -208,6 +505,7 @@ class ExponentialMovingAverage:
                 "This ExponentialMovingAverage has no `store()`ed weights "
                 "to `restore()`"
             )
+        self.wait()
         parameters = self._get_parameters(parameters)
         for c_param, param in zip(self.collected_params, parameters):
             param.data.copy_(c_param.data)
@@ -250,6 +548,7 @@ class ExponentialMovingAverage:
             device: like `device` argument to `torch.Tensor.to`
         """
         # .to() on the tensors handles None correctly
+        self.wait()
         self.shadow_params = [
             p.to(device=device, dtype=dtype)
             if p.is_floating_point()
@@ -263,6 +562,7 @@ class ExponentialMovingAverage:
                 else p.to(device=device)
                 for p in self.collected_params
             ]
+        self._build_groups()
         return
 
     def state_dict(self) -> dict:
@@ -270,6 +570,7 @@ class ExponentialMovingAverage:
         # Following PyTorch conventions, references to tensors are returned:
         # "returns a reference to the state and not its copy!" -
         # https://pytorch.org/tutorials/beginner/saving_loading_models.html#what-is-a-state-dict
+        self.wait()
         return {
             "decay": self.decay,
             "num_updates": self.num_updates,
@@ -285,6 +586,7 @@ class ExponentialMovingAverage:
                 from a call to :meth:`state_dict`.
         """
         # deepcopy, to be consistent with module API
+        self.wait()
         state_dict = copy.deepcopy(state_dict)
         self.decay = state_dict["decay"]
         if self.decay < 0.0 or self.decay > 1.0:
@@ -319,18 +621,21 @@ class ExponentialMovingAverage:
             if not any(p is None for p in params):
                 # ^ parameter references are still good
                 for i, p in enumerate(params):
+                    # offloaded shadows stay on the host
+                    device = 'cpu' if self.offload_to_cpu else p.device
                     self.shadow_params[i] = self.shadow_params[i].to(
-                        device=p.device, dtype=p.dtype
+                        device=device, dtype=self._get_shadow_dtype(p)
                     )
                     if self.collected_params is not None:
                         self.collected_params[i] = self.collected_params[i].to(
-                            device=p.device, dtype=p.dtype
+                            device=device, dtype=p.dtype
                         )
         else:
             raise ValueError(
                 "Tried to `load_state_dict()` with the wrong number of "
                 "parameters in the saved state."
             )
+        self._build_groups()
 
     def eval(self):
         if self._is_train_mode:
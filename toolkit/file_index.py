@@ -0,0 +1,119 @@
+import sys
+from typing import List, TYPE_CHECKING, Union
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from toolkit.data_transfer_object.data_loader import FileItemDTO
+
+
+class FileIndex:
+    """
+    Columnar index over the entries of a dataset. An entry is a file item times num_repeats, repeats are
+    not materialized, entry idx maps to file item idx % num_items. Sizes and flips are stored per file item,
+    the scale and crop each entry got from bucketing are stored per entry.
+    """
+
+    def __init__(self, file_list: List['FileItemDTO'], num_repeats: int = 1):
+        self.num_items = len(file_list)
+        self.num_repeats = max(1, num_repeats)
+        num_entries = self.num_items * self.num_repeats
+
+        # per file item
+        self.paths: List[str] = [sys.intern(file_item.path) for file_item in file_list]
+        self.width = np.array([file_item.width for file_item in file_list], dtype=np.int32)
+        self.height = np.array([file_item.height for file_item in file_list], dtype=np.int32)
+        self.flip_x = np.array([file_item.flip_x for file_item in file_list], dtype=bool)
+        self.flip_y = np.array([file_item.flip_y for file_item in file_list], dtype=bool)
+
+        # per entry, start with what the file items were created with
+        def per_entry(values):
+            return np.tile(np.array(values, dtype=np.int32), self.num_repeats)
+
+        self.scale_to_width = per_entry([file_item.scale_to_width for file_item in file_list])
+        self.scale_to_height = per_entry([file_item.scale_to_height for file_item in file_list])
+        self.crop_x = per_entry([file_item.crop_x for file_item in file_list])
+        self.crop_y = per_entry([file_item.crop_y for file_item in file_list])
+        self.crop_width = per_entry([file_item.crop_width for file_item in file_list])
+        self.crop_height = per_entry([file_item.crop_height for file_item in file_list])
+        self.bucket_id = np.full(num_entries, -1, dtype=np.int32)
+        # filled in when latents are cached so we only hash once per entry
+        self.latent_paths: List[Union[str, None]] = [None] * num_entries
+
+    def __len__(self):
+        return self.num_items * self.num_repeats
+
+    def get_item_idx(self, index: int) -> int:
+        return index % self.num_items
+
+    @property
+    def item_idx(self) -> np.ndarray:
+        return np.arange(len(self), dtype=np.int64) % self.num_items
+
+    @property
+    def entry_width(self) -> np.ndarray:
+        return self.width[self.item_idx]
+
+    @property
+    def entry_height(self) -> np.ndarray:
+        return self.height[self.item_idx]
+
+    def set_entry(
+            self,
+            index: int,
+            scale_to_width: int,
+            scale_to_height: int,
+            crop_x: int,
+            crop_y: int,
+            crop_width: int,
+            crop_height: int,
+    ):
+        changed = (
+            self.scale_to_width[index] != scale_to_width or self.scale_to_height[index] != scale_to_height or
+            self.crop_x[index] != crop_x or self.crop_y[index] != crop_y or
+            self.crop_width[index] != crop_width or self.crop_height[index] != crop_height
+        )
+        self.scale_to_width[index] = scale_to_width
+        self.scale_to_height[index] = scale_to_height
+        self.crop_x[index] = crop_x
+        self.crop_y[index] = crop_y
+        self.crop_width[index] = crop_width
+        self.crop_height[index] = crop_height
+        if changed:
+            # crop changed, latent path has to be recalculated
+            self.latent_paths[index] = None
+
+    def set_entries(
+            self,
+            idxs: np.ndarray,
+            scale_to_width: np.ndarray,
+            scale_to_height: np.ndarray,
+            crop_x: np.ndarray,
+            crop_y: np.ndarray,
+            crop_width: np.ndarray,
+            crop_height: np.ndarray,
+    ):
+        # vectorized set_entry
+        changed = (
+            (self.scale_to_width[idxs] != scale_to_width) | (self.scale_to_height[idxs] != scale_to_height) |
+            (self.crop_x[idxs] != crop_x) | (self.crop_y[idxs] != crop_y) |
+            (self.crop_width[idxs] != crop_width) | (self.crop_height[idxs] != crop_height)
+        )
+        self.scale_to_width[idxs] = scale_to_width
+        self.scale_to_height[idxs] = scale_to_height
+        self.crop_x[idxs] = crop_x
+        self.crop_y[idxs] = crop_y
+        self.crop_width[idxs] = crop_width
+        self.crop_height[idxs] = crop_height
+        # only entries whose crop changed need their latent path recalculated
+        for idx in np.asarray(idxs)[np.asarray(changed)].tolist():
+            self.latent_paths[idx] = None
+
+    def apply_to_file_item(self, index: int, file_item: 'FileItemDTO'):
+        file_item.scale_to_width = int(self.scale_to_width[index])
+        file_item.scale_to_height = int(self.scale_to_height[index])
+        file_item.crop_x = int(self.crop_x[index])
+        file_item.crop_y = int(self.crop_y[index])
+        file_item.crop_width = int(self.crop_width[index])
+        file_item.crop_height = int(self.crop_height[index])
+        file_item._latent_path = self.latent_paths[index]
@@ -4,6 +4,7 @@ import collections
 import json
 import os
 import io
+import re
 import struct
 import threading
 from typing import TYPE_CHECKING
@@ -265,6 +266,201 @@ def get_image_metadata_from_bytesio(input, size, file_path=None):
                  height=height)
 
 
+# exif orientations that rotate the image by 90 degrees, width and height are swapped after exif_transpose
+EXIF_ORIENTATION_TAG = 0x0112
+TRANSPOSED_EXIF_ORIENTATIONS = (5, 6, 7, 8)
+XMP_ORIENTATION_RE = re.compile(rb'tiff:Orientation(?:="|>)([0-9])')
+
+
+def _get_exif_orientation(exif: bytes):
+    # returns the orientation tag from IFD0 of raw exif (tiff) data or None if it is not there
+    if exif.startswith(b'Exif\x00\x00'):
+        exif = exif[6:]
+    if len(exif) < 8:
+        return None
+    if exif[:2] == b'II':
+        endian = '<'
+    elif exif[:2] == b'MM':
+        endian = '>'
+    else:
+        return None
+    ifd_offset = struct.unpack(endian + 'L', exif[4:8])[0]
+    if ifd_offset + 2 > len(exif):
+        return None
+    num_entries = struct.unpack(endian + 'H', exif[ifd_offset:ifd_offset + 2])[0]
+    for i in range(num_entries):
+        entry_offset = ifd_offset + 2 + i * 12
+        if entry_offset + 12 > len(exif):
+            break
+        tag = struct.unpack(endian + 'H', exif[entry_offset:entry_offset + 2])[0]
+        if tag == EXIF_ORIENTATION_TAG:
+            return struct.unpack(endian + 'H', exif[entry_offset + 8:entry_offset + 10])[0]
+    return None
+
+
+def _get_xmp_orientation(xmp: bytes):
+    # same lookup pillow does when exif has no orientation
+    match = XMP_ORIENTATION_RE.search(xmp)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def _get_jpeg_size_and_orientation(input):
+    exif_orientation = None
+    xmp_orientation = None
+    input.seek(2)
+    while True:
+        b = input.read(1)
+        if not b:
+            raise UnknownImageFormat("Reached end of JPEG before finding the frame header")
+        if b != b'\xff':
+            continue
+        marker = input.read(1)
+        while marker == b'\xff':
+            marker = input.read(1)
+        if not marker:
+            raise UnknownImageFormat("Reached end of JPEG before finding the frame header")
+        marker = ord(marker)
+        if marker == 0x01 or marker == 0xD8 or 0xD0 <= marker <= 0xD7:
+            # markers without a length
+            continue
+        if marker == 0xD9 or marker == 0xDA:
+            raise UnknownImageFormat("JPEG has no frame header before scan data")
+        length = struct.unpack(">H", input.read(2))[0]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            # start of frame
+            h, w = struct.unpack(">HH", input.read(5)[1:5])
+            orientation = exif_orientation if exif_orientation is not None else xmp_orientation
+            return int(w), int(h), orientation
+        if marker == 0xE1:
+            data = input.read(length - 2)
+            if data.startswith(b'Exif\x00\x00'):
+                if exif_orientation is None:
+                    exif_orientation = _get_exif_orientation(data)
+            elif data.startswith(b'http://ns.adobe.com/xap/1.0/\x00'):
+                if xmp_orientation is None:
+                    xmp_orientation = _get_xmp_orientation(data)
+        else:
+            input.seek(length - 2, 1)
+
+
+def _get_png_size_and_orientation(input, size):
+    input.seek(8)
+    width = None
+    height = None
+    exif_orientation = None
+    xmp_orientation = None
+    # walk the chunks, only reading the small ones we care about and seeking past the pixel data
+    while input.tell() + 8 <= size:
+        length, chunk_type = struct.unpack(">L4s", input.read(8))
+        if chunk_type == b'IHDR':
+            width, height = struct.unpack(">LL", input.read(8))
+            input.seek(length - 8 + 4, 1)
+        elif chunk_type == b'eXIf':
+            exif_orientation = _get_exif_orientation(input.read(length))
+            input.seek(4, 1)
+        elif chunk_type in (b'iTXt', b'tEXt', b'zTXt'):
+            data = input.read(length)
+            input.seek(4, 1)
+            if data.startswith(b'XML:com.adobe.xmp\x00'):
+                xmp_orientation = _get_xmp_orientation(data)
+            elif data.startswith(b'Raw profile type exif\x00'):
+                # hex encoded exif in a text chunk, let pillow handle it
+                raise UnknownImageFormat("PNG has exif in a text chunk")
+        elif chunk_type == b'IEND':
+            break
+        else:
+            input.seek(length + 4, 1)
+    if width is None:
+        raise UnknownImageFormat("PNG has no IHDR chunk")
+    orientation = exif_orientation if exif_orientation is not None else xmp_orientation
+    return int(width), int(height), orientation
+
+
+def _get_webp_size_and_orientation(input, size):
+    input.seek(12)
+    width = None
+    height = None
+    exif_orientation = None
+    xmp_orientation = None
+    while input.tell() + 8 <= size:
+        chunk_type, length = struct.unpack("<4sL", input.read(8))
+        # chunks are padded to an even size
+        padded_length = length + (length & 1)
+        if chunk_type == b'VP8X':
+            data = input.read(10)
+            width = 1 + int.from_bytes(data[4:7], 'little')
+            height = 1 + int.from_bytes(data[7:10], 'little')
+            input.seek(padded_length - 10, 1)
+        elif chunk_type == b'VP8 ' and width is None:
+            data = input.read(10)
+            if data[3:6] != b'\x9d\x01\x2a':
+                raise UnknownImageFormat("Bad VP8 frame header")
+            w, h = struct.unpack("<HH", data[6:10])
+            width = w & 0x3fff
+            height = h & 0x3fff
+            input.seek(padded_length - 10, 1)
+        elif chunk_type == b'VP8L' and width is None:
+            data = input.read(5)
+            if data[0] != 0x2f:
+                raise UnknownImageFormat("Bad VP8L signature")
+            bits = int.from_bytes(data[1:5], 'little')
+            width = (bits & 0x3fff) + 1
+            height = ((bits >> 14) & 0x3fff) + 1
+            input.seek(padded_length - 5, 1)
+        elif chunk_type == b'EXIF':
+            exif_orientation = _get_exif_orientation(input.read(length))
+            input.seek(padded_length - length, 1)
+        elif chunk_type == b'XMP ':
+            xmp_orientation = _get_xmp_orientation(input.read(length))
+            input.seek(padded_length - length, 1)
+        else:
+            input.seek(padded_length, 1)
+    if width is None:
+        raise UnknownImageFormat("WebP has no image chunk")
+    orientation = exif_orientation if exif_orientation is not None else xmp_orientation
+    return width, height, orientation
+
+
+def get_exif_transposed_image_size(file_path):
+    """
+    Return (width, height) of an image as it will be after exif_transpose, only reading the
+    headers. Supports JPEG, PNG and WebP, raises UnknownImageFormat for anything else.
+    """
+    size = os.path.getsize(file_path)
+    with io.open(file_path, "rb") as input:
+        data = input.read(16)
+        try:
+            if data.startswith(b'\377\330'):
+                width, height, orientation = _get_jpeg_size_and_orientation(input)
+            elif data.startswith(b'\211PNG\r\n\032\n'):
+                width, height, orientation = _get_png_size_and_orientation(input, size)
+            elif data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+                width, height, orientation = _get_webp_size_and_orientation(input, size)
+            else:
+                raise UnknownImageFormat(FILE_UNKNOWN)
+        except (struct.error, IndexError, ValueError) as e:
+            raise UnknownImageFormat(e.__class__.__name__ + " raised while reading image header")
+    if orientation in TRANSPOSED_EXIF_ORIENTATIONS:
+        width, height = height, width
+    return width, height
+
+
+def probe_image_size(file_path):
+    """
+    Return (width, height) of an image after exif_transpose. Reads the header when possible and
+    falls back to opening the image with PIL. Safe to run in a process pool.
+    """
+    try:
+        return get_exif_transposed_image_size(file_path)
+    except UnknownImageFormat:
+        from PIL import Image as PILImage
+        from PIL.ImageOps import exif_transpose
+        with PILImage.open(file_path) as img:
+            return exif_transpose(img).size
+
+
 import unittest
 
 
@@ -0,0 +1,155 @@
+import json
+import mmap
+import os
+import threading
+from typing import Dict, List, Tuple, Union
+
+import torch
+
+# bump this if the shard layout changes to invalidate old stores
+LATENT_STORE_VERSION = 1
+SHARD_INDEX_FILENAME = 'shard_index.json'
+# tensor data is aligned to this many bytes inside a shard
+SHARD_ALIGNMENT = 64
+
+
+def _dtype_to_str(dtype: torch.dtype) -> str:
+    return str(dtype).replace('torch.', '')
+
+
+def _str_to_dtype(dtype_str: str) -> torch.dtype:
+    return getattr(torch, dtype_str)
+
+
+class ShardedLatentStore:
+    """
+    Stores cached latents for a folder as a few large shard files plus a json index instead of one
+    safetensors file per image. Keys are the latent file names without extension ({filename}_{hash}).
+    Reads are zero copy tensors over a memory map of the shard.
+    """
+
+    def __init__(self, latent_dir: str, max_shard_size_mb: int = 1024):
+        self.latent_dir = latent_dir
+        self.max_shard_size = max_shard_size_mb * 1024 * 1024
+        self.index_path = os.path.join(latent_dir, SHARD_INDEX_FILENAME)
+        # key -> (shard_idx, offset, shape, dtype)
+        self.index: Dict[str, Tuple[int, int, List[int], str]] = {}
+        self.num_shards = 0
+        self._lock = threading.Lock()
+        self._mmaps: Dict[int, mmap.mmap] = {}
+        self._is_dirty = False
+        self.load_index()
+
+    def __getstate__(self):
+        # memory maps and locks cannot be sent to dataloader workers, they are reopened lazily
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        state['_mmaps'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __deepcopy__(self, memo):
+        # file items get deep copied every step, they should all share the same store
+        return self
+
+    def get_shard_path(self, shard_idx: int) -> str:
+        return os.path.join(self.latent_dir, f'shard_{shard_idx:05d}.bin')
+
+    def load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, 'r') as f:
+                data = json.load(f)
+            if data.get('__version__', None) != LATENT_STORE_VERSION:
+                print(f"Latent shard index version mismatch, ignoring: {self.index_path}")
+                return
+            self.index = {key: tuple(value) for key, value in data['index'].items()}
+            self.num_shards = data['num_shards']
+        except Exception as e:
+            print(f"Error loading latent shard index: {self.index_path}")
+            print(e)
+            self.index = {}
+            self.num_shards = 0
+
+    def save_index(self):
+        with self._lock:
+            if not self._is_dirty:
+                return
+            os.makedirs(self.latent_dir, exist_ok=True)
+            data = {
+                '__version__': LATENT_STORE_VERSION,
+                'num_shards': self.num_shards,
+                'index': self.index,
+            }
+            # write to a temp file first so a crash does not leave a broken index
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.index_path)
+            self._is_dirty = False
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def put(self, key: str, tensor: torch.Tensor):
+        tensor = tensor.detach().to('cpu').contiguous()
+        data = tensor.view(-1).view(torch.uint8).numpy().tobytes()
+        with self._lock:
+            os.makedirs(self.latent_dir, exist_ok=True)
+            shard_idx = max(self.num_shards - 1, 0)
+            shard_path = self.get_shard_path(shard_idx)
+            shard_size = os.path.getsize(shard_path) if os.path.exists(shard_path) else 0
+            if shard_size > 0 and shard_size + len(data) > self.max_shard_size:
+                # start a new shard
+                shard_idx += 1
+                shard_path = self.get_shard_path(shard_idx)
+                shard_size = 0
+            padding = (SHARD_ALIGNMENT - shard_size % SHARD_ALIGNMENT) % SHARD_ALIGNMENT
+            with open(shard_path, 'ab') as f:
+                if padding > 0:
+                    f.write(b'\0' * padding)
+                f.write(data)
+            self.num_shards = max(self.num_shards, shard_idx + 1)
+            self.index[key] = (shard_idx, shard_size + padding, list(tensor.shape), _dtype_to_str(tensor.dtype))
+            self._is_dirty = True
+
+    def _get_mmap(self, shard_idx: int, min_size: int) -> mmap.mmap:
+        mm = self._mmaps.get(shard_idx, None)
+        if mm is None or len(mm) < min_size:
+            # the shard grew since we mapped it, remap it
+            with open(self.get_shard_path(shard_idx), 'rb') as f:
+                # copy on write so torch gets a writable buffer without copying the data
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            self._mmaps[shard_idx] = mm
+        return mm
+
+    def get(self, key: str) -> Union[torch.Tensor, None]:
+        if key not in self.index:
+            return None
+        shard_idx, offset, shape, dtype_str = self.index[key]
+        dtype = _str_to_dtype(dtype_str)
+        numel = 1
+        for dim in shape:
+            numel *= dim
+        num_bytes = numel * torch.tensor([], dtype=dtype).element_size()
+        mm = self._get_mmap(shard_idx, offset + num_bytes)
+        tensor = torch.frombuffer(mm, dtype=dtype, count=numel, offset=offset)
+        return tensor.view(shape)
+
+
+# one store per latent folder per process
+_latent_stores: Dict[str, ShardedLatentStore] = {}
+
+
+def get_sharded_latent_store(latent_dir: str) -> ShardedLatentStore:
+    latent_dir = os.path.abspath(latent_dir)
+    if latent_dir not in _latent_stores:
+        _latent_stores[latent_dir] = ShardedLatentStore(latent_dir)
+    return _latent_stores[latent_dir]
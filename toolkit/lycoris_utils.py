@@ -12,6 +12,10 @@ import torch.linalg as linalg
 
 from tqdm import tqdm
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+if TYPE_CHECKING:
+    from toolkit.safetensors_stream import LazySafetensors
 
 
 def make_sparse(t: torch.Tensor, sparsity=0.95):
@@ -22,18 +26,7 @@ def make_sparse(t: torch.Tensor, sparsity=0.95):
     return sparse_t
 
 
-def extract_conv(
-        weight: Union[torch.Tensor, nn.Parameter],
-        mode='fixed',
-        mode_param=0,
-        device='cpu',
-        is_cp=False,
-) -> Tuple[nn.Parameter, nn.Parameter]:
-    weight = weight.to(device)
-    out_ch, in_ch, kernel_size, _ = weight.shape
-
-    U, S, Vh = linalg.svd(weight.reshape(out_ch, -1))
-
+def get_lora_rank(S: torch.Tensor, mode='fixed', mode_param=0, out_ch=None, in_ch=None) -> int:
     if mode == 'fixed':
         lora_rank = mode_param
     elif mode == 'threshold':
@@ -51,7 +44,22 @@ def extract_conv(
     else:
         raise NotImplementedError('Extract mode should be "fixed", "threshold", "ratio" or "quantile"')
     lora_rank = max(1, lora_rank)
-    lora_rank = min(out_ch, in_ch, lora_rank)
+    return int(min(out_ch, in_ch, lora_rank))
+
+
+def extract_conv(
+        weight: Union[torch.Tensor, nn.Parameter],
+        mode='fixed',
+        mode_param=0,
+        device='cpu',
+        is_cp=False,
+) -> Tuple[nn.Parameter, nn.Parameter]:
+    weight = weight.to(device)
+    out_ch, in_ch, kernel_size, _ = weight.shape
+
+    U, S, Vh = linalg.svd(weight.reshape(out_ch, -1))
+
+    lora_rank = get_lora_rank(S, mode, mode_param, out_ch, in_ch)
     if lora_rank >= out_ch / 2 and not is_cp:
         return weight, 'full'
 
@@ -78,24 +86,7 @@ def extract_linear(
 
     U, S, Vh = linalg.svd(weight)
 
-    if mode == 'fixed':
-        lora_rank = mode_param
-    elif mode == 'threshold':
-        assert mode_param >= 0
-        lora_rank = torch.sum(S > mode_param)
-    elif mode == 'ratio':
-        assert 1 >= mode_param >= 0
-        min_s = torch.max(S) * mode_param
-        lora_rank = torch.sum(S > min_s)
-    elif mode == 'quantile' or mode == 'percentile':
-        assert 1 >= mode_param >= 0
-        s_cum = torch.cumsum(S, dim=0)
-        min_cum_sum = mode_param * torch.sum(S)
-        lora_rank = torch.sum(s_cum < min_cum_sum)
-    else:
-        raise NotImplementedError('Extract mode should be "fixed", "threshold", "ratio" or "quantile"')
-    lora_rank = max(1, lora_rank)
-    lora_rank = min(out_ch, in_ch, lora_rank)
+    lora_rank = get_lora_rank(S, mode, mode_param, out_ch, in_ch)
     if lora_rank >= out_ch / 2:
         return weight, 'full'
 
@@ -111,6 +102,169 @@ def extract_linear(
     return (extract_weight_A, extract_weight_B, diff), 'low rank'
 
 
+class ExtractLayer:
+    # a layer to extract from the difference of its weight to the base weight
+    def __init__(
+            self,
+            lora_name: str,
+            weight: torch.Tensor,
+            base_weight: torch.Tensor,
+            mode_param=0,
+    ):
+        self.lora_name = lora_name
+        self.weight = weight
+        self.base_weight = base_weight
+        self.mode_param = mode_param
+        self.is_conv = len(weight.shape) == 4
+        self.is_linear = not self.is_conv or (weight.shape[2] == 1 and weight.shape[3] == 1)
+
+
+@torch.no_grad()
+def extract_layer_chunk(
+        layers: List[ExtractLayer],
+        mode='fixed',
+        device='cpu',
+        use_bias=False,
+        sparsity=0.98,
+        small_conv=True,
+        use_lowrank_svd=True,
+        lowrank_niter=4,
+) -> List[Dict[str, torch.Tensor]]:
+    # extracts layers with the same shape and mode param, with one batched svd
+    results = [{} for _ in layers]
+    to_decompose = []
+    for idx, layer in enumerate(layers):
+        if torch.allclose(layer.weight, layer.base_weight):
+            continue
+        diff = (layer.weight - layer.base_weight).to(device)
+        out_ch, in_ch = diff.shape[0], diff.shape[1]
+        if mode == 'fixed' and min(out_ch, in_ch, max(1, int(layer.mode_param))) >= out_ch / 2:
+            # would be full anyway, skip the svd
+            results[idx][f'{layer.lora_name}.diff'] = diff.detach().cpu().contiguous().half()
+            continue
+        to_decompose.append((idx, diff))
+    if len(to_decompose) == 0:
+        return results
+
+    matrices = torch.stack([diff.reshape(diff.shape[0], -1).float() for _, diff in to_decompose])
+    out_ch, in_ch = to_decompose[0][1].shape[0], to_decompose[0][1].shape[1]
+    if mode == 'fixed' and use_lowrank_svd:
+        # only the top ranks are needed, a randomized svd gets them without the full decomposition
+        fixed_rank = min(out_ch, in_ch, max(1, int(layers[0].mode_param)))
+        q = min(fixed_rank + 8, matrices.shape[1], matrices.shape[2])
+        U, S, V = torch.svd_lowrank(matrices, q=q, niter=lowrank_niter)
+        Vh = V.transpose(1, 2)
+    else:
+        U, S, Vh = linalg.svd(matrices, full_matrices=False)
+    del matrices
+
+    for batch_idx, (idx, diff) in enumerate(to_decompose):
+        layer = layers[idx]
+        loras = results[idx]
+        lora_name = layer.lora_name
+        lora_rank = get_lora_rank(S[batch_idx], mode, layer.mode_param, out_ch, in_ch)
+        if lora_rank >= out_ch / 2:
+            loras[f'{lora_name}.diff'] = diff.detach().cpu().contiguous().half()
+            continue
+
+        up = U[batch_idx, :, :lora_rank] * S[batch_idx, :lora_rank]
+        down = Vh[batch_idx, :lora_rank, :]
+        if layer.is_conv:
+            extract_a = down.reshape(lora_rank, *diff.shape[1:])
+            extract_b = up.reshape(out_ch, lora_rank, 1, 1)
+        else:
+            extract_a = down
+            extract_b = up
+        bias_diff = None
+        if use_bias:
+            bias_diff = diff - (up @ down).reshape(diff.shape).to(diff.dtype)
+
+        if small_conv and layer.is_conv and not layer.is_linear:
+            dim = extract_a.size(0)
+            (extract_c, extract_a, _), _ = extract_conv(
+                extract_a.transpose(0, 1),
+                'fixed', dim,
+                device, True
+            )
+            extract_a = extract_a.transpose(0, 1)
+            extract_c = extract_c.transpose(0, 1)
+            loras[f'{lora_name}.lora_mid.weight'] = extract_c.detach().cpu().contiguous().half()
+            if use_bias:
+                bias_diff = layer.weight - torch.einsum(
+                    'i j k l, j r, p i -> p r k l',
+                    extract_c, extract_a.flatten(1, -1), extract_b.flatten(1, -1)
+                ).detach().cpu().contiguous()
+            del extract_c
+
+        loras[f'{lora_name}.lora_down.weight'] = extract_a.detach().cpu().contiguous().half()
+        loras[f'{lora_name}.lora_up.weight'] = extract_b.detach().cpu().contiguous().half()
+        loras[f'{lora_name}.alpha'] = torch.Tensor([extract_a.shape[0]]).half()
+        if use_bias:
+            bias_diff = bias_diff.detach().cpu().reshape(extract_b.size(0), -1)
+            sparse_diff = make_sparse(bias_diff, sparsity).to_sparse().coalesce()
+
+            indices = sparse_diff.indices().to(torch.int16)
+            values = sparse_diff.values().half()
+            loras[f'{lora_name}.bias_indices'] = indices
+            loras[f'{lora_name}.bias_values'] = values
+            loras[f'{lora_name}.bias_size'] = torch.tensor(bias_diff.shape).to(torch.int16)
+        del extract_a, extract_b, bias_diff
+    del U, S, Vh
+    return results
+
+
+def extract_layers(
+        layers: List[ExtractLayer],
+        mode='fixed',
+        device='cpu',
+        use_bias=False,
+        sparsity=0.98,
+        small_conv=True,
+        use_lowrank_svd=True,
+        num_workers=4,
+        max_chunk_bytes=512 * 1024 * 1024,
+) -> Dict[str, torch.Tensor]:
+    # layers with the same shape go through svd together, chunks run on a thread pool (torch releases the gil
+    # in the decompositions). Each chunk hands back small fp16 tensors and frees its float32 work right away
+    groups = OrderedDict()
+    for idx, layer in enumerate(layers):
+        key = (tuple(layer.weight.shape), layer.mode_param)
+        if key not in groups:
+            groups[key] = []
+        groups[key].append(idx)
+
+    chunks = []
+    for (shape, _), idxs in groups.items():
+        chunk_size = max(1, max_chunk_bytes // (int(np.prod(shape)) * 4))
+        for i in range(0, len(idxs), chunk_size):
+            chunks.append(idxs[i:i + chunk_size])
+
+    results: List[Dict[str, torch.Tensor]] = [{} for _ in layers]
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        futures = {}
+        for chunk in chunks:
+            future = executor.submit(
+                extract_layer_chunk,
+                [layers[idx] for idx in chunk],
+                mode=mode,
+                device=device,
+                use_bias=use_bias,
+                sparsity=sparsity,
+                small_conv=small_conv,
+                use_lowrank_svd=use_lowrank_svd,
+            )
+            futures[future] = chunk
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            for idx, result in zip(futures[future], future.result()):
+                results[idx] = result
+
+    # same order as the layers
+    loras = {}
+    for result in results:
+        loras.update(result)
+    return loras
+
+
 def extract_diff(
         base_model,
         db_model,
@@ -124,6 +278,8 @@ def extract_diff(
         linear_only=False,
         extract_unet=True,
         extract_text_encoder=True,
+        use_lowrank_svd=True,
+        num_workers=4,
 ):
     meta = OrderedDict()
 
@@ -180,145 +336,55 @@ def extract_diff(
             elif name in target_replace_names:
                 temp_name[name] = module.weight
 
-        for name, module in tqdm(list(target_module.named_modules())):
+        layers: List[ExtractLayer] = []
+        for name, module in target_module.named_modules():
             if name in temp:
                 weights = temp[name]
                 for child_name, child_module in module.named_modules():
                     lora_name = prefix + '.' + name + '.' + child_name
                     lora_name = lora_name.replace('.', '_')
                     layer = child_module.__class__.__name__
-                    if layer in {'Linear', 'LoRACompatibleLinear', 'Conv2d', 'LoRACompatibleConv'}:
-                        root_weight = child_module.weight
-                        if torch.allclose(root_weight, weights[child_name]):
-                            continue
-
                     if layer == 'Linear' or layer == 'LoRACompatibleLinear':
-                        weight, decompose_mode = extract_linear(
-                            (child_module.weight - weights[child_name]),
-                            mode,
-                            linear_mode_param,
-                            device=extract_device,
-                        )
-                        if decompose_mode == 'low rank':
-                            extract_a, extract_b, diff = weight
+                        layers.append(ExtractLayer(lora_name, child_module.weight, weights[child_name], linear_mode_param))
                     elif layer == 'Conv2d' or layer == 'LoRACompatibleConv':
                         is_linear = (child_module.weight.shape[2] == 1
                                      and child_module.weight.shape[3] == 1)
                         if not is_linear and linear_only:
                             continue
-                        weight, decompose_mode = extract_conv(
-                            (child_module.weight - weights[child_name]),
-                            mode,
-                            linear_mode_param if is_linear else conv_mode_param,
-                            device=extract_device,
-                        )
-                        if decompose_mode == 'low rank':
-                            extract_a, extract_b, diff = weight
-                        if small_conv and not is_linear and decompose_mode == 'low rank':
-                            dim = extract_a.size(0)
-                            (extract_c, extract_a, _), _ = extract_conv(
-                                extract_a.transpose(0, 1),
-                                'fixed', dim,
-                                extract_device, True
-                            )
-                            extract_a = extract_a.transpose(0, 1)
-                            extract_c = extract_c.transpose(0, 1)
-                            loras[f'{lora_name}.lora_mid.weight'] = extract_c.detach().cpu().contiguous().half()
-                            diff = child_module.weight - torch.einsum(
-                                'i j k l, j r, p i -> p r k l',
-                                extract_c, extract_a.flatten(1, -1), extract_b.flatten(1, -1)
-                            ).detach().cpu().contiguous()
-                            del extract_c
-                    else:
-                        continue
-                    if decompose_mode == 'low rank':
-                        loras[f'{lora_name}.lora_down.weight'] = extract_a.detach().cpu().contiguous().half()
-                        loras[f'{lora_name}.lora_up.weight'] = extract_b.detach().cpu().contiguous().half()
-                        loras[f'{lora_name}.alpha'] = torch.Tensor([extract_a.shape[0]]).half()
-                        if use_bias:
-                            diff = diff.detach().cpu().reshape(extract_b.size(0), -1)
-                            sparse_diff = make_sparse(diff, sparsity).to_sparse().coalesce()
-
-                            indices = sparse_diff.indices().to(torch.int16)
-                            values = sparse_diff.values().half()
-                            loras[f'{lora_name}.bias_indices'] = indices
-                            loras[f'{lora_name}.bias_values'] = values
-                            loras[f'{lora_name}.bias_size'] = torch.tensor(diff.shape).to(torch.int16)
-                        del extract_a, extract_b, diff
-                    elif decompose_mode == 'full':
-                        loras[f'{lora_name}.diff'] = weight.detach().cpu().contiguous().half()
-                    else:
-                        raise NotImplementedError
+                        layers.append(ExtractLayer(
+                            lora_name, child_module.weight, weights[child_name],
+                            linear_mode_param if is_linear else conv_mode_param
+                        ))
             elif name in temp_name:
                 weights = temp_name[name]
                 lora_name = prefix + '.' + name
                 lora_name = lora_name.replace('.', '_')
                 layer = module.__class__.__name__
 
-                if layer in {'Linear', 'LoRACompatibleLinear', 'Conv2d', 'LoRACompatibleConv'}:
-                    root_weight = module.weight
-                    if torch.allclose(root_weight, weights):
-                        continue
-
                 if layer == 'Linear' or layer == 'LoRACompatibleLinear':
-                    weight, decompose_mode = extract_linear(
-                        (root_weight - weights),
-                        mode,
-                        linear_mode_param,
-                        device=extract_device,
-                    )
-                    if decompose_mode == 'low rank':
-                        extract_a, extract_b, diff = weight
+                    layers.append(ExtractLayer(lora_name, module.weight, weights, linear_mode_param))
                 elif layer == 'Conv2d' or layer == 'LoRACompatibleConv':
                     is_linear = (
-                            root_weight.shape[2] == 1
-                            and root_weight.shape[3] == 1
+                            module.weight.shape[2] == 1
+                            and module.weight.shape[3] == 1
                     )
                     if not is_linear and linear_only:
                         continue
-                    weight, decompose_mode = extract_conv(
-                        (root_weight - weights),
-                        mode,
-                        linear_mode_param if is_linear else conv_mode_param,
-                        device=extract_device,
-                    )
-                    if decompose_mode == 'low rank':
-                        extract_a, extract_b, diff = weight
-                    if small_conv and not is_linear and decompose_mode == 'low rank':
-                        dim = extract_a.size(0)
-                        (extract_c, extract_a, _), _ = extract_conv(
-                            extract_a.transpose(0, 1),
-                            'fixed', dim,
-                            extract_device, True
-                        )
-                        extract_a = extract_a.transpose(0, 1)
-                        extract_c = extract_c.transpose(0, 1)
-                        loras[f'{lora_name}.lora_mid.weight'] = extract_c.detach().cpu().contiguous().half()
-                        diff = root_weight - torch.einsum(
-                            'i j k l, j r, p i -> p r k l',
-                            extract_c, extract_a.flatten(1, -1), extract_b.flatten(1, -1)
-                        ).detach().cpu().contiguous()
-                        del extract_c
-                else:
-                    continue
-                if decompose_mode == 'low rank':
-                    loras[f'{lora_name}.lora_down.weight'] = extract_a.detach().cpu().contiguous().half()
-                    loras[f'{lora_name}.lora_up.weight'] = extract_b.detach().cpu().contiguous().half()
-                    loras[f'{lora_name}.alpha'] = torch.Tensor([extract_a.shape[0]]).half()
-                    if use_bias:
-                        diff = diff.detach().cpu().reshape(extract_b.size(0), -1)
-                        sparse_diff = make_sparse(diff, sparsity).to_sparse().coalesce()
-
-                        indices = sparse_diff.indices().to(torch.int16)
-                        values = sparse_diff.values().half()
-                        loras[f'{lora_name}.bias_indices'] = indices
-                        loras[f'{lora_name}.bias_values'] = values
-                        loras[f'{lora_name}.bias_size'] = torch.tensor(diff.shape).to(torch.int16)
-                    del extract_a, extract_b, diff
-                elif decompose_mode == 'full':
-                    loras[f'{lora_name}.diff'] = weight.detach().cpu().contiguous().half()
-                else:
-                    raise NotImplementedError
+                    layers.append(ExtractLayer(
+                        lora_name, module.weight, weights,
+                        linear_mode_param if is_linear else conv_mode_param
+                    ))
+
+        loras = extract_layers(
+            layers,
+            mode=mode,
+            device=extract_device,
+            use_bias=use_bias,
+            sparsity=sparsity,
+            small_conv=small_conv,
+            use_lowrank_svd=use_lowrank_svd,
+            num_workers=num_workers,
+        )
         return loras
 
     text_encoder_loras = make_state_dict(
@@ -338,6 +404,74 @@ def extract_diff(
     return (text_encoder_loras | unet_loras), meta
 
 
+def extract_diff_streaming(
+        base_model: 'LazySafetensors',
+        db_model: 'LazySafetensors',
+        mode='fixed',
+        linear_mode_param=0,
+        conv_mode_param=0,
+        extract_device='cpu',
+        use_bias=False,
+        sparsity=0.98,
+        small_conv=True,
+        linear_only=False,
+        prefix='lora_unet',
+        use_lowrank_svd=True,
+        num_workers=4,
+        max_window_bytes=2 * 1024 * 1024 * 1024,
+):
+    # extracts from the checkpoint keys directly instead of loaded models. Only a window of layers is read
+    # at a time, so memory stays around max_window_bytes no matter the size of the checkpoints.
+    # lora names are the checkpoint keys without .weight and with _ for .
+    meta = OrderedDict()
+    loras = {}
+    window: List[ExtractLayer] = []
+    window_bytes = 0
+
+    def extract_window():
+        loras.update(extract_layers(
+            window,
+            mode=mode,
+            device=extract_device,
+            use_bias=use_bias,
+            sparsity=sparsity,
+            small_conv=small_conv,
+            use_lowrank_svd=use_lowrank_svd,
+            num_workers=num_workers,
+        ))
+        window.clear()
+
+    for key in tqdm(base_model.keys(), desc="Reading layers"):
+        if not key.endswith('.weight') or key not in db_model:
+            continue
+        # token and position embeddings are not layers a lora can wrap
+        if key.endswith('embedding.weight') or key.endswith('embeddings.weight'):
+            continue
+        shape = base_model.get_shape(key)
+        if len(shape) not in [2, 4] or db_model.get_shape(key) != shape:
+            continue
+        is_linear = len(shape) == 2 or (shape[2] == 1 and shape[3] == 1)
+        if not is_linear and linear_only:
+            continue
+        lora_name = (prefix + '.' + key[:-len('.weight')]).replace('.', '_')
+        layer = ExtractLayer(
+            lora_name,
+            db_model[key].float(),
+            base_model[key].float(),
+            linear_mode_param if is_linear else conv_mode_param
+        )
+        window.append(layer)
+        window_bytes += layer.weight.numel() * 4 * 2
+        if window_bytes >= max_window_bytes:
+            extract_window()
+            window_bytes = 0
+    if len(window) > 0:
+        extract_window()
+
+    print(f'{len(loras)} Modules extracted')
+    return loras, meta
+
+
 def get_module(
         lyco_state_dict: Dict,
         lora_name
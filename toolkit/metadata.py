@@ -1,13 +1,40 @@
+import hashlib
 import json
 from collections import OrderedDict
-from io import BytesIO
+from typing import Dict, List, Tuple, Union
 
-import safetensors
+import torch
 from safetensors import safe_open
 
 from info import software_meta
-from toolkit.train_tools import addnet_hash_legacy
-from toolkit.train_tools import addnet_hash_safetensors
+
+# safetensors writes tensors sorted by dtype, largest first, then by name. This is the order of its dtypes
+_safetensors_dtypes = [
+    ('U64', 'uint64'),
+    ('I64', 'int64'),
+    ('F64', 'float64'),
+    ('F32', 'float32'),
+    ('U32', 'uint32'),
+    ('I32', 'int32'),
+    ('BF16', 'bfloat16'),
+    ('F16', 'float16'),
+    ('U16', 'uint16'),
+    ('I16', 'int16'),
+    ('F8_E4M3', 'float8_e4m3fn'),
+    ('F8_E5M2', 'float8_e5m2'),
+    ('I8', 'int8'),
+    ('U8', 'uint8'),
+    ('BOOL', 'bool'),
+]
+# torch dtype -> (sort rank, safetensors name), skipping dtypes this torch does not have
+safetensors_dtype_map: Dict[torch.dtype, Tuple[int, str]] = {
+    getattr(torch, torch_name): (rank, name)
+    for rank, (name, torch_name) in enumerate(_safetensors_dtypes) if hasattr(torch, torch_name)
+}
+
+# the part of the file hashed by addnet_hash_legacy
+LEGACY_HASH_START = 0x100000
+LEGACY_HASH_END = LEGACY_HASH_START + 0x10000
 
 
 def get_meta_for_safetensors(meta: OrderedDict, name=None, add_software_info=True) -> OrderedDict:
@@ -28,25 +55,127 @@ def get_meta_for_safetensors(meta: OrderedDict, name=None, add_software_info=Tru
     return save_meta
 
 
-def add_model_hash_to_meta(state_dict, meta: OrderedDict) -> OrderedDict:
-    """Precalculate the model hashes needed by sd-webui-additional-networks to
-    save time on indexing the model later."""
-
+def get_safetensors_header_layout(tensor_specs: Dict[str, Tuple[torch.dtype, List[int]]]) -> OrderedDict:
+    # header entries for {key: (dtype, shape)} in the order safetensors writes them
+    items = sorted(
+        [(safetensors_dtype_map[dtype][0], key, dtype, shape) for key, (dtype, shape) in tensor_specs.items()],
+        key=lambda x: (x[0], x[1])
+    )
+    header = OrderedDict()
+    offset = 0
+    for _, key, dtype, shape in items:
+        num_bytes = int(torch.Size(shape).numel()) * torch.empty((), dtype=dtype).element_size()
+        header[key] = OrderedDict([
+            ("dtype", safetensors_dtype_map[dtype][1]),
+            ("shape", list(shape)),
+            ("data_offsets", [offset, offset + num_bytes]),
+        ])
+        offset += num_bytes
+    return header
+
+
+def get_safetensors_layout(state_dict) -> Tuple[OrderedDict, List[torch.Tensor]]:
+    # header entries and tensors in the order safetensors writes them
+    header = get_safetensors_header_layout(
+        OrderedDict([(key, (tensor.dtype, list(tensor.shape))) for key, tensor in state_dict.items()])
+    )
+    return header, [state_dict[key] for key in header.keys()]
+
+
+def get_safetensors_header_bytes(tensor_header: OrderedDict, metadata: Union[Dict[str, str], None]) -> bytes:
+    # length prefix and json header padded to 8 bytes like safetensors. Metadata is written in dict order
+    header = OrderedDict()
+    if metadata is not None:
+        header["__metadata__"] = metadata
+    header.update(tensor_header)
+    header_bytes = json.dumps(header, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    header_bytes += b' ' * ((8 - len(header_bytes) % 8) % 8)
+    return len(header_bytes).to_bytes(8, "little") + header_bytes
+
+
+def tensor_to_bytes(tensor: torch.Tensor) -> memoryview:
+    # raw little endian bytes of the tensor without another copy on cpu
+    tensor = tensor.detach().cpu().contiguous()
+    if tensor.numel() == 0:
+        return memoryview(b'')
+    return memoryview(tensor.reshape(-1).view(torch.uint8).numpy())
+
+
+class ModelHasher:
+    """
+    Computes the sd-webui-additional-networks hashes (addnet_hash_safetensors and addnet_hash_legacy)
+    incrementally while the bytes of a safetensors file go by.
+    """
+
+    def __init__(self):
+        self.model_hash = hashlib.sha256()
+        self.legacy_hash = hashlib.sha256()
+        self.position = 0
+
+    def update(self, data: Union[bytes, memoryview], is_header: bool = False):
+        if not is_header:
+            self.model_hash.update(data)
+        start = max(self.position, LEGACY_HASH_START)
+        end = min(self.position + len(data), LEGACY_HASH_END)
+        if start < end:
+            self.legacy_hash.update(data[start - self.position:end - self.position])
+        self.position += len(data)
+
+    def get_hashes(self) -> Tuple[str, str]:
+        return self.model_hash.hexdigest(), self.legacy_hash.hexdigest()[0:8]
+
+
+def get_hash_metadata(meta: OrderedDict) -> Dict[str, str]:
     # Because writing user metadata to the file can change the result of
     # sd_models.model_hash(), only retain the training metadata for purposes of
     # calculating the hash, as they are meant to be immutable
-    metadata = {k: v for k, v in meta.items() if k.startswith("ss_")}
+    return {k: v for k, v in meta.items() if k.startswith("ss_")}
+
+
+def get_model_hashes(state_dict, metadata: Union[Dict[str, str], None]) -> Tuple[str, str]:
+    # same as hashing the output of safetensors.torch.save(state_dict, metadata) without building it
+    tensor_header, tensors = get_safetensors_layout(state_dict)
+    hasher = ModelHasher()
+    hasher.update(get_safetensors_header_bytes(tensor_header, metadata), is_header=True)
+    for tensor in tensors:
+        hasher.update(tensor_to_bytes(tensor))
+    return hasher.get_hashes()
 
-    bytes = safetensors.torch.save(state_dict, metadata)
-    b = BytesIO(bytes)
 
-    model_hash = addnet_hash_safetensors(b)
-    legacy_hash = addnet_hash_legacy(b)
+def add_model_hash_to_meta(state_dict, meta: OrderedDict) -> OrderedDict:
+    """Precalculate the model hashes needed by sd-webui-additional-networks to
+    save time on indexing the model later."""
+    model_hash, legacy_hash = get_model_hashes(state_dict, get_hash_metadata(meta))
     meta["sshs_model_hash"] = model_hash
     meta["sshs_legacy_hash"] = legacy_hash
     return meta
 
 
+def save_file_with_model_hash(state_dict, filename: str, meta: OrderedDict) -> OrderedDict:
+    """
+    Saves a safetensors file and adds the model hashes to meta in the same pass over the tensors.
+    The hashes have a fixed length, so the header size is known before they are computed. The data is written
+    first while hashing and the header is written at the start of the file at the end.
+    """
+    tensor_header, tensors = get_safetensors_layout(state_dict)
+    hasher = ModelHasher()
+    hasher.update(get_safetensors_header_bytes(tensor_header, get_hash_metadata(meta)), is_header=True)
+
+    meta["sshs_model_hash"] = "0" * 64
+    meta["sshs_legacy_hash"] = "0" * 8
+    header_size = len(get_safetensors_header_bytes(tensor_header, meta))
+    with open(filename, "wb") as f:
+        f.seek(header_size)
+        for tensor in tensors:
+            data = tensor_to_bytes(tensor)
+            hasher.update(data)
+            f.write(data)
+        meta["sshs_model_hash"], meta["sshs_legacy_hash"] = hasher.get_hashes()
+        f.seek(0)
+        f.write(get_safetensors_header_bytes(tensor_header, meta))
+    return meta
+
+
 def add_base_model_info_to_meta(
         meta: OrderedDict,
         base_model: str = None,
@@ -12,7 +12,7 @@ from tqdm import tqdm
 
 from toolkit.config_modules import NetworkConfig
 from toolkit.lorm import extract_conv, extract_linear, count_parameters
-from toolkit.metadata import add_model_hash_to_meta
+from toolkit.metadata import add_model_hash_to_meta, save_file_with_model_hash
 from toolkit.paths import KEYMAPS_ROOT
 from toolkit.saving import get_lora_keymap_from_model_keymap
 from optimum.quanto import QBytesTensor
@@ -22,6 +22,7 @@ if TYPE_CHECKING:
     from toolkit.lora_special import LoRASpecialNetwork, LoRAModule
     from toolkit.stable_diffusion_model import StableDiffusion
     from toolkit.models.DoRA import DoRAModule
+    from toolkit.checkpoint_writer import AsyncCheckpointWriter
 
 Network = Union['LycorisSpecialNetwork', 'LoRASpecialNetwork']
 Module = Union['LoConSpecialModule', 'LoRAModule', 'DoRAModule']
@@ -168,6 +169,11 @@ class ToolkitModuleMixin:
         self.network_ref: weakref.ref = weakref.ref(network)
         self.is_checkpointing = False
         self._multiplier: Union[float, list, torch.Tensor] = None
+        # cpu copy of the org module weight from before merge_in, reused for every merge
+        self.merge_backup: Union[torch.Tensor, None] = None
+        self.is_weight_merged = False
+        # if this is a plain linear lora that can use _fast_forward, set on the first forward
+        self.is_fast_forward_module: Union[bool, None] = None
 
     def _call_forward(self: Module, x):
         # module dropout
@@ -213,6 +219,46 @@ class ToolkitModuleMixin:
 
         return lx * scale
 
+    def can_fast_forward(self: Module, x) -> bool:
+        if self.is_fast_forward_module is None:
+            self.is_fast_forward_module = isinstance(self.lora_down, nn.Linear) and \
+                                          isinstance(self.lora_up, nn.Linear) and \
+                                          self.lora_up.bias is None and \
+                                          getattr(self, 'lora_mid', None) is None and \
+                                          not isinstance(getattr(self, 'scalar', None), nn.Parameter) and \
+                                          self.__class__.__name__ != "DoRAModule"
+        if not self.is_fast_forward_module or isinstance(x, QTensor) or isinstance(self.scale, torch.Tensor):
+            return False
+        if self.training:
+            # dropouts need the full path
+            if self.module_dropout or self.rank_dropout:
+                return False
+            if self.dropout is not None and not isinstance(self.dropout, nn.Identity):
+                return False
+        return True
+
+    def _fast_forward(self: Module, x, org_forwarded, multiplier: float):
+        # x @ down.T @ up.T * scale * multiplier, added to the original output with one addmm
+        down_weight = self.lora_down.weight
+        up_weight = self.lora_up.weight
+        if x.dtype != down_weight.dtype:
+            x = x.to(down_weight.dtype)
+        scale = self.scale * multiplier
+        if hasattr(self, 'scalar'):
+            scale = scale * float(self.scalar)
+        lx = torch.nn.functional.linear(x, down_weight)
+        if org_forwarded.dtype == lx.dtype:
+            out = torch.addmm(
+                org_forwarded.reshape(-1, org_forwarded.size(-1)),
+                lx.reshape(-1, lx.size(-1)),
+                up_weight.t(),
+                alpha=float(scale)
+            )
+            return out.view(org_forwarded.shape)
+        # lora runs in its own precision, cast the result like the full path does
+        lora_output = torch.nn.functional.linear(lx, up_weight) * float(scale)
+        return org_forwarded + lora_output.to(org_forwarded.dtype)
+
     def lorm_forward(self: Network, x, *args, **kwargs):
         network: Network = self.network_ref()
         if not network.is_active:
@@ -275,12 +321,15 @@ class ToolkitModuleMixin:
 
         org_forwarded = self.org_forward(x, *args, **kwargs)
 
+        if network.single_multiplier is not None and self.can_fast_forward(x):
+            return self._fast_forward(x, org_forwarded, network.single_multiplier)
+
         if isinstance(x, QTensor):
             x = x.dequantize()
         # always cast to float32
         lora_input = x.to(self.lora_down.weight.dtype)
         lora_output = self._call_forward(lora_input)
-        multiplier = self.network_ref().torch_multiplier
+        multiplier = network.torch_multiplier
 
         lora_output_batch_size = lora_output.size(0)
         multiplier_batch_size = multiplier.size(0)
@@ -325,63 +374,69 @@ class ToolkitModuleMixin:
     def disable_gradient_checkpointing(self: Module):
         self.is_checkpointing = False
 
-    @torch.no_grad()
-    def merge_out(self: Module, merge_out_weight=1.0):
-        # make sure it is positive
-        merge_out_weight = abs(merge_out_weight)
-        # merging out is just merging in the negative of the weight
-        self.merge_in(merge_weight=-merge_out_weight)
-
-    @torch.no_grad()
-    def merge_in(self: Module, merge_weight=1.0):
-        if not self.can_merge_in:
-            return
-        # get up/down weight
-        up_weight = self.lora_up.weight.clone().float()
-        down_weight = self.lora_down.weight.clone().float()
-
-        # extract weight from org_module
-        org_sd = self.org_module[0].state_dict()
+    def get_merge_weight(self: Module) -> Union[torch.Tensor, None]:
+        # the org module weight we can merge into, None if it is quantized
+        weight = self.org_module[0].weight
         # todo find a way to merge in weights when doing quantized model
-        if 'weight._data' in org_sd:
-            # quantized weight
-            return
-
-        weight_key = "weight"
-        if 'weight._data' in org_sd:
-            # quantized weight
-            weight_key = "weight._data"
+        if isinstance(weight, QTensor):
+            return None
+        return weight
 
-        orig_dtype = org_sd[weight_key].dtype
-        weight = org_sd[weight_key].float()
-
-        multiplier = merge_weight
+    def get_merge_scale(self: Module):
         scale = self.scale
         # handle trainable scaler method locon does
         if hasattr(self, 'scalar'):
             scale = scale * self.scalar
+        return scale
 
-        # merge weight
-        if len(weight.size()) == 2:
+    @torch.no_grad()
+    def get_merge_delta(self: Module) -> torch.Tensor:
+        # up @ down in float32 in the shape of the org module weight, without scale or multiplier
+        up_weight = self.lora_up.weight.float()
+        down_weight = self.lora_down.weight.float()
+        if len(down_weight.size()) == 2:
             # linear
-            weight = weight + multiplier * (up_weight @ down_weight) * scale
+            return up_weight @ down_weight
         elif down_weight.size()[2:4] == (1, 1):
             # conv2d 1x1
-            weight = (
-                    weight
-                    + multiplier
-                    * (up_weight.squeeze(3).squeeze(2) @ down_weight.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3)
-                    * scale
-            )
+            return (up_weight.squeeze(3).squeeze(2) @ down_weight.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3)
         else:
             # conv2d 3x3
-            conved = torch.nn.functional.conv2d(down_weight.permute(1, 0, 2, 3), up_weight).permute(1, 0, 2, 3)
-            # print(conved.size(), weight.size(), module.stride, module.padding)
-            weight = weight + multiplier * conved * scale
+            return torch.nn.functional.conv2d(down_weight.permute(1, 0, 2, 3), up_weight).permute(1, 0, 2, 3)
+
+    @torch.no_grad()
+    def merge_delta_in(self: Module, delta: torch.Tensor, merge_weight=1.0):
+        weight = self.get_merge_weight()
+        if weight is None:
+            return
+        if not self.is_weight_merged:
+            # keep the unmerged weight so merge_out restores it exactly instead of subtracting the delta again
+            if self.merge_backup is None or self.merge_backup.shape != weight.shape or \
+                    self.merge_backup.dtype != weight.dtype:
+                self.merge_backup = torch.empty(
+                    weight.shape, dtype=weight.dtype, device='cpu', pin_memory=weight.is_cuda
+                )
+            self.merge_backup.copy_(weight.data, non_blocking=True)
+        merged = weight.float() + delta.reshape(weight.shape) * (merge_weight * self.get_merge_scale())
+        weight.data.copy_(merged.to(weight.dtype))
+        self.is_weight_merged = True
 
-        # set weight to org_module
-        org_sd[weight_key] = weight.to(orig_dtype)
-        self.org_module[0].load_state_dict(org_sd)
+    @torch.no_grad()
+    def merge_out(self: Module, merge_out_weight=1.0):
+        if not self.is_weight_merged:
+            return
+        # copies back the weight from before merge_in, so merging does not drift the base weights
+        weight = self.get_merge_weight()
+        weight.data.copy_(self.merge_backup, non_blocking=True)
+        self.is_weight_merged = False
+
+    @torch.no_grad()
+    def merge_in(self: Module, merge_weight=1.0):
+        if not self.can_merge_in:
+            return
+        if self.get_merge_weight() is None:
+            return
+        self.merge_delta_in(self.get_merge_delta(), merge_weight)
 
     def setup_lorm(self: Module, state_dict: Optional[Dict[str, Any]] = None):
         # LoRM (Low Rank Middle) is a method reduce the number of parameters in a module while keeping the inputs and
@@ -401,6 +456,15 @@ class ToolkitModuleMixin:
         )
 
 
+def save_weights_file(save_dict: OrderedDict, file: str, metadata: OrderedDict):
+    if os.path.splitext(file)[1] == ".safetensors":
+        # hashes while writing the file
+        save_file_with_model_hash(save_dict, file, metadata)
+    else:
+        add_model_hash_to_meta(save_dict, metadata)
+        torch.save(save_dict, file)
+
+
 class ToolkitNetworkMixin:
     def __init__(
             self: Network,
@@ -419,6 +483,8 @@ class ToolkitNetworkMixin:
         self.train_unet = train_unet
         self.is_checkpointing = False
         self._multiplier: float = 1.0
+        # the multiplier as a float when it is the same for the whole batch, for the module fast forward
+        self.single_multiplier: Optional[float] = None
         self.is_active: bool = False
         self.is_sdxl = is_sdxl
         self.is_ssd = is_ssd
@@ -431,6 +497,8 @@ class ToolkitNetworkMixin:
         self.module_losses: List[torch.Tensor] = []
         self.lorm_train_mode: Literal['local', None] = None
         self.can_merge_in = not is_lorm
+        # max size of the batched deltas in merge_in
+        self.max_merge_chunk_bytes = 256 * 1024 * 1024
 
     def get_keymap(self: Network, force_weight_mapping=False):
         use_weight_mapping = False
@@ -493,7 +561,8 @@ class ToolkitNetworkMixin:
             self: Network,
             file, dtype=torch.float16,
             metadata=None,
-            extra_state_dict: Optional[OrderedDict] = None
+            extra_state_dict: Optional[OrderedDict] = None,
+            writer: Optional['AsyncCheckpointWriter'] = None
     ):
         keymap = self.get_keymap()
 
@@ -509,9 +578,21 @@ class ToolkitNetworkMixin:
         state_dict = self.state_dict()
         save_dict = OrderedDict()
 
+        if writer is not None:
+            # snapshot everything to cpu at once, the writer saves it in the background
+            state_dict = writer.snapshot(state_dict, dtype)
+            if extra_state_dict is not None:
+                extra_state_dict = writer.snapshot(extra_state_dict, dtype)
+
+            def to_save(tensor):
+                return tensor
+        else:
+            def to_save(tensor):
+                return tensor.detach().clone().to("cpu").to(dtype)
+
         for key in list(state_dict.keys()):
             v = state_dict[key]
-            v = v.detach().clone().to("cpu").to(dtype)
+            v = to_save(v)
             save_key = save_keymap[key] if key in save_keymap else key
             save_dict[save_key] = v
             del state_dict[key]
@@ -520,7 +601,7 @@ class ToolkitNetworkMixin:
             # add extra items to state dict
             for key in list(extra_state_dict.keys()):
                 v = extra_state_dict[key]
-                v = v.detach().clone().to("cpu").to(dtype)
+                v = to_save(v)
                 save_dict[key] = v
 
         if self.peft_format:
@@ -543,12 +624,10 @@ class ToolkitNetworkMixin:
 
         if metadata is None:
             metadata = OrderedDict()
-        metadata = add_model_hash_to_meta(state_dict, metadata)
-        if os.path.splitext(file)[1] == ".safetensors":
-            from safetensors.torch import save_file
-            save_file(save_dict, file, metadata)
+        if writer is not None:
+            writer.submit(save_weights_file, save_dict, file, metadata)
         else:
-            torch.save(save_dict, file)
+            save_weights_file(save_dict, file, metadata)
 
     def load_weights(self: Network, file, force_weight_mapping=False):
         # allows us to save and load to and from ldm weights
@@ -622,13 +701,19 @@ class ToolkitNetworkMixin:
         with torch.no_grad():
             tensor_multiplier = None
             if isinstance(multiplier, int) or isinstance(multiplier, float):
-                tensor_multiplier = torch.tensor((multiplier,)).to(device, dtype=dtype)
+                tensor_multiplier = torch.tensor((multiplier,)).to(dtype=dtype)
             elif isinstance(multiplier, list):
-                tensor_multiplier = torch.tensor(multiplier).to(device, dtype=dtype)
+                tensor_multiplier = torch.tensor(multiplier).to(dtype=dtype)
             elif isinstance(multiplier, torch.Tensor):
-                tensor_multiplier = multiplier.clone().detach().to(device, dtype=dtype)
+                tensor_multiplier = multiplier.clone().detach().to('cpu', dtype=dtype)
 
-            self.torch_multiplier = tensor_multiplier.clone().detach()
+            # resolved here so the modules do not broadcast a tensor every forward
+            values = tensor_multiplier.flatten()
+            self.single_multiplier = None
+            if values.numel() > 0 and bool(torch.all(values == values[0])):
+                self.single_multiplier = values[0].item()
+
+            self.torch_multiplier = tensor_multiplier.to(device).clone().detach()
 
     @property
     def multiplier(self) -> Union[float, List[float], List[List[float]]]:
@@ -686,12 +771,41 @@ class ToolkitNetworkMixin:
         self.is_checkpointing = False
         self._update_checkpointing()
 
+    @torch.no_grad()
     def merge_in(self, merge_weight=1.0):
         if self.network_type.lower() == 'dora':
             return
         self.is_merged_in = True
+        # modules with the same lora shapes get their deltas from one batched matmul
+        groups = OrderedDict()
         for module in self.get_all_modules():
-            module.merge_in(merge_weight)
+            if not module.can_merge_in or module.get_merge_weight() is None:
+                continue
+            up_weight = module.lora_up.weight
+            down_weight = module.lora_down.weight
+            if len(down_weight.size()) == 4 and down_weight.size()[2:4] != (1, 1):
+                # conv2d 3x3
+                module.merge_in(merge_weight)
+                continue
+            key = (tuple(up_weight.shape), tuple(down_weight.shape), up_weight.device)
+            if key not in groups:
+                groups[key] = []
+            groups[key].append(module)
+
+        for (up_shape, down_shape, device), modules in groups.items():
+            # limit how many float32 deltas are alive at once
+            delta_bytes = up_shape[0] * down_shape[1] * 4
+            chunk_size = max(1, self.max_merge_chunk_bytes // delta_bytes)
+            for idx in range(0, len(modules), chunk_size):
+                chunk = modules[idx:idx + chunk_size]
+                up_weights = torch.stack([m.lora_up.weight.reshape(up_shape[0], up_shape[1]) for m in chunk]).float()
+                down_weights = torch.stack(
+                    [m.lora_down.weight.reshape(down_shape[0], down_shape[1]) for m in chunk]
+                ).float()
+                deltas = torch.bmm(up_weights, down_weights)
+                for module, delta in zip(chunk, deltas):
+                    module.merge_delta_in(delta, merge_weight)
+                del up_weights, down_weights, deltas
 
     def merge_out(self: Network, merge_weight=1.0):
         if not self.is_merged_in:
@@ -1,12 +1,13 @@
 import math
 from typing import List
 import torch
-from toolkit.optimizers.optimizer_utils import copy_stochastic, stochastic_grad_accummulation
+from toolkit.optimizers.optimizer_utils import copy_stochastic, stochastic_grad_accummulation, can_foreach, \
+    get_foreach_buckets, copy_stochastic_multi, foreach_copy_
+from toolkit.optimizers.param_swapping import ParamSwappingMixin
 from optimum.quanto import QBytesTensor
-import random
 
 
-class Adafactor(torch.optim.Optimizer):
+class Adafactor(ParamSwappingMixin, torch.optim.Optimizer):
     """
     Adafactor implementation with stochastic rounding accumulation and stochastic rounding on apply.
     Modified from transformers Adafactor implementation to support stochastic rounding accumulation and apply.
@@ -40,6 +41,8 @@ class Adafactor(torch.optim.Optimizer):
             If True, time-dependent learning rate is computed instead of external learning rate
         warmup_init (`bool`, *optional*, defaults to `False`):
             Time-dependent learning rate computation depends on whether warm-up initialization is being used
+        foreach (`bool`, *optional*, defaults to `True`):
+            Step params with the same shape, dtype and device together as one stacked batch
 
     This implementation handles low-precision (FP16, bfloat) values, but we have not thoroughly tested.
 
@@ -108,6 +111,10 @@ class Adafactor(torch.optim.Optimizer):
         warmup_init=False,
         do_paramiter_swapping=False,
         paramiter_swapping_factor=0.1,
+        # swap the active params every n steps and keep the state of inactive params on the cpu
+        paramiter_swapping_every=1,
+        paramiter_swapping_offload_state=False,
+        foreach=True,
     ):
         if lr is not None and relative_step:
             raise ValueError(
@@ -133,6 +140,7 @@ class Adafactor(torch.optim.Optimizer):
             lr for group in self.param_groups
         ]
 
+        self.foreach = foreach
         self.is_stochastic_rounding_accumulation = False
 
         # setup stochastic grad accum hooks
@@ -156,36 +164,11 @@ class Adafactor(torch.optim.Optimizer):
         
         # needs to be enabled to count paramiters
         if self.do_paramiter_swapping:
-            self.enable_paramiter_swapping(self.paramiter_swapping_factor)
-        
-    
-    def enable_paramiter_swapping(self, paramiter_swapping_factor=0.1):
-        self.do_paramiter_swapping = True
-        self.paramiter_swapping_factor = paramiter_swapping_factor
-        # call it an initial time
-        self.swap_paramiters()
-                    
-    def swap_paramiters(self):
-        all_params = []
-        # deactivate all paramiters
-        for group in self.param_groups:
-            for param in group['params']:
-                param.requires_grad_(False)
-                # remove any grad
-                param.grad = None
-                all_params.append(param)
-        # shuffle all paramiters
-        random.shuffle(all_params)
-        
-        # keep activating paramiters until we are going to go over the target paramiters
-        target_paramiters = int(self._total_paramiter_size * self.paramiter_swapping_factor)
-        total_paramiters = 0
-        for param in all_params:
-            total_paramiters += torch.numel(param)
-            if total_paramiters >= target_paramiters:
-                break
-            else:
-                param.requires_grad_(True)
+            self.enable_paramiter_swapping(
+                self.paramiter_swapping_factor,
+                swap_every=paramiter_swapping_every,
+                offload_state=paramiter_swapping_offload_state,
+            )
 
     @staticmethod
     def _get_lr(param_group, param_state):
@@ -254,10 +237,12 @@ class Adafactor(torch.optim.Optimizer):
             loss = closure()
 
         for group in self.param_groups:
-            for p in group["params"]:
-                if p.grad is None or not p.requires_grad:
-                    continue
+            params = [p for p in group["params"] if p.grad is not None and p.requires_grad]
+            if self.foreach:
+                self._step_foreach(group, [p for p in params if can_foreach(p)])
+                params = [p for p in params if not can_foreach(p)]
 
+            for p in params:
                 grad = p.grad
                 if grad.dtype != torch.float32:
                     grad = grad.to(torch.float32)
@@ -357,3 +342,95 @@ class Adafactor(torch.optim.Optimizer):
                     copy_stochastic(p, p_data_fp32)
 
         return loss
+
+    def _step_foreach(self, group, params):
+        # params with the same shape are stacked and stepped as one batch
+        use_first_moment = group["beta1"] is not None
+        for p in params:
+            state = self.state[p]
+            factored, _ = self._get_options(group, p.shape)
+            if len(state) == 0:
+                state["step"] = 0
+                if use_first_moment:
+                    state["exp_avg"] = torch.zeros_like(p, dtype=torch.float32)
+                if factored:
+                    state["exp_avg_sq_row"] = torch.zeros(p.shape[:-1], dtype=torch.float32, device=p.device)
+                    state["exp_avg_sq_col"] = torch.zeros(
+                        p.shape[:-2] + p.shape[-1:], dtype=torch.float32, device=p.device)
+                else:
+                    state["exp_avg_sq"] = torch.zeros_like(p, dtype=torch.float32)
+                state["RMS"] = 0
+            else:
+                for key in ["exp_avg", "exp_avg_sq_row", "exp_avg_sq_col", "exp_avg_sq"]:
+                    if key in state:
+                        state[key] = state[key].to(p.device, dtype=torch.float32)
+
+        buckets = get_foreach_buckets(params, key_fn=lambda p: (tuple(p.shape), self.state[p]["step"]))
+        for bucket in buckets:
+            states = [self.state[p] for p in bucket]
+            shape = bucket[0].shape
+            numel = bucket[0].numel()
+            # broadcasts a per param value over the stacked batch
+            batch_view = (-1,) + (1,) * len(shape)
+            factored, _ = self._get_options(group, shape)
+
+            grad = torch.stack([p.grad for p in bucket]).to(torch.float32)
+            p_data_fp32 = torch.stack([p.detach() for p in bucket]).to(torch.float32)
+
+            for state in states:
+                state["step"] += 1
+            step = states[0]["step"]
+            rms = p_data_fp32.flatten(1).norm(2, dim=1) / (numel ** 0.5)
+            for idx, state in enumerate(states):
+                state["RMS"] = rms[idx]
+
+            rel_step_sz = group["lr"]
+            if group["relative_step"]:
+                min_step = 1e-6 * step if group["warmup_init"] else 1e-2
+                rel_step_sz = min(min_step, 1.0 / math.sqrt(step))
+            lr = rel_step_sz
+            if group["scale_parameter"]:
+                lr = rms.clamp(min=group["eps"][1]).mul_(rel_step_sz).view(batch_view)
+
+            beta2t = 1.0 - math.pow(step, group["decay_rate"])
+            eps = group["eps"]
+            if isinstance(eps, tuple) or isinstance(eps, list):
+                eps = eps[0]
+            update = (grad ** 2) + eps
+            if factored:
+                exp_avg_sq_row = torch.stack([state["exp_avg_sq_row"] for state in states])
+                exp_avg_sq_col = torch.stack([state["exp_avg_sq_col"] for state in states])
+
+                exp_avg_sq_row.mul_(beta2t).add_(update.mean(dim=-1), alpha=(1.0 - beta2t))
+                exp_avg_sq_col.mul_(beta2t).add_(update.mean(dim=-2), alpha=(1.0 - beta2t))
+                foreach_copy_([state["exp_avg_sq_row"] for state in states], list(exp_avg_sq_row.unbind(0)))
+                foreach_copy_([state["exp_avg_sq_col"] for state in states], list(exp_avg_sq_col.unbind(0)))
+
+                # Approximation of exponential moving average of square of gradient
+                update = self._approx_sq_grad(exp_avg_sq_row, exp_avg_sq_col)
+                update.mul_(grad)
+            else:
+                exp_avg_sq = torch.stack([state["exp_avg_sq"] for state in states])
+
+                exp_avg_sq.mul_(beta2t).add_(update, alpha=(1.0 - beta2t))
+                foreach_copy_([state["exp_avg_sq"] for state in states], list(exp_avg_sq.unbind(0)))
+                update = exp_avg_sq.rsqrt().mul_(grad)
+            del grad
+
+            update_rms = update.flatten(1).norm(2, dim=1) / (numel ** 0.5)
+            update.div_((update_rms / group["clip_threshold"]).clamp_(min=1.0).view(batch_view))
+            update.mul_(lr)
+
+            if use_first_moment:
+                exp_avg = torch.stack([state["exp_avg"] for state in states])
+                exp_avg.mul_(group["beta1"]).add_(update, alpha=(1 - group["beta1"]))
+                foreach_copy_([state["exp_avg"] for state in states], list(exp_avg.unbind(0)))
+                update = exp_avg
+
+            if group["weight_decay"] != 0:
+                p_data_fp32.add_(p_data_fp32 * (-group["weight_decay"] * lr))
+
+            p_data_fp32.add_(-update)
+
+            # stochastic rounding for the whole bucket at once
+            copy_stochastic_multi([p.data for p in bucket], p_data_fp32)
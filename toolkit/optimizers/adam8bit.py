@@ -1,7 +1,8 @@
 import math
 import torch
 from torch.optim import Optimizer
-from toolkit.optimizers.optimizer_utils import copy_stochastic, Auto8bitTensor, stochastic_grad_accummulation
+from toolkit.optimizers.optimizer_utils import copy_stochastic, Auto8bitTensor, stochastic_grad_accummulation, \
+    can_foreach, get_foreach_buckets, copy_stochastic_multi, dequantize_auto8bit_multi, quantize_auto8bit_multi
 
 class Adam8bit(Optimizer):
     """
@@ -14,9 +15,10 @@ class Adam8bit(Optimizer):
         eps (float): Term added to denominator to improve numerical stability (default: 1e-8)
         weight_decay (float): Weight decay coefficient (default: 0)
         decouple (bool): Use AdamW style decoupled weight decay (default: True)
+        foreach (bool): Step params of the same dtype and device together with foreach ops (default: True)
     """
     def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, 
-                 weight_decay=0, decouple=True):
+                 weight_decay=0, decouple=True, foreach=True):
         if not 0.0 <= lr:
             raise ValueError(f"Invalid learning rate: {lr}")
         if not 0.0 <= eps:
@@ -29,7 +31,8 @@ class Adam8bit(Optimizer):
         defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay,
                        decouple=decouple)
         super(Adam8bit, self).__init__(params, defaults)
-        
+
+        self.foreach = foreach
         self.is_stochastic_rounding_accumulation = False
         
         # Setup stochastic grad accumulation hooks
@@ -80,9 +83,13 @@ class Adam8bit(Optimizer):
             decay = group['weight_decay']
             decouple = group['decouple']
 
-            for p in group['params']:
-                if p.grad is None:
-                    continue
+            params = [p for p in group['params'] if p.grad is not None]
+            if self.foreach:
+                foreach_params = [p for p in params if can_foreach(p)]
+                self._step_foreach(group, foreach_params)
+                params = [p for p in params if not can_foreach(p)]
+
+            for p in params:
 
                 grad = p.grad.data.to(torch.float32)
                 p_fp32 = p.clone().to(torch.float32)
@@ -133,7 +140,68 @@ class Adam8bit(Optimizer):
                 copy_stochastic(p.data, p_fp32.data)
 
         return loss
-    
+
+    def _step_foreach(self, group, params):
+        beta1, beta2 = group['betas']
+        eps = group['eps']
+        lr = group['lr']
+        decay = group['weight_decay']
+        decouple = group['decouple']
+
+        for p in params:
+            state = self.state[p]
+            if len(state) == 0:
+                state['step'] = 0
+                state['exp_avg'] = Auto8bitTensor(torch.zeros_like(p, dtype=torch.float32))
+                state['exp_avg_sq'] = Auto8bitTensor(torch.zeros_like(p, dtype=torch.float32))
+
+        # params in a bucket share the bias correction
+        for bucket in get_foreach_buckets(params, key_fn=lambda p: (self.state[p]['step'],)):
+            states = [self.state[p] for p in bucket]
+            grads = [p.grad.to(torch.float32) for p in bucket]
+            # float32 params are updated in place
+            p_fp32 = [p.detach().to(torch.float32) for p in bucket]
+
+            # Apply weight decay (coupled variant)
+            if decay != 0 and not decouple:
+                grads = torch._foreach_add(grads, p_fp32, alpha=decay)
+
+            exp_avgs = dequantize_auto8bit_multi([state['exp_avg'] for state in states])
+            exp_avg_sqs = dequantize_auto8bit_multi([state['exp_avg_sq'] for state in states])
+
+            for state in states:
+                state['step'] += 1
+            bias_correction1 = 1 - beta1 ** states[0]['step']
+            bias_correction2 = 1 - beta2 ** states[0]['step']
+
+            # Adam EMA updates
+            torch._foreach_mul_(exp_avgs, beta1)
+            torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+            torch._foreach_mul_(exp_avg_sqs, beta2)
+            torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+
+            # Apply weight decay (decoupled variant)
+            if decay != 0 and decouple:
+                torch._foreach_mul_(p_fp32, 1 - lr * decay)
+
+            # Bias correction
+            step_size = lr / bias_correction1
+            denom = torch._foreach_sqrt(exp_avg_sqs)
+            torch._foreach_div_(denom, math.sqrt(bias_correction2))
+            torch._foreach_add_(denom, eps)
+
+            # Take step
+            torch._foreach_addcdiv_(p_fp32, exp_avgs, denom, value=-step_size)
+
+            for state, exp_avg, exp_avg_sq in zip(
+                    states, quantize_auto8bit_multi(exp_avgs), quantize_auto8bit_multi(exp_avg_sqs)
+            ):
+                state['exp_avg'] = exp_avg
+                state['exp_avg_sq'] = exp_avg_sq
+
+            if bucket[0].dtype != torch.float32:
+                copy_stochastic_multi([p.data for p in bucket], p_fp32)
+
     def state_dict(self):
         """Returns the state of the optimizer as a dict."""
         state_dict = super().state_dict()
@@ -2,12 +2,13 @@ from collections import OrderedDict
 import math
 from typing import List
 import torch
-from toolkit.optimizers.optimizer_utils import Auto8bitTensor, copy_stochastic, stochastic_grad_accummulation
+from toolkit.optimizers.optimizer_utils import Auto8bitTensor, copy_stochastic, stochastic_grad_accummulation, \
+    can_foreach, get_foreach_buckets, copy_stochastic_multi, foreach_copy_
+from toolkit.optimizers.param_swapping import ParamSwappingMixin
 from optimum.quanto import QBytesTensor
-import random
 
 
-class Automagic(torch.optim.Optimizer):
+class Automagic(ParamSwappingMixin, torch.optim.Optimizer):
     def __init__(
         self,
         params,
@@ -22,6 +23,11 @@ class Automagic(torch.optim.Optimizer):
         weight_decay=0.0,
         do_paramiter_swapping=False,
         paramiter_swapping_factor=0.1,
+        # swap the active params every n steps and keep the state of inactive params on the cpu
+        paramiter_swapping_every=1,
+        paramiter_swapping_offload_state=False,
+        # step params with the same shape, dtype and device together as one stacked batch
+        foreach=True,
     ):
         self.lr = lr
         self.min_lr = min_lr
@@ -42,6 +48,7 @@ class Automagic(torch.optim.Optimizer):
             lr for group in self.param_groups
         ]
 
+        self.foreach = foreach
         self.is_stochastic_rounding_accumulation = False
 
         # setup stochastic grad accum hooks
@@ -65,36 +72,11 @@ class Automagic(torch.optim.Optimizer):
 
         # needs to be enabled to count paramiters
         if self.do_paramiter_swapping:
-            self.enable_paramiter_swapping(self.paramiter_swapping_factor)
-
-    def enable_paramiter_swapping(self, paramiter_swapping_factor=0.1):
-        self.do_paramiter_swapping = True
-        self.paramiter_swapping_factor = paramiter_swapping_factor
-        # call it an initial time
-        self.swap_paramiters()
-
-    def swap_paramiters(self):
-        all_params = []
-        # deactivate all paramiters
-        for group in self.param_groups:
-            for param in group['params']:
-                param.requires_grad_(False)
-                # remove any grad
-                param.grad = None
-                all_params.append(param)
-        # shuffle all paramiters
-        random.shuffle(all_params)
-
-        # keep activating paramiters until we are going to go over the target paramiters
-        target_paramiters = int(
-            self._total_paramiter_size * self.paramiter_swapping_factor)
-        total_paramiters = 0
-        for param in all_params:
-            total_paramiters += torch.numel(param)
-            if total_paramiters >= target_paramiters:
-                break
-            else:
-                param.requires_grad_(True)
+            self.enable_paramiter_swapping(
+                self.paramiter_swapping_factor,
+                swap_every=paramiter_swapping_every,
+                offload_state=paramiter_swapping_offload_state,
+            )
 
     @staticmethod
     def _get_lr(param_group, param_state):
@@ -166,10 +148,12 @@ class Automagic(torch.optim.Optimizer):
             loss = closure()
 
         for group in self.param_groups:
-            for p in group["params"]:
-                if p.grad is None or not p.requires_grad:
-                    continue
+            params = [p for p in group["params"] if p.grad is not None and p.requires_grad]
+            if self.foreach:
+                self._step_foreach(group, [p for p in params if can_foreach(p)])
+                params = [p for p in params if not can_foreach(p)]
 
+            for p in params:
                 grad = p.grad
                 if grad.dtype != torch.float32:
                     grad = grad.to(torch.float32)
@@ -280,6 +264,115 @@ class Automagic(torch.optim.Optimizer):
 
         return loss
     
+    def _step_foreach(self, group, params):
+        # params with the same shape are stacked and stepped as one batch
+        for p in params:
+            state = self.state[p]
+            if len(state) == 0:
+                self.initialize_state(p)
+            else:
+                for key in ["exp_avg_sq_row", "exp_avg_sq_col", "exp_avg_sq"]:
+                    if key in state:
+                        state[key] = state[key].to(p.device, dtype=torch.float32)
+
+        for bucket in get_foreach_buckets(params, key_fn=lambda p: (tuple(p.shape), self.state[p]["step"])):
+            states = [self.state[p] for p in bucket]
+            shape = bucket[0].shape
+            numel = bucket[0].numel()
+            # broadcasts a per param value over the stacked batch
+            batch_view = (-1,) + (1,) * len(shape)
+            factored = len(shape) >= 2
+
+            grad = torch.stack([p.grad for p in bucket]).to(torch.float32)
+            p_data_fp32 = torch.stack([p.detach() for p in bucket]).to(torch.float32)
+
+            for state in states:
+                state["step"] += 1
+            step = states[0]["step"]
+            rms = p_data_fp32.flatten(1).norm(2, dim=1) / (numel ** 0.5)
+            for idx, state in enumerate(states):
+                state["RMS"] = rms[idx]
+
+            beta2t = 1.0 - math.pow(step, group["decay_rate"])
+            eps = group["eps"]
+            if isinstance(eps, tuple) or isinstance(eps, list):
+                eps = eps[0]
+            update = (grad ** 2) + eps
+            if factored:
+                exp_avg_sq_row = torch.stack([state["exp_avg_sq_row"] for state in states])
+                exp_avg_sq_col = torch.stack([state["exp_avg_sq_col"] for state in states])
+
+                exp_avg_sq_row.mul_(beta2t).add_(update.mean(dim=-1), alpha=(1.0 - beta2t))
+                exp_avg_sq_col.mul_(beta2t).add_(update.mean(dim=-2), alpha=(1.0 - beta2t))
+                foreach_copy_([state["exp_avg_sq_row"] for state in states], list(exp_avg_sq_row.unbind(0)))
+                foreach_copy_([state["exp_avg_sq_col"] for state in states], list(exp_avg_sq_col.unbind(0)))
+
+                # Approximation of exponential moving average of square of gradient
+                update = self._approx_sq_grad(exp_avg_sq_row, exp_avg_sq_col)
+                update.mul_(grad)
+            else:
+                exp_avg_sq = torch.stack([state["exp_avg_sq"] for state in states])
+
+                exp_avg_sq.mul_(beta2t).add_(update, alpha=(1.0 - beta2t))
+                foreach_copy_([state["exp_avg_sq"] for state in states], list(exp_avg_sq.unbind(0)))
+                update = exp_avg_sq.rsqrt().mul_(grad)
+            del grad
+
+            update_rms = update.flatten(1).norm(2, dim=1) / (numel ** 0.5)
+            update.div_((update_rms / group["clip_threshold"]).clamp_(min=1.0).view(batch_view))
+
+            # Get signs of current last update and updates
+            last_polarity = torch.stack([state['last_polarity'] for state in states])
+            current_polarity = (update > 0).to(torch.bool)
+            sign_agreement = last_polarity == current_polarity
+            for idx, state in enumerate(states):
+                state['last_polarity'] = current_polarity[idx]
+
+            lr_mask = torch.stack([state['lr_mask'].quantized.to(update.device) for state in states]).to(torch.float32)
+            lr_mask.mul_(torch.tensor(
+                [float(state['lr_mask'].scale) for state in states], dtype=torch.float32, device=lr_mask.device
+            ).view(batch_view))
+
+            # Update learning rate mask based on sign agreement
+            new_lr = torch.where(
+                sign_agreement,
+                lr_mask * self.lr_pump_scale,  # Increase lr
+                lr_mask * self.lr_dump_scale  # Decrease lr
+            )
+            del lr_mask
+
+            # Clip learning rates to bounds
+            new_lr = torch.clamp(
+                new_lr,
+                min=self.min_lr,
+                max=self.max_lr
+            )
+
+            # Apply the learning rate mask to the update
+            update.mul_(new_lr)
+
+            # quantize the masks like Auto8bitTensor does, with one sync for the scales
+            abs_maxes = new_lr.flatten(1).abs().amax(dim=1).tolist()
+            scales = [abs_max / 127.0 if abs_max > 0 else 1.0 for abs_max in abs_maxes]
+            scales_tensor = torch.tensor(scales, dtype=torch.float32, device=new_lr.device).view(batch_view)
+            quantized = (new_lr / scales_tensor).round_().clamp_(-127, 127).to(torch.int8)
+            avg_lr = new_lr.flatten(1).mean(dim=1)
+            for idx, state in enumerate(states):
+                state['lr_mask'] = Auto8bitTensor({
+                    'quantized': quantized[idx],
+                    'scale': scales[idx],
+                    'orig_dtype': new_lr.dtype
+                })
+                state['avg_lr'] = avg_lr[idx]
+
+            if group["weight_decay"] != 0:
+                p_data_fp32.add_(p_data_fp32 * new_lr * -group["weight_decay"])
+
+            p_data_fp32.add_(-update)
+
+            # stochastic rounding for the whole bucket at once
+            copy_stochastic_multi([p.data for p in bucket], p_data_fp32)
+
     def initialize_state(self, p):
         state = self.state[p]
         state["step"] = 0
@@ -1,6 +1,7 @@
+import threading
 import torch
 from torch import Tensor
-from typing import Optional
+from typing import Callable, List, Optional, Union
 from optimum.quanto import QBytesTensor
 
 
@@ -114,6 +115,138 @@ def get_format_params(dtype: torch.dtype) -> tuple[int, int]:
         raise ValueError(f"Unsupported dtype: {dtype}")
 
 
+def _to_int32(value: int) -> int:
+    # wraps an unsigned 32 bit constant to the signed value an int32 tensor holds
+    value &= 0xFFFFFFFF
+    return value - (1 << 32) if value >= (1 << 31) else value
+
+
+def _mix32(value: int) -> int:
+    # lowbias32 finalizer on a python int, used to turn the seed and call counter into a key
+    value &= 0xFFFFFFFF
+    value ^= value >> 16
+    value = (value * 0x7feb352d) & 0xFFFFFFFF
+    value ^= value >> 15
+    value = (value * 0x846ca68b) & 0xFFFFFFFF
+    value ^= value >> 16
+    return value
+
+
+class StochasticRounder:
+    """
+    Stochastic rounding from float32 to bf16, fp16 and fp8 without allocating per call. The random bits come from a
+    counter based hash of the element index, a seed and a per call counter instead of a randint tensor, and are built
+    in scratch buffers that are kept per device and thread. Large tensors are rounded in chunks so the scratch memory
+    never grows past chunk_numel elements. release_scratch frees the buffers of every thread.
+    """
+
+    def __init__(self, seed: Optional[int] = None, chunk_numel: int = 4 * 1024 * 1024):
+        self.seed = seed
+        self.chunk_numel = chunk_numel
+        self.counter = 0
+        # set to False to use the randint implementation
+        self.enabled = True
+        # (thread id, device) -> scratch buffers
+        self._scratch = {}
+        self._lock = threading.Lock()
+
+    def can_round(self, target: torch.Tensor, source: torch.Tensor) -> bool:
+        return self.enabled and \
+            type(target) in (torch.Tensor, torch.nn.Parameter) and \
+            target.dtype in (torch.bfloat16, torch.float16, torch.float8_e4m3fn, torch.float8_e5m2) and \
+            target.is_contiguous() and \
+            source.dtype == torch.float32 and \
+            source.is_contiguous() and \
+            source.device == target.device
+
+    def _next_key(self) -> int:
+        with self._lock:
+            if self.seed is None:
+                self.seed = torch.initial_seed() & 0xFFFFFFFF
+            self.counter += 1
+            return _to_int32(_mix32(self.seed ^ _mix32(self.counter)))
+
+    def _get_scratch(self, device: torch.device, numel: int):
+        key = (threading.get_ident(), device)
+        buffers = self._scratch.get(key)
+        if buffers is None or buffers[0].numel() < numel:
+            buffers = (
+                torch.empty(numel, dtype=torch.int32, device=device),
+                torch.empty(numel, dtype=torch.int32, device=device),
+            )
+            with self._lock:
+                self._scratch[key] = buffers
+        return buffers[0][:numel], buffers[1][:numel]
+
+    def release_scratch(self):
+        """
+        Frees the scratch buffers of all threads. A call in progress keeps its buffers until it finishes.
+        """
+        with self._lock:
+            self._scratch = {}
+
+    @staticmethod
+    def _hash_(x: torch.Tensor, tmp: torch.Tensor):
+        # lowbias32 on int32. The shifts are logical, so the sign bits shifted in are masked off
+        for shift, multiplier in [(16, 0x7feb352d), (15, 0x846ca68b), (16, None)]:
+            torch.bitwise_right_shift(x, shift, out=tmp)
+            tmp.bitwise_and_((1 << (32 - shift)) - 1)
+            x.bitwise_xor_(tmp)
+            if multiplier is not None:
+                x.mul_(_to_int32(multiplier))
+
+    def _round_flat(self, target: torch.Tensor, source: torch.Tensor, key: int, index_offset: int):
+        # target and source are flat. index_offset keeps the random bits of a multi tensor call independent
+        mantissa_bits, _ = get_format_params(target.dtype)
+        bits_to_round = 23 - mantissa_bits
+        source_int = source.view(dtype=torch.int32)
+        numel = source.numel()
+        for start in range(0, numel, self.chunk_numel):
+            end = min(start + self.chunk_numel, numel)
+            result, tmp = self._get_scratch(source.device, end - start)
+            # the offset is added as a wrapped scalar so huge buffers do not overflow the int32 arange
+            torch.arange(0, end - start, dtype=torch.int32, out=result)
+            result.add_(_to_int32(index_offset + start))
+            # the key is mixed in between two hashes, adding it would give calls with close keys shifted bits
+            self._hash_(result, tmp)
+            result.bitwise_xor_(key)
+            self._hash_(result, tmp)
+            # keep only the bits that get rounded off, add them and truncate
+            result.bitwise_and_((1 << bits_to_round) - 1)
+            result.add_(source_int[start:end])
+            result.bitwise_and_((-1) << bits_to_round)
+            result_float = result.view(dtype=torch.float32)
+            if target.dtype == torch.float8_e4m3fn:
+                result_float.clamp_(-448.0, 448.0)
+            elif target.dtype == torch.float8_e5m2:
+                result_float.clamp_(-57344.0, 57344.0)
+            target[start:end].copy_(result_float)
+
+    def round_(self, target: torch.Tensor, source: torch.Tensor) -> None:
+        """
+        Stochastically rounds source into target. Check can_round first.
+        """
+        with torch.no_grad():
+            self._round_flat(target.view(-1), source.view(-1), self._next_key(), 0)
+
+    def round_multi_(self, targets: List[torch.Tensor], source: torch.Tensor) -> None:
+        """
+        Stochastically rounds a flat float32 buffer holding all the targets back to back, in one call.
+        """
+        with torch.no_grad():
+            key = self._next_key()
+            source = source.view(-1)
+            offset = 0
+            for target in targets:
+                numel = target.numel()
+                self._round_flat(target.view(-1), source[offset:offset + numel], key, offset)
+                offset += numel
+
+
+# shared by copy_stochastic and everything that calls it
+stochastic_rounder = StochasticRounder()
+
+
 def copy_stochastic(
     target: torch.Tensor,
     source: torch.Tensor,
@@ -133,6 +266,10 @@ def copy_stochastic(
             target.copy_(source)
             return
 
+        if eps is None and stochastic_rounder.can_round(target, source):
+            stochastic_rounder.round_(target, source)
+            return
+
         # Special handling for int8
         if target.dtype == torch.int8:
             # Scale the source values to utilize the full int8 range
@@ -254,3 +391,98 @@ def stochastic_grad_accummulation(param):
     else:
         param._accum_grad = param.grad.clone()
         del param.grad
+
+
+# max elements stepped together in one foreach bucket, limits the float32 scratch memory
+FOREACH_MAX_NUMEL = 64 * 1024 * 1024
+
+
+def can_foreach(param: torch.Tensor) -> bool:
+    # quantized params and sparse grads need the per param path
+    return type(param) in (torch.Tensor, torch.nn.Parameter) and param.grad is not None and not param.grad.is_sparse
+
+
+def get_foreach_buckets(
+    params: List[torch.Tensor],
+    key_fn: Optional[Callable] = None,
+    max_numel: int = FOREACH_MAX_NUMEL
+) -> List[List[torch.Tensor]]:
+    """
+    Groups params that can be stepped together. Params are bucketed by dtype, device and anything key_fn returns,
+    then split so a bucket never holds more than max_numel elements unless a single param is larger.
+    """
+    grouped = {}
+    for param in params:
+        key = (param.dtype, param.device)
+        if key_fn is not None:
+            key = key + tuple(key_fn(param))
+        grouped.setdefault(key, []).append(param)
+    buckets = []
+    for group_params in grouped.values():
+        bucket = []
+        bucket_numel = 0
+        for param in group_params:
+            if len(bucket) > 0 and bucket_numel + param.numel() > max_numel:
+                buckets.append(bucket)
+                bucket = []
+                bucket_numel = 0
+            bucket.append(param)
+            bucket_numel += param.numel()
+        if len(bucket) > 0:
+            buckets.append(bucket)
+    return buckets
+
+
+def foreach_copy_(targets: List[torch.Tensor], sources: List[torch.Tensor]) -> None:
+    if hasattr(torch, '_foreach_copy_'):
+        torch._foreach_copy_(targets, sources)
+    else:
+        for target, source in zip(targets, sources):
+            target.copy_(source)
+
+
+def copy_stochastic_multi(
+    targets: List[torch.Tensor],
+    source: Union[torch.Tensor, List[torch.Tensor]]
+) -> None:
+    """
+    Stochastically rounds many tensors in one pass. The source is either a list matching targets or a contiguous
+    float32 buffer holding all of them back to back, like a stacked bucket. All targets must share a dtype.
+    """
+    if len(targets) == 0:
+        return
+    with torch.no_grad():
+        if isinstance(source, (list, tuple)):
+            source = torch.cat([s.reshape(-1) for s in source])
+        source = source.reshape(-1)
+        if all([stochastic_rounder.can_round(t, source) for t in targets]):
+            # rounds straight into the targets
+            stochastic_rounder.round_multi_(targets, source)
+            return
+        if targets[0].dtype == torch.float32:
+            rounded = source
+        else:
+            rounded = torch.empty(source.shape, dtype=targets[0].dtype, device=source.device)
+            copy_stochastic(rounded, source)
+        splits = rounded.split([t.numel() for t in targets])
+        foreach_copy_(targets, [split.view(t.shape) for split, t in zip(splits, targets)])
+
+
+def dequantize_auto8bit_multi(tensors: List[Auto8bitTensor]) -> List[Tensor]:
+    values = [t.quantized.to(torch.float32) for t in tensors]
+    torch._foreach_mul_(values, [float(t.scale) for t in tensors])
+    return values
+
+
+def quantize_auto8bit_multi(tensors: List[Tensor]) -> List[Auto8bitTensor]:
+    # same result as Auto8bitTensor(t) for each tensor, with a single sync for all the scales
+    abs_maxes = torch.stack([t.abs().max() for t in tensors]).tolist()
+    scales = [abs_max / 127.0 if abs_max > 0 else 1.0 for abs_max in abs_maxes]
+    scaled = torch._foreach_div(tensors, scales)
+    torch._foreach_round_(scaled)
+    torch._foreach_clamp_min_(scaled, -127)
+    torch._foreach_clamp_max_(scaled, 127)
+    return [
+        Auto8bitTensor({'quantized': q.to(torch.int8), 'scale': scale, 'orig_dtype': t.dtype})
+        for q, scale, t in zip(scaled, scales, tensors)
+    ]
@@ -0,0 +1,121 @@
+import bisect
+from itertools import accumulate
+from typing import List, Tuple
+
+import torch
+
+from toolkit.optimizers.optimizer_utils import Auto8bitTensor
+
+
+class ParamSwappingMixin:
+    """
+    Trains a window of the params at a time and rotates through them. The windows are planned once from a prefix
+    sum of the param sizes so each holds up to paramiter_swapping_factor of the total, and a swap only touches the
+    params leaving and entering the active window, except the first swap after enabling or loading, which applies the
+    whole mask in case something else changed requires_grad. Optionally the optimizer state of inactive params lives
+    on the cpu. The position in the rotation is saved in the state dict.
+    Expects the optimizer to set do_paramiter_swapping, paramiter_swapping_factor and _total_paramiter_size.
+    """
+
+    def enable_paramiter_swapping(self, paramiter_swapping_factor=0.1, swap_every=1, offload_state=False):
+        self.do_paramiter_swapping = True
+        self.paramiter_swapping_factor = paramiter_swapping_factor
+        self.paramiter_swapping_every = max(int(swap_every), 1)
+        self.paramiter_swapping_offload_state = offload_state
+        self._swap_params: List[torch.nn.Parameter] = [
+            param for group in self.param_groups for param in group['params']
+        ]
+        self._swap_windows = self._plan_swap_windows()
+        self._swap_calls = 0
+        self._active_window = 0
+        self._apply_full_mask()
+
+    def _apply_full_mask(self):
+        for param in self._swap_params:
+            self._deactivate_param(param)
+        for param in self._get_window_params(self._active_window):
+            self._activate_param(param)
+        # the next swap sets every param again, the trainer may turn them all back on before the first step
+        self._needs_full_mask = True
+
+    def _plan_swap_windows(self) -> List[Tuple[int, int]]:
+        prefix = [0] + list(accumulate([torch.numel(param) for param in self._swap_params]))
+        target_paramiters = max(int(self._total_paramiter_size * self.paramiter_swapping_factor), 1)
+        windows = []
+        start = 0
+        while start < len(self._swap_params):
+            # last param that keeps the window within the budget. A param bigger than the budget gets its own
+            end = bisect.bisect_right(prefix, prefix[start] + target_paramiters) - 1
+            end = max(end, start + 1)
+            windows.append((start, end))
+            start = end
+        return windows
+
+    def _get_window_params(self, window_idx: int) -> List[torch.nn.Parameter]:
+        start, end = self._swap_windows[window_idx]
+        return self._swap_params[start:end]
+
+    def swap_paramiters(self):
+        self._swap_calls += 1
+        is_swap_step = self._swap_calls % self.paramiter_swapping_every == 0 and len(self._swap_windows) > 1
+        if self._needs_full_mask:
+            if is_swap_step:
+                self._active_window = (self._active_window + 1) % len(self._swap_windows)
+            self._apply_full_mask()
+            self._needs_full_mask = False
+            return
+        if not is_swap_step:
+            return
+        next_window = (self._active_window + 1) % len(self._swap_windows)
+        for param in self._get_window_params(self._active_window):
+            self._deactivate_param(param)
+        for param in self._get_window_params(next_window):
+            self._activate_param(param)
+        self._active_window = next_window
+
+    def _deactivate_param(self, param: torch.nn.Parameter):
+        param.requires_grad_(False)
+        # remove any grad
+        param.grad = None
+        if hasattr(param, "_accum_grad"):
+            del param._accum_grad
+        if self.paramiter_swapping_offload_state:
+            self._move_param_state(param, torch.device('cpu'))
+
+    def _activate_param(self, param: torch.nn.Parameter):
+        if self.paramiter_swapping_offload_state:
+            self._move_param_state(param, param.device)
+        param.requires_grad_(True)
+
+    def _move_param_state(self, param: torch.nn.Parameter, device: torch.device):
+        if param not in self.state:
+            return
+        # copies to the device do not need to block, copies to the cpu do before they can be read
+        non_blocking = device.type != 'cpu'
+        state = self.state[param]
+        for key, value in state.items():
+            if isinstance(value, torch.Tensor):
+                state[key] = value.to(device, non_blocking=non_blocking)
+            elif isinstance(value, Auto8bitTensor):
+                value.quantized = value.quantized.to(device, non_blocking=non_blocking)
+
+    def state_dict(self, *args, **kwargs):
+        state_dict = super().state_dict(*args, **kwargs)
+        if getattr(self, 'do_paramiter_swapping', False):
+            state_dict['paramiter_swapping'] = {
+                'active_window': self._active_window,
+                'swap_calls': self._swap_calls,
+            }
+        return state_dict
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        swapping_state = state_dict.pop('paramiter_swapping', None)
+        super().load_state_dict(state_dict, *args, **kwargs)
+        if not getattr(self, 'do_paramiter_swapping', False):
+            return
+        if swapping_state is not None:
+            # continue the rotation where it left off
+            self._active_window = swapping_state['active_window'] % len(self._swap_windows)
+            self._swap_calls = swapping_state['swap_calls']
+        # loading puts all the state on the param devices, this offloads the inactive ones again
+        self._apply_full_mask()
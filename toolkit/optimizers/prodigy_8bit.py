@@ -2,7 +2,8 @@ import math
 import torch
 import torch.distributed as dist
 from torch.optim import Optimizer
-from toolkit.optimizers.optimizer_utils import copy_stochastic, Auto8bitTensor, stochastic_grad_accummulation
+from toolkit.optimizers.optimizer_utils import copy_stochastic, Auto8bitTensor, stochastic_grad_accummulation, \
+    can_foreach, get_foreach_buckets, copy_stochastic_multi, dequantize_auto8bit_multi, quantize_auto8bit_multi
 
 
 class Prodigy8bit(Optimizer):
@@ -46,6 +47,8 @@ class Prodigy8bit(Optimizer):
             If you're using sharded parameters, this should be set to True. The optimizer
             will attempt to auto-detect this, but if you're using an implementation other
             than PyTorch's builtin version, the auto-detection won't work.
+        foreach (bool):
+            Step params of the same dtype and device together with foreach ops (default: True).
     """
 
     def __init__(self, params, lr=1.0,
@@ -53,7 +56,7 @@ class Prodigy8bit(Optimizer):
                  eps=1e-8, weight_decay=0, decouple=True,
                  use_bias_correction=False, safeguard_warmup=False,
                  d0=1e-6, d_coef=1.0, growth_rate=float('inf'),
-                 fsdp_in_use=False):
+                 fsdp_in_use=False, foreach=True):
         if not 0.0 < d0:
             raise ValueError("Invalid d0 value: {}".format(d0))
         if not 0.0 < lr:
@@ -81,6 +84,7 @@ class Prodigy8bit(Optimizer):
         self.d0 = d0
         super(Prodigy8bit, self).__init__(params, defaults)
 
+        self.foreach = foreach
         self.is_stochastic_rounding_accumulation = False
 
         # setup stochastic grad accum hooks
@@ -165,9 +169,19 @@ class Prodigy8bit(Optimizer):
                 raise RuntimeError(
                     f"Setting different lr values in different parameter groups is only supported for values of 0")
 
-            for p in group['params']:
-                if p.grad is None:
-                    continue
+            params = [p for p in group['params'] if p.grad is not None]
+            if self.foreach:
+                foreach_params = [p for p in params if can_foreach(p)]
+                group_d_numerator, group_d_denom = self._accumulate_foreach(
+                    group, foreach_params, d, dlr, beta1, beta2, beta3
+                )
+                d_numerator += group_d_numerator
+                d_denom += group_d_denom
+                params = [p for p in params if not can_foreach(p)]
+                if any([hasattr(p, "_fsdp_flattened") for p in foreach_params]):
+                    fsdp_in_use = True
+
+            for p in params:
                 if hasattr(p, "_fsdp_flattened"):
                     fsdp_in_use = True
 
@@ -257,9 +271,12 @@ class Prodigy8bit(Optimizer):
             k = group['k']
             eps = group['eps']
 
-            for p in group['params']:
-                if p.grad is None:
-                    continue
+            params = [p for p in group['params'] if p.grad is not None]
+            if self.foreach:
+                self._step_foreach(group, [p for p in params if can_foreach(p)], d, dlr)
+                params = [p for p in params if not can_foreach(p)]
+
+            for p in params:
                 grad = p.grad.data.to(torch.float32)
                 p_fp32 = p.clone().to(torch.float32)
 
@@ -284,3 +301,102 @@ class Prodigy8bit(Optimizer):
             group['k'] = k + 1
 
         return loss
+
+    def _accumulate_foreach(self, group, params, d, dlr, beta1, beta2, beta3):
+        # first pass of step for the foreach params. Returns what they add to d_numerator and d_denom
+        decay = group['weight_decay']
+        decouple = group['decouple']
+        d0 = group['d0']
+        safeguard_warmup = group['safeguard_warmup']
+        d_numerator = 0.0
+        d_denom = 0.0
+
+        for p in params:
+            state = self.state[p]
+            if 'step' not in state:
+                p_fp32 = p.detach().to(torch.float32)
+                state['step'] = 0
+                state['s'] = Auto8bitTensor(torch.zeros_like(p_fp32))
+                state['p0'] = Auto8bitTensor(p_fp32.clone())
+                state['exp_avg'] = Auto8bitTensor(torch.zeros_like(p_fp32))
+                state['exp_avg_sq'] = Auto8bitTensor(torch.zeros_like(p_fp32))
+
+        for bucket in get_foreach_buckets(params):
+            states = [self.state[p] for p in bucket]
+            grads = [p.grad.to(torch.float32) for p in bucket]
+            p_fp32 = [p.detach().to(torch.float32) for p in bucket]
+
+            # Apply weight decay (coupled variant)
+            if decay != 0 and not decouple:
+                grads = torch._foreach_add(grads, p_fp32, alpha=decay)
+
+            exp_avgs = dequantize_auto8bit_multi([state['exp_avg'] for state in states])
+            exp_avg_sqs = dequantize_auto8bit_multi([state['exp_avg_sq'] for state in states])
+            s = dequantize_auto8bit_multi([state['s'] for state in states])
+            p0 = dequantize_auto8bit_multi([state['p0'] for state in states])
+
+            if group['lr'] > 0.0:
+                # one sync for the whole bucket instead of one per param
+                p0_diff = torch._foreach_sub(p0, p_fp32)
+                dots = torch.stack([torch.dot(g.flatten(), diff.flatten()) for g, diff in zip(grads, p0_diff)])
+                d_numerator += (d / d0) * dlr * dots.sum().item()
+                del p0_diff
+
+                # Adam EMA updates
+                torch._foreach_mul_(exp_avgs, beta1)
+                torch._foreach_add_(exp_avgs, grads, alpha=d * (1 - beta1))
+                torch._foreach_mul_(exp_avg_sqs, beta2)
+                torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=d * d * (1 - beta2))
+
+                torch._foreach_mul_(s, beta3)
+                if safeguard_warmup:
+                    torch._foreach_add_(s, grads, alpha=((d / d0) * d))
+                else:
+                    torch._foreach_add_(s, grads, alpha=((d / d0) * dlr))
+                d_denom += torch.stack(torch._foreach_norm(s, 1)).sum().item()
+
+            # update state with stochastic rounding
+            for state, exp_avg, exp_avg_sq, s_state, p0_state in zip(
+                    states,
+                    quantize_auto8bit_multi(exp_avgs),
+                    quantize_auto8bit_multi(exp_avg_sqs),
+                    quantize_auto8bit_multi(s),
+                    quantize_auto8bit_multi(p0),
+            ):
+                state['exp_avg'] = exp_avg
+                state['exp_avg_sq'] = exp_avg_sq
+                state['s'] = s_state
+                state['p0'] = p0_state
+
+        return d_numerator, d_denom
+
+    def _step_foreach(self, group, params, d, dlr):
+        # second pass of step for the foreach params
+        decay = group['weight_decay']
+        decouple = group['decouple']
+        eps = group['eps']
+
+        for bucket in get_foreach_buckets(params):
+            states = [self.state[p] for p in bucket]
+            # float32 params are updated in place
+            p_fp32 = [p.detach().to(torch.float32) for p in bucket]
+
+            exp_avgs = dequantize_auto8bit_multi([state['exp_avg'] for state in states])
+            exp_avg_sqs = dequantize_auto8bit_multi([state['exp_avg_sq'] for state in states])
+
+            for state in states:
+                state['step'] += 1
+
+            denom = torch._foreach_sqrt(exp_avg_sqs)
+            torch._foreach_add_(denom, d * eps)
+
+            # Apply weight decay (decoupled variant)
+            if decay != 0 and decouple:
+                torch._foreach_add_(p_fp32, p_fp32, alpha=-decay * dlr)
+
+            # Take step
+            torch._foreach_addcdiv_(p_fp32, exp_avgs, denom, value=-dlr)
+
+            if bucket[0].dtype != torch.float32:
+                # apply stochastic rounding
+                copy_stochastic_multi([p.data for p in bucket], p_fp32)
@@ -62,6 +62,21 @@ class PromptEmbeds:
             prompt_embeds.attention_mask = self.attention_mask.clone()
         return prompt_embeds
 
+    def save(self, path: str, meta: Optional[dict] = None):
+        state_dict = {'text_embeds': self.text_embeds.detach().to('cpu').contiguous().clone()}
+        if self.pooled_embeds is not None:
+            state_dict['pooled_embeds'] = self.pooled_embeds.detach().to('cpu').contiguous().clone()
+        if self.attention_mask is not None:
+            state_dict['attention_mask'] = self.attention_mask.detach().to('cpu').contiguous().clone()
+        save_file(state_dict, path, metadata=meta)
+
+    @classmethod
+    def load(cls, path: str, device='cpu') -> 'PromptEmbeds':
+        state_dict = load_file(path, device=device)
+        prompt_embeds = cls([state_dict['text_embeds'], state_dict.get('pooled_embeds', None)])
+        prompt_embeds.attention_mask = state_dict.get('attention_mask', None)
+        return prompt_embeds
+
 
 class EncodedPromptPair:
     def __init__(
@@ -135,7 +150,10 @@ def concat_prompt_embeds(prompt_embeds: list[PromptEmbeds]):
     pooled_embeds = None
     if prompt_embeds[0].pooled_embeds is not None:
         pooled_embeds = torch.cat([p.pooled_embeds for p in prompt_embeds], dim=0)
-    return PromptEmbeds([text_embeds, pooled_embeds])
+    attention_mask = None
+    if prompt_embeds[0].attention_mask is not None:
+        attention_mask = torch.cat([p.attention_mask for p in prompt_embeds], dim=0)
+    return PromptEmbeds([text_embeds, pooled_embeds], attention_mask=attention_mask)
 
 
 def concat_prompt_pairs(prompt_pairs: list[EncodedPromptPair]):
@@ -184,9 +202,14 @@ def split_prompt_embeds(concatenated: PromptEmbeds, num_parts=None) -> List[Prom
     else:
         pooled_embeds_splits = [None] * num_parts
 
+    if concatenated.attention_mask is not None:
+        attention_mask_splits = torch.chunk(concatenated.attention_mask, num_parts, dim=0)
+    else:
+        attention_mask_splits = [None] * num_parts
+
     prompt_embeds_list = [
-        PromptEmbeds([text, pooled])
-        for text, pooled in zip(text_embeds_splits, pooled_embeds_splits)
+        PromptEmbeds([text, pooled], attention_mask=attention_mask)
+        for text, pooled, attention_mask in zip(text_embeds_splits, pooled_embeds_splits, attention_mask_splits)
     ]
 
     return prompt_embeds_list
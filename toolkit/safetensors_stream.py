@@ -0,0 +1,137 @@
+import glob
+import os
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Tuple, Union
+
+import torch
+from safetensors import safe_open
+
+from toolkit.metadata import ModelHasher, get_hash_metadata, get_safetensors_header_bytes, \
+    get_safetensors_header_layout, safetensors_dtype_map, tensor_to_bytes
+
+
+class LazySafetensors:
+    """
+    Reads tensors from safetensors files one key at a time instead of loading the whole state dict. Takes a
+    file, a list of files or a folder of shards. Shapes and dtypes come from the headers without reading data.
+    """
+
+    def __init__(self, path: Union[str, List[str]], device: str = 'cpu'):
+        if isinstance(path, str) and os.path.isdir(path):
+            paths = sorted(glob.glob(os.path.join(path, '*.safetensors')))
+        elif isinstance(path, str):
+            paths = [path]
+        else:
+            paths = list(path)
+        if len(paths) == 0:
+            raise FileNotFoundError(f"No safetensors files found at {path}")
+        self.path = path
+        self.device = device
+        self.handles = []
+        self.key_to_handle = OrderedDict()
+        for file_path in paths:
+            handle = safe_open(file_path, framework='pt', device=device)
+            self.handles.append(handle)
+            for key in handle.keys():
+                self.key_to_handle[key] = handle
+
+    def keys(self) -> List[str]:
+        return list(self.key_to_handle.keys())
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.key_to_handle
+
+    def __len__(self) -> int:
+        return len(self.key_to_handle)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def __getitem__(self, key: str) -> torch.Tensor:
+        return self.key_to_handle[key].get_tensor(key)
+
+    def get_shape(self, key: str) -> List[int]:
+        return list(self.key_to_handle[key].get_slice(key).get_shape())
+
+    def items(self) -> Iterator[Tuple[str, torch.Tensor]]:
+        # only one tensor is loaded at a time
+        for key in self.keys():
+            yield key, self[key]
+
+    def metadata(self) -> Dict[str, str]:
+        metadata = self.handles[0].metadata() if len(self.handles) > 0 else None
+        return metadata if metadata is not None else {}
+
+    def close(self):
+        self.key_to_handle = OrderedDict()
+        self.handles = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class SafetensorsStreamWriter:
+    """
+    Writes a safetensors file one tensor at a time. The dtypes and shapes are declared up front so the header can
+    be laid out, then the tensors have to be written in the order of keys(). Adds the model hashes to the metadata
+    the same way save_file_with_model_hash does.
+    """
+
+    def __init__(
+            self,
+            filename: str,
+            tensor_specs: Dict[str, Tuple[torch.dtype, List[int]]],
+            meta: Union[OrderedDict, None] = None,
+            add_model_hash: bool = True,
+    ):
+        self.filename = filename
+        self.tensor_header = get_safetensors_header_layout(tensor_specs)
+        self.key_order = list(self.tensor_header.keys())
+        self.next_idx = 0
+        if meta is None and add_model_hash:
+            meta = OrderedDict()
+        self.meta = meta
+        self.hasher = None
+        if add_model_hash:
+            self.hasher = ModelHasher()
+            self.hasher.update(
+                get_safetensors_header_bytes(self.tensor_header, get_hash_metadata(meta)), is_header=True
+            )
+            # fixed length placeholders so the header size does not change when the hashes are filled in
+            self.meta["sshs_model_hash"] = "0" * 64
+            self.meta["sshs_legacy_hash"] = "0" * 8
+        header_size = len(get_safetensors_header_bytes(self.tensor_header, self.meta))
+        self.file = open(filename, "wb")
+        self.file.seek(header_size)
+
+    def keys(self) -> List[str]:
+        return list(self.key_order)
+
+    def write(self, key: str, tensor: torch.Tensor):
+        expected_key = self.key_order[self.next_idx] if self.next_idx < len(self.key_order) else None
+        if key != expected_key:
+            raise ValueError(f"Expected tensor {expected_key} next, got {key}")
+        entry = self.tensor_header[key]
+        if safetensors_dtype_map[tensor.dtype][1] != entry["dtype"] or list(tensor.shape) != entry["shape"]:
+            raise ValueError(
+                f"Tensor {key} is {tensor.dtype} {list(tensor.shape)}, expected {entry['dtype']} {entry['shape']}"
+            )
+        data = tensor_to_bytes(tensor)
+        if self.hasher is not None:
+            self.hasher.update(data)
+        self.file.write(data)
+        self.next_idx += 1
+
+    def close(self) -> Union[OrderedDict, None]:
+        if self.next_idx != len(self.key_order):
+            self.file.close()
+            raise ValueError(f"Only {self.next_idx} of {len(self.key_order)} tensors were written to {self.filename}")
+        if self.hasher is not None:
+            self.meta["sshs_model_hash"], self.meta["sshs_legacy_hash"] = self.hasher.get_hashes()
+        self.file.seek(0)
+        self.file.write(get_safetensors_header_bytes(self.tensor_header, self.meta))
+        self.file.close()
+        return self.meta
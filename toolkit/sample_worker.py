@@ -0,0 +1,235 @@
+import copy
+import queue
+import traceback
+from collections import OrderedDict
+from typing import List, Union, Type, TYPE_CHECKING
+
+import torch
+import torch.multiprocessing as mp
+
+from toolkit.config_modules import ModelConfig, GenerateImageConfig
+from toolkit.logging import EmptyLogger
+
+if TYPE_CHECKING:
+    from toolkit.network_mixins import Network
+
+
+class SampleImageCollector(EmptyLogger):
+    # stands in for the logger in the worker, keeps the images to send back to the training process
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.images = []
+
+    def log_image(self, image, id, caption=None, *args, **kwargs):
+        self.images.append((image, id, caption))
+
+
+def load_sample_model(
+        device: str,
+        model_config: ModelConfig,
+        dtype: str,
+        noise_scheduler: str,
+        network_class: Union[Type['Network'], None] = None,
+        network_kwargs: Union[dict, None] = None,
+        train_text_encoder: bool = False,
+        train_unet: bool = True,
+        custom_pipeline=None,
+):
+    from toolkit.sampler import get_sampler
+    from toolkit.stable_diffusion_model import StableDiffusion
+
+    model_config = copy.deepcopy(model_config)
+    # everything for sampling lives on the worker device
+    model_config.vae_device = None
+    model_config.te_device = None
+
+    sd = StableDiffusion(
+        device=device,
+        model_config=model_config,
+        dtype=dtype,
+        custom_pipeline=custom_pipeline,
+        noise_scheduler=get_sampler(
+            noise_scheduler,
+            {
+                "prediction_type": "v_prediction" if model_config.is_v_pred else "epsilon",
+            },
+            'sd' if not model_config.is_pixart else 'pixart'
+        ),
+    )
+    sd.load_model()
+
+    text_encoders = sd.text_encoder if isinstance(sd.text_encoder, list) else [sd.text_encoder]
+    for te in text_encoders:
+        te.requires_grad_(False)
+        te.eval()
+    sd.unet.requires_grad_(False)
+    sd.unet.eval()
+    sd.vae.requires_grad_(False)
+    sd.vae.eval()
+
+    if network_class is not None:
+        # same network as the trainer so the state dict keys match
+        network = network_class(
+            text_encoder=sd.text_encoder,
+            unet=sd.unet,
+            **network_kwargs
+        )
+        network.force_to(sd.device_torch, dtype=torch.float32)
+        sd.network = network
+        network._update_torch_multiplier()
+        network.apply_to(
+            sd.text_encoder,
+            sd.unet,
+            train_text_encoder,
+            train_unet
+        )
+        # we cannot merge in if quantized
+        if model_config.quantize:
+            network.can_merge_in = False
+        network.requires_grad_(False)
+        network.eval()
+    return sd
+
+
+@torch.no_grad()
+def run_sample_worker(model_kwargs: dict, request_queue, result_queue):
+    try:
+        sd = load_sample_model(**model_kwargs)
+    except Exception as e:
+        traceback.print_exc()
+        result_queue.put((None, [], f"Error loading sample model: {e}"))
+        return
+
+    while True:
+        request = request_queue.get()
+        if request is None:
+            return
+        step, state_dict, image_configs, sampler, batch_size = request
+        try:
+            if sd.network is not None and state_dict is not None:
+                # a mismatch would quietly render the base model, so report it instead
+                info = sd.network.load_state_dict(state_dict, False)
+                if len(info.missing_keys) > 0 or len(info.unexpected_keys) > 0:
+                    raise RuntimeError(
+                        f"Sample network does not match the training network. Missing keys: {info.missing_keys}, "
+                        f"unexpected keys: {info.unexpected_keys}"
+                    )
+            collector = SampleImageCollector()
+            for image_config in image_configs:
+                image_config.logger = collector
+            sd.generate_images(image_configs, sampler=sampler, batch_size=batch_size)
+            result_queue.put((step, collector.images, None))
+        except Exception as e:
+            traceback.print_exc()
+            result_queue.put((step, [], f"Error generating samples: {e}"))
+
+
+class SampleWorker:
+    """
+    Renders samples in a separate process that loads its own copy of the frozen base model and the same network
+    as the trainer. submit() hands it a cpu snapshot of the trainable weights and the image configs, the images
+    are saved by the worker and sent back with their step for the trainer to log. The process starts on the
+    first submit, so it does not load the model unless sampling happens.
+    """
+
+    def __init__(
+            self,
+            device: str,
+            model_config: ModelConfig,
+            dtype: str,
+            noise_scheduler: str,
+            network_class: Union[Type['Network'], None] = None,
+            network_kwargs: Union[dict, None] = None,
+            train_text_encoder: bool = False,
+            train_unet: bool = True,
+            custom_pipeline=None,
+            max_pending: int = 2,
+    ):
+        self.model_kwargs = {
+            'device': device,
+            'model_config': model_config,
+            'dtype': dtype,
+            'noise_scheduler': noise_scheduler,
+            'network_class': network_class,
+            'network_kwargs': network_kwargs if network_kwargs is not None else {},
+            'train_text_encoder': train_text_encoder,
+            'train_unet': train_unet,
+            'custom_pipeline': custom_pipeline,
+        }
+        # cuda cannot be re-initialized in a forked process
+        self.ctx = mp.get_context('spawn')
+        self.request_queue = self.ctx.Queue(maxsize=max(1, max_pending))
+        self.result_queue = self.ctx.Queue()
+        self.process = None
+        self.num_pending = 0
+
+    def start(self):
+        if self.process is not None:
+            return
+        self.process = self.ctx.Process(
+            target=run_sample_worker,
+            args=(self.model_kwargs, self.request_queue, self.result_queue),
+            daemon=True
+        )
+        self.process.start()
+
+    def check_alive(self):
+        if self.process is not None and not self.process.is_alive() and self.result_queue.empty():
+            raise RuntimeError(f"Sample worker exited with code {self.process.exitcode}")
+
+    @staticmethod
+    def snapshot_state_dict(state_dict: OrderedDict) -> OrderedDict:
+        # plain cpu copies, pinned memory cannot be shared with the worker
+        return OrderedDict([(key, value.detach().to('cpu', copy=True)) for key, value in state_dict.items()])
+
+    def submit(
+            self,
+            step: int,
+            state_dict: Union[OrderedDict, None],
+            image_configs: List[GenerateImageConfig],
+            sampler: str = None,
+            batch_size: int = 1,
+    ):
+        self.start()
+        worker_configs = []
+        for image_config in image_configs:
+            # the logger stays in the training process
+            worker_config = copy.copy(image_config)
+            worker_config.logger = None
+            worker_configs.append(worker_config)
+        request = (step, state_dict, worker_configs, sampler, batch_size)
+        # blocks when the worker is max_pending rounds behind
+        while True:
+            try:
+                self.request_queue.put(request, timeout=1.0)
+                break
+            except queue.Full:
+                self.check_alive()
+        self.num_pending += 1
+
+    def get_results(self, block: bool = False):
+        # [(step, [(image, id, caption)], error)] for every finished round, waits for all of them if block
+        results = []
+        while self.num_pending > 0:
+            try:
+                result = self.result_queue.get(timeout=1.0) if block else self.result_queue.get_nowait()
+            except queue.Empty:
+                if not block:
+                    break
+                self.check_alive()
+                continue
+            step, images, error = result
+            if step is None:
+                # the model failed to load, nothing else will come back
+                self.num_pending = 0
+                raise RuntimeError(error)
+            self.num_pending -= 1
+            results.append(result)
+        return results
+
+    def close(self):
+        if self.process is not None:
+            if self.process.is_alive():
+                self.request_queue.put(None)
+            self.process.join()
+            self.process = None
@@ -40,14 +40,18 @@ class CustomFlowMatchEulerDiscreteScheduler(FlowMatchEulerDiscreteScheduler):
             pass
 
     def get_weights_for_timesteps(self, timesteps: torch.Tensor, v2=False) -> torch.Tensor:
-        # Get the indices of the timesteps
-        step_indices = [(self.timesteps == t).nonzero().item() for t in timesteps]
+        # Get the indices of the timesteps, first match without syncing with the device
+        timesteps = timesteps.to(self.timesteps.device)
+        matches = self.timesteps.unsqueeze(0) == timesteps.unsqueeze(1)
+        # argmax would silently give index 0 for a timestep not in the schedule, fail on the device instead
+        torch._assert_async(matches.any(dim=1).all(), "timestep not found in the scheduler timesteps")
+        step_indices = matches.int().argmax(dim=1)
 
         # Get the weights for the timesteps
         if v2:
-            weights = self.linear_timesteps_weights2[step_indices].flatten()
+            weights = self.linear_timesteps_weights2.to(step_indices.device)[step_indices].flatten()
         else:
-            weights = self.linear_timesteps_weights[step_indices].flatten()
+            weights = self.linear_timesteps_weights.to(step_indices.device)[step_indices].flatten()
 
         return weights
 
@@ -11,6 +11,7 @@ from toolkit.paths import KEYMAPS_ROOT
 
 if TYPE_CHECKING:
     from toolkit.stable_diffusion_model import StableDiffusion
+    from toolkit.checkpoint_writer import AsyncCheckpointWriter
 
 
 def get_slices_from_string(s: str) -> tuple:
@@ -141,10 +142,15 @@ def save_ldm_model_from_diffusers(
         output_file: str,
         meta: 'OrderedDict',
         save_dtype=get_torch_dtype('fp16'),
-        sd_version: Literal['1', '2', 'sdxl', 'ssd', 'vega'] = '2'
+        sd_version: Literal['1', '2', 'sdxl', 'ssd', 'vega'] = '2',
+        writer: Optional['AsyncCheckpointWriter'] = None
 ):
+    state_dict = sd.state_dict()
+    if writer is not None:
+        # snapshot to cpu first so the conversion below never shares memory with the model
+        state_dict = writer.snapshot(state_dict, save_dtype)
     converted_state_dict = get_ldm_state_dict_from_diffusers(
-        sd.state_dict(),
+        state_dict,
         sd_version,
         device='cpu',
         dtype=save_dtype
@@ -152,7 +158,10 @@ def save_ldm_model_from_diffusers(
 
     # make sure parent folder exists
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
-    save_file(converted_state_dict, output_file, metadata=meta)
+    if writer is not None:
+        writer.submit(save_file, converted_state_dict, output_file, metadata=meta)
+    else:
+        save_file(converted_state_dict, output_file, metadata=meta)
 
 
 def save_lora_from_diffusers(
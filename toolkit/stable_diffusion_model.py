@@ -4,7 +4,7 @@ import json
 import random
 import shutil
 import typing
-from typing import Union, List, Literal, Iterator
+from typing import Union, List, Literal, Iterator, Dict
 import sys
 import os
 from collections import OrderedDict
@@ -33,7 +33,7 @@ from toolkit.config_modules import ModelConfig, GenerateImageConfig
 from toolkit.metadata import get_meta_for_safetensors
 from toolkit.models.decorator import Decorator
 from toolkit.paths import REPOS_ROOT, KEYMAPS_ROOT
-from toolkit.prompt_utils import inject_trigger_into_prompt, PromptEmbeds, concat_prompt_embeds
+from toolkit.prompt_utils import inject_trigger_into_prompt, PromptEmbeds, concat_prompt_embeds, split_prompt_embeds
 from toolkit.reference_adapter import ReferenceAdapter
 from toolkit.sampler import get_sampler
 from toolkit.samplers.custom_flowmatch_sampler import CustomFlowMatchEulerDiscreteScheduler
@@ -67,6 +67,7 @@ from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
     from toolkit.lora_special import LoRASpecialNetwork
+    from toolkit.checkpoint_writer import AsyncCheckpointWriter
 
 # tell it to shut up
 diffusers.logging.set_verbosity(diffusers.logging.ERROR)
@@ -168,6 +169,10 @@ class StableDiffusion:
         self.network = None
         self.adapter: Union['ControlNetModel', 'T2IAdapter', 'IPAdapter', 'ReferenceAdapter', None] = None
         self.decorator: Union[Decorator, None] = None
+        # (text encoder ids, prompt, prompt 2) -> PromptEmbeds for sample prompts, reused across sampling rounds
+        self.sample_prompt_embeds_cache: Dict[tuple, PromptEmbeds] = {}
+        # set by the trainer when the text encoder or an embedding is trained, disables the sample prompt cache
+        self.is_training_text_encoder = False
         self.is_xl = model_config.is_xl
         self.is_v2 = model_config.is_v2
         self.is_ssd = model_config.is_ssd
@@ -916,6 +921,7 @@ class StableDiffusion:
             image_configs: List[GenerateImageConfig],
             sampler=None,
             pipeline: Union[None, StableDiffusionPipeline, StableDiffusionXLPipeline] = None,
+            batch_size: int = 1,
     ):
         merge_multiplier = 1.0
         flush()
@@ -1129,6 +1135,11 @@ class StableDiffusion:
                 if self.network is not None:
                     assert self.network.is_active
 
+                if batch_size > 1 and self.can_generate_images_batched(image_configs, sampler):
+                    self.generate_images_batched(pipeline, image_configs, sampler, batch_size)
+                    # all generated, skip the one at a time loop
+                    image_configs = []
+
                 for i in tqdm(range(len(image_configs)), desc=f"Generating Images", leave=False):
                     gen_config = image_configs[i]
 
@@ -1201,12 +1212,12 @@ class StableDiffusion:
                     # encode the prompt ourselves so we can do fun stuff with embeddings
                     if isinstance(self.adapter, CustomAdapter):
                         self.adapter.is_unconditional_run = False
-                    conditional_embeds = self.encode_prompt(gen_config.prompt, gen_config.prompt_2, force_all=True)
+                    conditional_embeds = self.encode_sample_prompts([gen_config.prompt], [gen_config.prompt_2])
 
                     if isinstance(self.adapter, CustomAdapter):
                         self.adapter.is_unconditional_run = True
-                    unconditional_embeds = self.encode_prompt(
-                        gen_config.negative_prompt, gen_config.negative_prompt_2, force_all=True
+                    unconditional_embeds = self.encode_sample_prompts(
+                        [gen_config.negative_prompt], [gen_config.negative_prompt_2]
                     )
                     if isinstance(self.adapter, CustomAdapter):
                         self.adapter.is_unconditional_run = False
@@ -1268,140 +1279,15 @@ class StableDiffusion:
                     conditional_embeds = conditional_embeds.to(self.device_torch, dtype=self.unet.dtype)
                     unconditional_embeds = unconditional_embeds.to(self.device_torch, dtype=self.unet.dtype)
 
-                    if self.is_xl:
-                        # fix guidance rescale for sdxl
-                        # was trained on 0.7 (I believe)
-
-                        grs = gen_config.guidance_rescale
-                        # if grs is None or grs < 0.00001:
-                        #     grs = 0.7
-                        # grs = 0.0
-
-                        if sampler.startswith("sample_"):
-                            extra['use_karras_sigmas'] = True
-                            extra = {
-                                **extra,
-                                **gen_config.extra_kwargs,
-                            }
-
-                        img = pipeline(
-                            # prompt=gen_config.prompt,
-                            # prompt_2=gen_config.prompt_2,
-                            prompt_embeds=conditional_embeds.text_embeds,
-                            pooled_prompt_embeds=conditional_embeds.pooled_embeds,
-                            negative_prompt_embeds=unconditional_embeds.text_embeds,
-                            negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
-                            # negative_prompt=gen_config.negative_prompt,
-                            # negative_prompt_2=gen_config.negative_prompt_2,
-                            height=gen_config.height,
-                            width=gen_config.width,
-                            num_inference_steps=gen_config.num_inference_steps,
-                            guidance_scale=gen_config.guidance_scale,
-                            guidance_rescale=grs,
-                            latents=gen_config.latents,
-                            generator=generator,
-                            **extra
-                        ).images[0]
-                    elif self.is_v3:
-                        img = pipeline(
-                            prompt_embeds=conditional_embeds.text_embeds,
-                            pooled_prompt_embeds=conditional_embeds.pooled_embeds,
-                            negative_prompt_embeds=unconditional_embeds.text_embeds,
-                            negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
-                            height=gen_config.height,
-                            width=gen_config.width,
-                            num_inference_steps=gen_config.num_inference_steps,
-                            guidance_scale=gen_config.guidance_scale,
-                            latents=gen_config.latents,
-                            generator=generator,
-                            **extra
-                        ).images[0]
-                    elif self.is_flux:
-                        if self.model_config.use_flux_cfg:
-                            img = pipeline(
-                                prompt_embeds=conditional_embeds.text_embeds,
-                                pooled_prompt_embeds=conditional_embeds.pooled_embeds,
-                                negative_prompt_embeds=unconditional_embeds.text_embeds,
-                                negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
-                                height=gen_config.height,
-                                width=gen_config.width,
-                                num_inference_steps=gen_config.num_inference_steps,
-                                guidance_scale=gen_config.guidance_scale,
-                                latents=gen_config.latents,
-                                generator=generator,
-                                **extra
-                            ).images[0]
-                        else:
-                            img = pipeline(
-                                prompt_embeds=conditional_embeds.text_embeds,
-                                pooled_prompt_embeds=conditional_embeds.pooled_embeds,
-                                # negative_prompt_embeds=unconditional_embeds.text_embeds,
-                                # negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
-                                height=gen_config.height,
-                                width=gen_config.width,
-                                num_inference_steps=gen_config.num_inference_steps,
-                                guidance_scale=gen_config.guidance_scale,
-                                latents=gen_config.latents,
-                                generator=generator,
-                                **extra
-                            ).images[0]
-                    elif self.is_pixart:
-                        # needs attention masks for some reason
-                        img = pipeline(
-                            prompt=None,
-                            prompt_embeds=conditional_embeds.text_embeds.to(self.device_torch, dtype=self.unet.dtype),
-                            prompt_attention_mask=conditional_embeds.attention_mask.to(self.device_torch,
-                                                                                       dtype=self.unet.dtype),
-                            negative_prompt_embeds=unconditional_embeds.text_embeds.to(self.device_torch,
-                                                                                       dtype=self.unet.dtype),
-                            negative_prompt_attention_mask=unconditional_embeds.attention_mask.to(self.device_torch,
-                                                                                                  dtype=self.unet.dtype),
-                            negative_prompt=None,
-                            # negative_prompt=gen_config.negative_prompt,
-                            height=gen_config.height,
-                            width=gen_config.width,
-                            num_inference_steps=gen_config.num_inference_steps,
-                            guidance_scale=gen_config.guidance_scale,
-                            latents=gen_config.latents,
-                            generator=generator,
-                            **extra
-                        ).images[0]
-                    elif self.is_auraflow:
-                        pipeline: AuraFlowPipeline = pipeline
-
-                        img = pipeline(
-                            prompt=None,
-                            prompt_embeds=conditional_embeds.text_embeds.to(self.device_torch, dtype=self.unet.dtype),
-                            prompt_attention_mask=conditional_embeds.attention_mask.to(self.device_torch,
-                                                                                       dtype=self.unet.dtype),
-                            negative_prompt_embeds=unconditional_embeds.text_embeds.to(self.device_torch,
-                                                                                       dtype=self.unet.dtype),
-                            negative_prompt_attention_mask=unconditional_embeds.attention_mask.to(self.device_torch,
-                                                                                                  dtype=self.unet.dtype),
-                            negative_prompt=None,
-                            # negative_prompt=gen_config.negative_prompt,
-                            height=gen_config.height,
-                            width=gen_config.width,
-                            num_inference_steps=gen_config.num_inference_steps,
-                            guidance_scale=gen_config.guidance_scale,
-                            latents=gen_config.latents,
-                            generator=generator,
-                            **extra
-                        ).images[0]
-                    else:
-                        img = pipeline(
-                            # prompt=gen_config.prompt,
-                            prompt_embeds=conditional_embeds.text_embeds,
-                            negative_prompt_embeds=unconditional_embeds.text_embeds,
-                            # negative_prompt=gen_config.negative_prompt,
-                            height=gen_config.height,
-                            width=gen_config.width,
-                            num_inference_steps=gen_config.num_inference_steps,
-                            guidance_scale=gen_config.guidance_scale,
-                            latents=gen_config.latents,
-                            generator=generator,
-                            **extra
-                        ).images[0]
+                    img = self.generate_pipeline_images(
+                        pipeline,
+                        gen_config,
+                        conditional_embeds,
+                        unconditional_embeds,
+                        generator,
+                        sampler,
+                        extra,
+                    )[0]
 
                     if self.refiner_unet is not None and gen_config.refiner_start_at < 1.0:
                         # slide off just the last 1280 on the last dim as refiner does not use first text encoder
@@ -1422,7 +1308,7 @@ class StableDiffusion:
                             negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
                             num_inference_steps=gen_config.num_inference_steps,
                             guidance_scale=gen_config.guidance_scale,
-                            guidance_rescale=grs,
+                            guidance_rescale=gen_config.guidance_rescale,
                             denoising_start=gen_config.refiner_start_at,
                             denoising_end=gen_config.num_inference_steps,
                             image=img.unsqueeze(0),
@@ -1475,6 +1361,285 @@ class StableDiffusion:
 
         flush()
 
+    def can_cache_sample_prompt_embeds(self) -> bool:
+        # these adapters hook into the text encoder while encoding
+        if isinstance(self.adapter, ClipVisionAdapter) or isinstance(self.adapter, CustomAdapter):
+            return False
+        # training the text encoder or an embedding, which trains the input embeddings
+        if self.is_training_text_encoder:
+            return False
+        # training a lora on the text encoder
+        if self.network is not None and len(getattr(self.network, 'text_encoder_loras', [])) > 0:
+            return False
+        # anything else left trainable on the text encoder
+        text_encoders = self.text_encoder if isinstance(self.text_encoder, list) else [self.text_encoder]
+        for text_encoder in text_encoders:
+            if text_encoder is not None and any([p.requires_grad for p in text_encoder.parameters()]):
+                return False
+        return True
+
+    def encode_sample_prompts(self, prompts: List[str], prompts2: List[str]) -> PromptEmbeds:
+        # encodes prompts for sampling, reusing embeds from earlier rounds while they cannot have changed
+        if not self.can_cache_sample_prompt_embeds():
+            self.sample_prompt_embeds_cache = {}
+            return self.encode_prompt(prompts, prompts2, force_all=True)
+
+        text_encoders = self.text_encoder if isinstance(self.text_encoder, list) else [self.text_encoder]
+        text_encoder_ids = tuple([id(text_encoder) for text_encoder in text_encoders])
+        keys = [(text_encoder_ids, prompt, prompt2) for prompt, prompt2 in zip(prompts, prompts2)]
+
+        to_encode = list(OrderedDict.fromkeys([key for key in keys if key not in self.sample_prompt_embeds_cache]))
+        if len(to_encode) > 0:
+            prompt_embeds = self.encode_prompt(
+                [key[1] for key in to_encode],
+                [key[2] for key in to_encode],
+                force_all=True
+            )
+            for key, embeds in zip(to_encode, split_prompt_embeds(prompt_embeds, len(to_encode))):
+                self.sample_prompt_embeds_cache[key] = embeds.detach()
+
+        # concat makes new tensors so the cached ones are never modified
+        return concat_prompt_embeds([self.sample_prompt_embeds_cache[key] for key in keys])
+
+    def can_generate_images_batched(self, image_configs: List[GenerateImageConfig], sampler: str) -> bool:
+        # adapters, the refiner and starting latents are handled per image
+        if self.adapter is not None or self.refiner_unet is not None:
+            return False
+        if sampler is not None and sampler.startswith("sample_"):
+            return False
+        for gen_config in image_configs:
+            if gen_config.latents is not None:
+                return False
+            # subclasses that change the embeddings expect one image at a time
+            if type(gen_config).post_process_embeddings is not GenerateImageConfig.post_process_embeddings:
+                return False
+        return True
+
+    def generate_images_batched(
+            self,
+            pipeline,
+            image_configs: List[GenerateImageConfig],
+            sampler: str,
+            batch_size: int,
+    ):
+        # configs that only differ by prompt and seed share a pipeline call. Each image gets its own generator
+        # seeded like the one at a time path, so a seed gives the same starting noise either way
+        groups = OrderedDict()
+        for i, gen_config in enumerate(image_configs):
+            key = (
+                gen_config.width,
+                gen_config.height,
+                gen_config.num_inference_steps,
+                gen_config.guidance_scale,
+                gen_config.guidance_rescale,
+                gen_config.network_multiplier,
+            )
+            if key not in groups:
+                groups[key] = []
+            groups[key].append(i)
+        batches = []
+        for idxs in groups.values():
+            for start_idx in range(0, len(idxs), batch_size):
+                batches.append(idxs[start_idx:start_idx + batch_size])
+
+        images = {}
+        num_saved = 0
+        for batch_idxs in tqdm(batches, desc=f"Generating Images", leave=False):
+            gen_configs = [image_configs[i] for i in batch_idxs]
+            first_config = gen_configs[0]
+
+            if self.network is not None:
+                self.network.multiplier = first_config.network_multiplier
+            torch.manual_seed(first_config.seed)
+            torch.cuda.manual_seed(first_config.seed)
+
+            generator = [torch.Generator().manual_seed(gen_config.seed) for gen_config in gen_configs]
+
+            conditional_embeds = self.encode_sample_prompts(
+                [gen_config.prompt for gen_config in gen_configs],
+                [gen_config.prompt_2 for gen_config in gen_configs],
+            )
+            unconditional_embeds = self.encode_sample_prompts(
+                [gen_config.negative_prompt for gen_config in gen_configs],
+                [gen_config.negative_prompt_2 for gen_config in gen_configs],
+            )
+
+            if self.decorator is not None:
+                # apply the decorator to the embeddings
+                conditional_embeds.text_embeds = self.decorator(conditional_embeds.text_embeds)
+                unconditional_embeds.text_embeds = self.decorator(unconditional_embeds.text_embeds, is_unconditional=True)
+
+            conditional_embeds = conditional_embeds.to(self.device_torch, dtype=self.unet.dtype)
+            unconditional_embeds = unconditional_embeds.to(self.device_torch, dtype=self.unet.dtype)
+
+            batch_images = self.generate_pipeline_images(
+                pipeline,
+                first_config,
+                conditional_embeds,
+                unconditional_embeds,
+                generator,
+                sampler,
+                {},
+            )
+            for i, img in zip(batch_idxs, batch_images):
+                images[i] = img
+
+            # save and log in the order of the configs as soon as they are ready
+            while num_saved in images:
+                img = images.pop(num_saved)
+                image_configs[num_saved].save_image(img, num_saved)
+                image_configs[num_saved].log_image(img, num_saved)
+                num_saved += 1
+            flush()
+
+    def generate_pipeline_images(
+            self,
+            pipeline,
+            gen_config: GenerateImageConfig,
+            conditional_embeds: PromptEmbeds,
+            unconditional_embeds: PromptEmbeds,
+            generator: Union[torch.Generator, List[torch.Generator]],
+            sampler: str,
+            extra: dict,
+    ) -> list:
+        # runs the pipeline with encoded prompts, returns one image per item in the embeds batch
+        if self.is_xl:
+            # fix guidance rescale for sdxl
+            # was trained on 0.7 (I believe)
+
+            grs = gen_config.guidance_rescale
+            # if grs is None or grs < 0.00001:
+            #     grs = 0.7
+            # grs = 0.0
+
+            if sampler.startswith("sample_"):
+                extra['use_karras_sigmas'] = True
+                extra = {
+                    **extra,
+                    **gen_config.extra_kwargs,
+                }
+
+            images = pipeline(
+                # prompt=gen_config.prompt,
+                # prompt_2=gen_config.prompt_2,
+                prompt_embeds=conditional_embeds.text_embeds,
+                pooled_prompt_embeds=conditional_embeds.pooled_embeds,
+                negative_prompt_embeds=unconditional_embeds.text_embeds,
+                negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
+                # negative_prompt=gen_config.negative_prompt,
+                # negative_prompt_2=gen_config.negative_prompt_2,
+                height=gen_config.height,
+                width=gen_config.width,
+                num_inference_steps=gen_config.num_inference_steps,
+                guidance_scale=gen_config.guidance_scale,
+                guidance_rescale=grs,
+                latents=gen_config.latents,
+                generator=generator,
+                **extra
+            ).images
+        elif self.is_v3:
+            images = pipeline(
+                prompt_embeds=conditional_embeds.text_embeds,
+                pooled_prompt_embeds=conditional_embeds.pooled_embeds,
+                negative_prompt_embeds=unconditional_embeds.text_embeds,
+                negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
+                height=gen_config.height,
+                width=gen_config.width,
+                num_inference_steps=gen_config.num_inference_steps,
+                guidance_scale=gen_config.guidance_scale,
+                latents=gen_config.latents,
+                generator=generator,
+                **extra
+            ).images
+        elif self.is_flux:
+            if self.model_config.use_flux_cfg:
+                images = pipeline(
+                    prompt_embeds=conditional_embeds.text_embeds,
+                    pooled_prompt_embeds=conditional_embeds.pooled_embeds,
+                    negative_prompt_embeds=unconditional_embeds.text_embeds,
+                    negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
+                    height=gen_config.height,
+                    width=gen_config.width,
+                    num_inference_steps=gen_config.num_inference_steps,
+                    guidance_scale=gen_config.guidance_scale,
+                    latents=gen_config.latents,
+                    generator=generator,
+                    **extra
+                ).images
+            else:
+                images = pipeline(
+                    prompt_embeds=conditional_embeds.text_embeds,
+                    pooled_prompt_embeds=conditional_embeds.pooled_embeds,
+                    # negative_prompt_embeds=unconditional_embeds.text_embeds,
+                    # negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
+                    height=gen_config.height,
+                    width=gen_config.width,
+                    num_inference_steps=gen_config.num_inference_steps,
+                    guidance_scale=gen_config.guidance_scale,
+                    latents=gen_config.latents,
+                    generator=generator,
+                    **extra
+                ).images
+        elif self.is_pixart:
+            # needs attention masks for some reason
+            images = pipeline(
+                prompt=None,
+                prompt_embeds=conditional_embeds.text_embeds.to(self.device_torch, dtype=self.unet.dtype),
+                prompt_attention_mask=conditional_embeds.attention_mask.to(self.device_torch,
+                                                                           dtype=self.unet.dtype),
+                negative_prompt_embeds=unconditional_embeds.text_embeds.to(self.device_torch,
+                                                                           dtype=self.unet.dtype),
+                negative_prompt_attention_mask=unconditional_embeds.attention_mask.to(self.device_torch,
+                                                                                      dtype=self.unet.dtype),
+                negative_prompt=None,
+                # negative_prompt=gen_config.negative_prompt,
+                height=gen_config.height,
+                width=gen_config.width,
+                num_inference_steps=gen_config.num_inference_steps,
+                guidance_scale=gen_config.guidance_scale,
+                latents=gen_config.latents,
+                generator=generator,
+                **extra
+            ).images
+        elif self.is_auraflow:
+            pipeline: AuraFlowPipeline = pipeline
+
+            images = pipeline(
+                prompt=None,
+                prompt_embeds=conditional_embeds.text_embeds.to(self.device_torch, dtype=self.unet.dtype),
+                prompt_attention_mask=conditional_embeds.attention_mask.to(self.device_torch,
+                                                                           dtype=self.unet.dtype),
+                negative_prompt_embeds=unconditional_embeds.text_embeds.to(self.device_torch,
+                                                                           dtype=self.unet.dtype),
+                negative_prompt_attention_mask=unconditional_embeds.attention_mask.to(self.device_torch,
+                                                                                      dtype=self.unet.dtype),
+                negative_prompt=None,
+                # negative_prompt=gen_config.negative_prompt,
+                height=gen_config.height,
+                width=gen_config.width,
+                num_inference_steps=gen_config.num_inference_steps,
+                guidance_scale=gen_config.guidance_scale,
+                latents=gen_config.latents,
+                generator=generator,
+                **extra
+            ).images
+        else:
+            images = pipeline(
+                # prompt=gen_config.prompt,
+                prompt_embeds=conditional_embeds.text_embeds,
+                negative_prompt_embeds=unconditional_embeds.text_embeds,
+                # negative_prompt=gen_config.negative_prompt,
+                height=gen_config.height,
+                width=gen_config.width,
+                num_inference_steps=gen_config.num_inference_steps,
+                guidance_scale=gen_config.guidance_scale,
+                latents=gen_config.latents,
+                generator=generator,
+                **extra
+            ).images
+
+        return images
+
     def get_latent_noise(
             self,
             height=None,
@@ -2424,7 +2589,15 @@ class StableDiffusion:
             output_config_path = f"{output_path_no_ext}.yaml"
             shutil.copyfile(self.config_file, output_config_path)
 
-    def save(self, output_file: str, meta: OrderedDict, save_dtype=get_torch_dtype('fp16'), logit_scale=None):
+    def save(
+            self,
+            output_file: str,
+            meta: OrderedDict,
+            save_dtype=get_torch_dtype('fp16'),
+            logit_scale=None,
+            writer: Union['AsyncCheckpointWriter', None] = None
+    ):
+        # writer is only used for single file saves, diffusers folders are saved from the live modules
         version_string = '1'
         if self.is_v2:
             version_string = '2'
@@ -2464,6 +2637,7 @@ class StableDiffusion:
                 meta=meta,
                 save_dtype=save_dtype,
                 sd_version=version_string,
+                writer=writer,
             )
             if self.config_file is not None:
                 output_path_no_ext = os.path.splitext(output_file)[0]